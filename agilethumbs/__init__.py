@@ -1 +1,2 @@
-from agilethumbs.base import image_url, ImageProcessorError
+from agilethumbs.base import (image_url, image_urls, image_srcset,
+    ImageProcessorError)
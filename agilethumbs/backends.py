@@ -0,0 +1,305 @@
+import os
+import errno
+import urllib
+import mimetypes
+from StringIO import StringIO
+from hashlib import md5
+from tempfile import gettempdir
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect
+from django.core.urlresolvers import get_callable
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, get_storage_class
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import quote_etag
+from django.views.static import serve as django_serve_static
+
+from agilethumbs import metrics
+from agilethumbs.lru import LRUCache
+from agilethumbs.concurrency import atomic_create_many
+from agilethumbs.eviction import record_creation, record_access
+
+
+# Not known to older versions of the mimetypes module
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+# Cached images never change, as their URLs include the style version and
+# signature
+DEFAULT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class CacheBackend(object):
+    """
+    Somewhere to keep generated images. Names are paths relative to the root
+    of the cache, as returned by agilethumbs.base.cache_path.
+    """
+
+    def exists(self, name):
+        raise NotImplementedError()
+
+    def read(self, name):
+        """
+        Return the contents of a cached image
+        """
+        raise NotImplementedError()
+
+    def serve(self, request, name):
+        """
+        Return a response which serves a cached image
+        """
+        raise NotImplementedError()
+
+    def size(self, name):
+        """
+        Return the size in bytes of a cached image, or None if it doesn't
+        exist
+        """
+        if not self.exists(name):
+            return None
+        return len(self.read(name))
+
+    def create(self, names):
+        """
+        Return a context manager which yields a list of file objects to
+        write each image to, and which stores all of them only once they
+        have all been written successfully
+        """
+        raise NotImplementedError()
+
+    def delete(self, name):
+        raise NotImplementedError()
+
+    def lock_filename(self, name):
+        """
+        Return a local filename to base lock files for the given image on
+        """
+        lock_dir = (getattr(settings, 'AGILETHUMBS_LOCK_DIR', None) or
+                    os.path.join(gettempdir(), 'agilethumbs-locks'))
+        return safe_join(lock_dir, name)
+
+
+class FileSystemCache(CacheBackend):
+    """
+    Keeps images in AGILETHUMBS_CACHE_DIR, where the web server can serve
+    them directly
+    """
+
+    def __init__(self, location=None):
+        self.location = location or settings.AGILETHUMBS_CACHE_DIR
+
+    def path(self, name):
+        return safe_join(self.location, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def serve(self, request, name):
+        path = self.path(name)
+        record_access(path)
+        return serve_file(request, path, self.location)
+
+    def size(self, name):
+        try:
+            return os.stat(self.path(name)).st_size
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    @contextmanager
+    def create(self, names):
+        paths = [self.path(name) for name in names]
+        write_timer = metrics.timer('write')
+        with atomic_create_many(paths) as outfiles:
+            yield outfiles
+            # Time the flush, close and rename
+            write_timer.start()
+        write_timer.stop()
+        for path in paths:
+            record_creation(path)
+
+    def delete(self, name):
+        os.unlink(self.path(name))
+
+    def lock_filename(self, name):
+        # Keep locks alongside the images, so they work for any host which
+        # shares the cache directory
+        return self.path(name)
+
+
+class StorageCache(CacheBackend):
+    """
+    Keeps images in a Django file storage, which may be shared between
+    servers. If `redirect` is True, cached images are served by redirecting
+    to the storage's URL for them rather than by reading them.
+    """
+
+    def __init__(self, storage=None, redirect=False):
+        if storage is None:
+            storage = default_storage
+        elif isinstance(storage, basestring):
+            storage = get_storage_class(storage)()
+        self.storage = storage
+        self.redirect = redirect
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def read(self, name):
+        f = self.storage.open(name, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def serve(self, request, name):
+        if self.redirect:
+            return HttpResponseRedirect(self.storage.url(name))
+        return HttpResponse(self.read(name), content_type=content_type(name))
+
+    def size(self, name):
+        if not self.storage.exists(name):
+            return None
+        return self.storage.size(name)
+
+    @contextmanager
+    def create(self, names):
+        buffers = [StringIO() for name in names]
+        yield buffers
+        write_timer = metrics.timer('write').start()
+        for name, buf in zip(names, buffers):
+            # Storages pick a new name rather than overwrite an existing file
+            if self.storage.exists(name):
+                self.storage.delete(name)
+            saved_name = self.storage.save(name,
+                                           ContentFile(buf.getvalue()))
+            if saved_name != name:
+                # Lost a race with another server writing the same image
+                self.storage.delete(saved_name)
+        write_timer.stop()
+
+    def delete(self, name):
+        self.storage.delete(name)
+
+
+class MemoryCache(CacheBackend):
+    """
+    Keeps up to `max_items` images of no more than `max_item_size` bytes in
+    memory, in front of another backend which holds all of them
+    """
+
+    def __init__(self, backend, max_items=1000, max_item_size=64 * 1024):
+        self.backend = backend
+        self.max_item_size = max_item_size
+        self.images = LRUCache(max_items)
+
+    def exists(self, name):
+        return name in self.images or self.backend.exists(name)
+
+    def read(self, name):
+        data = self.images.get(name)
+        if data is not None:
+            metrics.incr('memory_hit')
+        else:
+            data = self.backend.read(name)
+            if len(data) <= self.max_item_size:
+                self.images.set(name, data)
+        return data
+
+    def serve(self, request, name):
+        return HttpResponse(self.read(name), content_type=content_type(name))
+
+    def size(self, name):
+        data = self.images.get(name)
+        if data is not None:
+            return len(data)
+        return self.backend.size(name)
+
+    def create(self, names):
+        return self.backend.create(names)
+
+    def delete(self, name):
+        self.images.pop(name)
+        self.backend.delete(name)
+
+    def lock_filename(self, name):
+        return self.backend.lock_filename(name)
+
+
+_backend = (None, None)
+
+def get_cache_backend():
+    """
+    Return the backend configured by AGILETHUMBS_CACHE_BACKEND and
+    AGILETHUMBS_CACHE_BACKEND_OPTIONS, wrapped in a MemoryCache configured by
+    AGILETHUMBS_MEMORY_CACHE if that is set. The same instance is returned
+    until those settings change.
+    """
+    global _backend
+    key = (getattr(settings, 'AGILETHUMBS_CACHE_BACKEND',
+                   'agilethumbs.backends.FileSystemCache'),
+           getattr(settings, 'AGILETHUMBS_CACHE_BACKEND_OPTIONS', {}),
+           getattr(settings, 'AGILETHUMBS_MEMORY_CACHE', None),
+           getattr(settings, 'AGILETHUMBS_CACHE_DIR', None))
+    if _backend[0] != key:
+        backend_class, options, memory_options = key[:3]
+        backend = get_callable(backend_class)(**options)
+        if memory_options is not None:
+            backend = MemoryCache(backend, **memory_options)
+        _backend = (key, backend)
+    return _backend[1]
+
+
+def content_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def image_etag(name):
+    """
+    Return a strong ETag for the cached image with the given name, which is
+    derived from the URL and so needs no file access
+    """
+    return md5(name.encode('utf8')).hexdigest()
+
+
+def patch_image_headers(response, name, auto=False):
+    """
+    Add the ETag and AGILETHUMBS_CACHE_CONTROL headers to a response for a
+    cached image, and Vary on Accept for images in 'auto' styles
+    """
+    if response.status_code in (200, 304):
+        response['ETag'] = quote_etag(image_etag(name))
+        cache_control = getattr(settings, 'AGILETHUMBS_CACHE_CONTROL',
+                                DEFAULT_CACHE_CONTROL)
+        if cache_control:
+            response['Cache-Control'] = cache_control
+    if auto:
+        patch_vary_headers(response, ('Accept',))
+    return response
+
+
+def serve_file(request, path, document_root=None):
+    header = getattr(settings, 'AGILETHUMBS_SENDFILE_HEADER', None)
+    if not header:
+        return django_serve_static(request, path, document_root='/')
+    # Leave the web server to send the file itself
+    response = HttpResponse(content_type=content_type(path))
+    if header.lower() == 'x-accel-redirect':
+        # nginx wants the URI of an internal location which maps onto the
+        # cache directory
+        relative_path = os.path.relpath(
+            path, document_root or settings.AGILETHUMBS_CACHE_DIR)
+        response[header] = '%s/%s' % (
+            settings.AGILETHUMBS_SENDFILE_PREFIX.rstrip('/'),
+            urllib.quote(relative_path.encode('utf8'), safe='/~'))
+    else:
+        response[header] = path
+    return response
@@ -5,9 +5,18 @@ from hashlib import sha1
 from base64 import b32encode
 
 from django.conf import settings
-from django.core.urlresolvers import reverse, get_callable
+from django.core.urlresolvers import (reverse, get_callable, get_urlconf,
+    get_script_prefix)
 from django.core.files.storage import default_storage
 from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.test.signals import setting_changed
+except ImportError:
+    setting_changed = None
+
+from agilethumbs.lru import LRUCache
+from agilethumbs.formats import AUTO_EXTENSION, variant_extensions
+from agilethumbs.urls import regices
 
 
 class ImageProcessorError(Exception):
@@ -15,34 +24,321 @@ class ImageProcessorError(Exception):
 
 
 def image_url(fileobj, style='default'):
-    # Allow override of object_to_id function in settings
-    this_object_to_id = get_callable(getattr(
-        settings, 'AGILETHUMBS_OBJECT_TO_ID', object_to_id))
-    # Get file extension and version number for selected image style
+    registry = get_style_registry()
+    return registry[style].url(registry.object_to_id(fileobj))
+
+
+def image_srcset(fileobj, style='default', widths=(), densities=()):
+    """
+    Return a `srcset` attribute value offering the image at each of the
+    given widths (in pixels) and/or whole-number pixel densities (e.g. 2 or
+    '2x')
+
+    The variants are derived from the one style: see
+    StyleRegistry.variant().
+    """
+    registry = get_style_registry()
+    object_id = registry.object_to_id(fileobj)
+    candidates = []
+    for width in widths:
+        width = int(width)
+        url = registry['%s_%dw' % (style, width)].url(object_id)
+        candidates.append('%s %dw' % (url, width))
+    for density in densities:
+        try:
+            density = int(unicode(density).rstrip('x'))
+        except ValueError:
+            # Variant names can only hold whole numbers
+            raise ImproperlyConfigured('Pixel densities for image_srcset '
+                'must be whole numbers, not %r' % density)
+        name = style if density == 1 else '%s_%dx' % (style, density)
+        candidates.append('%s %dx' % (registry[name].url(object_id),
+                                      density))
+    return ', '.join(candidates)
+
+
+def image_urls(fileobjs, styles=('default',)):
+    """
+    Return a list with a dict mapping style names to URLs for each object
+
+    Equivalent to calling image_url for every object and style, but styles
+    are looked up once, each object ID is escaped once and every signature
+    is computed from the same keyed HMAC.
+    """
+    if isinstance(styles, basestring):
+        styles = [styles]
+    registry = get_style_registry()
+    styles = [registry[name] for name in styles]
+    this_object_to_id = registry.object_to_id
+    cache = registry.urls
+    signer = get_signer()
+    results = []
+    for fileobj in fileobjs:
+        object_id = this_object_to_id(fileobj)
+        file_id = None
+        urls = {}
+        for style in styles:
+            cache_key = (object_id, style.name)
+            url = cache.get(cache_key)
+            if url is None:
+                if file_id is None:
+                    file_id = escape(object_id)
+                url = style.build_url(file_id, signer)
+                cache.set(cache_key, url)
+            urls[style.name] = url
+        results.append(urls)
+    return results
+
+
+def sign_params(*args):
+    return sign_with(get_signer(), args)
+
+
+def sign_with(signer, args):
+    signature = signer.copy()
+    signature.update('\n'.join(args))
+    return b32encode(signature.digest()).rstrip('=').lower()
+
+
+_signer = (None, None)
+
+def get_signer():
+    """
+    Return an HMAC object keyed with SECRET_KEY, to be copied for each
+    message so the key is only processed once
+    """
+    global _signer
+    key, signer = _signer
+    if key != settings.SECRET_KEY:
+        key = settings.SECRET_KEY
+        signer = hmac.new(key, digestmod=sha1)
+        _signer = (key, signer)
+    return signer
+
+
+class Style(object):
+    """
+    A compiled entry from AGILETHUMBS_STYLES
+    """
+
+    def __init__(self, registry, name, config):
+        self.registry = registry
+        self.name = name
+        self.config = config
+        self.processor_path, self.extension, version, self.kwargs = config
+        self.version = unicode(version)
+        self._processor = None
+        self._url_template = None
+
+    @property
+    def processor(self):
+        # Resolved lazily so that generating URLs never imports processors
+        if self._processor is None:
+            self._processor = get_callable(self.processor_path)
+        return self._processor
+
+    def params(self, file_id, signer=None):
+        """
+        Return the URL parameters for the given (already escaped) file ID
+        """
+        if signer is None:
+            signer = get_signer()
+        return {
+            'file_id': file_id,
+            'style': self.name,
+            'version': self.version,
+            'signature': sign_with(signer, (file_id, self.name, self.version,
+                                            self.extension)),
+            'extension': self.extension
+        }
+
+    def cache_names(self, file_id):
+        """
+        Return an (extension, cache path) pair for each file cached for the
+        given (already escaped) file ID: one per format for 'auto' styles
+        """
+        params = self.params(file_id)
+        if self.extension != AUTO_EXTENSION:
+            return [(self.extension, cache_path(**params))]
+        return [(extension, cache_path(variant=extension, **params))
+                for extension in variant_extensions(self.processor)]
+
+    def url(self, object_id):
+        cache_key = (object_id, self.name)
+        url = self.registry.urls.get(cache_key)
+        if url is None:
+            url = self.build_url(escape(object_id))
+            self.registry.urls.set(cache_key, url)
+        return url
+
+    def build_url(self, file_id, signer=None):
+        params = self.params(file_id, signer)
+        template = self.url_template
+        if template:
+            return template % (params['file_id'], params['signature'])
+        return reverse('agilethumbs_image', kwargs=params)
+
+    @property
+    def url_template(self):
+        """
+        Reverse the URL once with dummy values and turn it into a template
+        with the file ID and signature left as placeholders
+        """
+        if self._url_template is None:
+            suffix = 'x-%s-%s-x.%s' % (self.name, self.version,
+                                       self.extension)
+            url = reverse('agilethumbs_image', kwargs={
+                'file_id': 'x',
+                'style': self.name,
+                'version': self.version,
+                'signature': 'x',
+                'extension': self.extension
+            })
+            if url.endswith(suffix):
+                self._url_template = (
+                    url[:-len(suffix)].replace('%', '%%') +
+                    '%s-' + self.name + '-' + self.version + '-%s.' +
+                    self.extension)
+            else:
+                # Unexpected URL configuration: reverse on every call
+                self._url_template = False
+        return self._url_template
+
+
+class StyleRegistry(object):
+    """
+    AGILETHUMBS_STYLES compiled into Style objects, along with the resolved
+    object_to_id function and a cache of previously generated URLs
+    """
+
+    def __init__(self, key):
+        self.key = key
+        styles, this_object_to_id = key[:2]
+        self.object_to_id = get_callable(this_object_to_id)
+        self.styles = dict(
+            (name, Style(self, name, config))
+            for (name, config) in styles.items())
+        self.urls = LRUCache(
+            getattr(settings, 'AGILETHUMBS_URL_CACHE_SIZE', 10000))
+        self.variants = LRUCache(1000)
+
+    def __getitem__(self, name):
+        style = self.get(name)
+        if style is None:
+            raise ImproperlyConfigured("No such image style '%s' defined in "
+                "settings.AGILETHUMBS_STYLES" % name)
+        return style
+
+    def get(self, name, default=None):
+        style = self.styles.get(name)
+        if style is None:
+            style = self.variants.get(name)
+            if style is None:
+                style = self.variant(name)
+                if style is None:
+                    return default
+                self.variants.set(name, style)
+        return style
+
+    def variant(self, name):
+        """
+        Return a Style for a size variant of a configured style, or None if
+        `name` isn't one: '<style>_<N>w' is the style resized to N pixels
+        wide, and '<style>_<N>x' the style at N times its dimensions. The
+        variant shares the style's version, so bumping one bumps both.
+        """
+        match = variant_regex.match(name)
+        if not match or match.group('base') not in self.styles:
+            return None
+        size = int(match.group('size'))
+        if size < 1:
+            return None
+        processor_path, extension, version, kwargs = \
+            self.styles[match.group('base')].config
+        if 'operations' in kwargs:
+            # Pipelines are scaled by scaling each resize operation
+            kwargs = dict(kwargs, operations=[
+                (op[0], scale_dimensions(op[1], match.group('unit'), size))
+                if isinstance(op, (list, tuple)) else op
+                for op in kwargs['operations']])
+        else:
+            kwargs = scale_dimensions(kwargs, match.group('unit'), size)
+        return Style(self, name, (processor_path, extension, version, kwargs))
+
+
+variant_regex = re.compile(r'^(?P<base>.+)_(?P<size>[0-9]+)(?P<unit>[wx])$')
+
+def scale_dimensions(kwargs, unit, size):
+    """
+    Return a copy of processor keyword arguments with the width and height
+    changed to give an image `size` pixels wide (for unit 'w') or `size`
+    times larger (for unit 'x')
+    """
+    width = kwargs.get('width') or None
+    height = kwargs.get('height') or None
+    if width is None and height is None:
+        return kwargs
+    if unit == 'x':
+        width = width and int(width) * size
+        height = height and int(height) * size
+    elif width is not None:
+        height = height and int(round(int(height) * size / float(width)))
+        width = size
+    else:
+        # Only the height is fixed, so the width can only be set instead
+        width, height = size, None
+    kwargs = dict(kwargs, width=width)
+    if height is None:
+        kwargs.pop('height', None)
+    else:
+        kwargs['height'] = height
+    return kwargs
+
+
+_registry = None
+
+def get_style_registry():
+    """
+    Return the StyleRegistry for the current settings, recompiling it if any
+    of the settings it depends on have been replaced
+    """
+    global _registry
     try:
-        extension, version = settings.AGILETHUMBS_STYLES[style][1:3]
-    except KeyError:
-        raise ImproperlyConfigured("No such image style '%s' defined in "
-            "settings.AGILETHUMBS_STYLES" % style)
+        styles = settings.AGILETHUMBS_STYLES
     except AttributeError:
         raise ImproperlyConfigured("You must define some image styles in "
             "settings.AGILETHUMBS_STYLES.\nSee documentation for examples.")
-    file_id = escape(this_object_to_id(fileobj))
-    version = unicode(version)
-    signature = sign_params(file_id, style, version, extension)
-    return reverse('agilethumbs_image', kwargs={
-        'file_id': file_id,
-        'style': style,
-        'version': version,
-        'signature': signature,
-        'extension': extension
-    })
+    # The URL configuration and script prefix both affect reverse()
+    key = (styles,
+           getattr(settings, 'AGILETHUMBS_OBJECT_TO_ID', object_to_id),
+           settings.SECRET_KEY,
+           get_urlconf() or settings.ROOT_URLCONF,
+           get_script_prefix())
+    registry = _registry
+    if registry is None or registry.key[0] is not styles \
+            or registry.key[1:] != key[1:]:
+        registry = _registry = StyleRegistry(key)
+    return registry
 
 
-def sign_params(*args):
-    msg = '\n'.join(args)
-    signature = hmac.new(settings.SECRET_KEY, msg, digestmod=sha1).digest()
-    return b32encode(signature).rstrip('=').lower()
+def clear_style_registry(**kwargs):
+    """
+    Discard the compiled styles and URL cache. Only needed if
+    AGILETHUMBS_STYLES is modified in place rather than replaced.
+    """
+    global _registry
+    _registry = None
+
+if setting_changed is not None:
+    setting_changed.connect(clear_style_registry)
+
+
+def url_cache_stats():
+    """
+    Return hit and miss counts for the URL cache, for tuning
+    AGILETHUMBS_URL_CACHE_SIZE
+    """
+    return get_style_registry().urls.stats()
 
 
 def object_to_id(fileobj):
@@ -68,3 +364,67 @@ def escape(s):
 
 def unescape(s):
     return urllib.unquote(s.replace('~', '%')).decode('utf8')
+
+
+cache_filename_regex = re.compile(
+    r'^%(file_id)s-%(style)s-%(version)s-%(signature)s\.%(extension)s'
+    r'(?:\.(?P<variant>[a-z0-9]+))?$' % regices)
+
+def get_cache_layout(layout=None):
+    """
+    Return the cache directory layout ('flat' or 'sharded') and, for the
+    sharded layout, the number of fan-out directory levels
+    """
+    if layout is None:
+        layout = getattr(settings, 'AGILETHUMBS_CACHE_LAYOUT', 'flat')
+    if layout not in ('flat', 'sharded'):
+        raise ImproperlyConfigured("AGILETHUMBS_CACHE_LAYOUT must be 'flat' "
+                                   "or 'sharded'")
+    depth = getattr(settings, 'AGILETHUMBS_CACHE_SHARD_DEPTH', 2)
+    return layout, (depth if layout == 'sharded' else 0)
+
+
+def cache_path(file_id, style, version, signature, extension, layout=None,
+               variant=None):
+    """
+    Return the path of the cached file for the supplied request parameters,
+    relative to the cache directory. Each format an 'auto' style is served in
+    is a `variant` with its own file alongside the others.
+
+    The sharded layout prefixes the path with directories named after pairs
+    of characters from the signature, which is already a hash and is part of
+    the URL, so the web server can map URLs to files without help.
+    """
+    path = '%s-%s-%s-%s.%s' % (file_id, style, version, signature, extension)
+    if variant is not None:
+        path = '%s.%s' % (path, variant)
+    layout, depth = get_cache_layout(layout)
+    shards = [signature[i * 2:i * 2 + 2] for i in range(depth)]
+    return '/'.join(shards + [path])
+
+
+def parse_cache_filename(path, layout=None):
+    """
+    Return the request parameters (plus the variant, for 'auto' styles) for
+    a path relative to the cache directory, or None if it isn't a cached
+    image with a valid signature
+    """
+    layout, depth = get_cache_layout(layout)
+    parts = path.split('/', depth)
+    if len(parts) <= depth:
+        return None
+    match = cache_filename_regex.match(parts[-1])
+    if not match:
+        return None
+    params = match.groupdict()
+    if params['variant'] is None:
+        del params['variant']
+    if cache_path(layout=layout, **params) != path:
+        return None
+    # Checking the signature also tells the layouts apart, as the shard
+    # directories of one are valid file ID components in the other
+    if params['signature'] != sign_params(params['file_id'], params['style'],
+                                          params['version'],
+                                          params['extension']):
+        return None
+    return params
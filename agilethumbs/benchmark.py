@@ -0,0 +1,291 @@
+"""
+Offline benchmarks for the image processors, URL generation and the serving
+path, run with the agilethumbs_benchmark management command
+"""
+from __future__ import division
+import time
+import shutil
+import platform
+import tempfile
+import resource
+import multiprocessing
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.urlresolvers import (get_urlconf, set_urlconf, resolve,
+    get_callable)
+from django.test.client import RequestFactory
+from django.template import Template, Context
+
+from agilethumbs import image_url, image_urls, processor_pil
+from agilethumbs.processor_im import has_convert
+
+
+SOURCE_SIZES = [(640, 480), (1920, 1280), (4000, 3000)]
+SOURCE_FORMATS = ['JPEG', 'PNG']
+RESIZE_MODES = ['fit', 'fill', 'pad', 'squash']
+PROCESSORS = ['agilethumbs.processor_pil.simple_resize',
+              'agilethumbs.processor_im.simple_resize']
+# processor_im is also measured with this many AGILETHUMBS_IM_WORKERS
+IM_WORKERS = 1
+OUTPUT_SIZE = (200, 150)
+URL_BATCH = 10000
+
+GROUPS = ['processors', 'urls', 'requests']
+
+
+def run(groups=GROUPS, quick=False, repeat=None, callback=None):
+    """
+    Run the benchmarks in the given groups and return the results as a dict
+    which can be saved as JSON. `quick` uses smaller inputs and fewer
+    iterations, for a rough comparison. `callback` is called with each
+    result as it is measured.
+    """
+    results = []
+    def report(result):
+        results.append(result)
+        if callback is not None:
+            callback(result)
+    if 'processors' in groups:
+        bench_processors(report, quick, repeat)
+    if 'urls' in groups:
+        bench_urls(report, URL_BATCH // 10 if quick else URL_BATCH)
+    if 'requests' in groups:
+        bench_requests(report, 20 if quick else (repeat or 200))
+    return {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pil': getattr(processor_pil.Image, '__version__',
+                       getattr(processor_pil.Image, 'VERSION', None)),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def make_source(size, format):
+    """
+    Return the contents of a synthetic image of the given size: gradients
+    with some noise, so that it compresses like a photo rather than a block
+    of colour
+    """
+    Image = processor_pil.Image
+    gradient = Image.linear_gradient('L')
+    bands = [gradient.resize(size),
+             gradient.rotate(90).resize(size),
+             Image.effect_noise(size, 32)]
+    im = Image.merge('RGB', bands)
+    output = StringIO()
+    im.save(output, format, quality=90)
+    return output.getvalue()
+
+
+def result(group, name, iterations, seconds, **extra):
+    result = {
+        'group': group,
+        'name': name,
+        'iterations': iterations,
+        'seconds': seconds,
+        'per_second': iterations / seconds if seconds else None,
+    }
+    result.update(extra)
+    return result
+
+
+def bench_processors(report, quick=False, repeat=None):
+    sizes = SOURCE_SIZES[:1] if quick else SOURCE_SIZES
+    cases = [(processor_path, 0) for processor_path in PROCESSORS]
+    cases.append(('agilethumbs.processor_im.simple_resize', IM_WORKERS))
+    for processor_path, workers in cases:
+        label = processor_path
+        if workers:
+            label += ' AGILETHUMBS_IM_WORKERS=%d' % workers
+        if 'processor_im' in processor_path and not has_convert():
+            report(result('processors', label, 0, 0,
+                          skipped='ImageMagick is not installed'))
+            continue
+        for format in SOURCE_FORMATS:
+            for size in sizes:
+                source = make_source(size, format)
+                for resize in RESIZE_MODES:
+                    iterations = repeat or (2 if quick else
+                                            max(2, 20000000 // (size[0] *
+                                                                size[1])))
+                    name = '%s %s %dx%d %s' % (label, format,
+                                               size[0], size[1], resize)
+                    seconds, peak_rss, child_peak_rss = in_child(
+                        time_processor, (processor_path, source, resize,
+                                         iterations, workers))
+                    extra = {}
+                    if 'processor_im' in processor_path and not workers:
+                        # The image is decoded by convert, not the process
+                        # calling it (with workers, convert isn't its child)
+                        extra['child_peak_rss_kb'] = child_peak_rss
+                    report(result('processors', name, iterations, seconds,
+                                  source_bytes=len(source),
+                                  peak_rss_kb=peak_rss, **extra))
+
+
+def time_processor(processor_path, source, resize, iterations, workers=0):
+    processor = get_callable(processor_path)
+    width, height = OUTPUT_SIZE
+    # processor_pil pads with an RGBA background, which JPEG can't hold
+    extension = 'png' if resize == 'pad' else 'jpg'
+    run = lambda: processor(StringIO(source), StringIO(), extension,
+                            width=width, height=height, resize=resize,
+                            background='#ffffff')
+    if workers:
+        # This runs in its own process, so the setting needn't be restored.
+        # Starting the pool isn't counted, as it is only paid once.
+        settings.AGILETHUMBS_IM_WORKERS = workers
+        run()
+    started = time.time()
+    for i in range(iterations):
+        run()
+    return time.time() - started
+
+
+def in_child(func, args):
+    """
+    Run `func` in a fresh child process, so that its peak memory use can be
+    measured, and return its result, the increase in peak RSS in KB and the
+    peak RSS in KB of the largest process it ran in turn (such as convert)
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=child_main,
+                                      args=(child, func, args))
+    process.start()
+    try:
+        status, value, peak_rss, child_peak_rss = parent.recv()
+    finally:
+        process.join()
+    if status == 'error':
+        raise RuntimeError(value)
+    return value, peak_rss, child_peak_rss
+
+
+def child_main(conn, func, args):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        value = func(*args)
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (e.__class__.__name__, e), None,
+                   None))
+    else:
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        conn.send(('ok', value, after - before, children))
+    conn.close()
+
+
+class BenchmarkImage(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+@contextmanager
+def benchmark_settings(**values):
+    """
+    Temporarily configure agilethumbs for the benchmarks, routing its URLs
+    directly rather than through the project's URLconf
+    """
+    missing = object()
+    old_values = dict((key, getattr(settings, key, missing))
+                      for key in values)
+    old_urlconf = get_urlconf()
+    for key, value in values.items():
+        setattr(settings, key, value)
+    set_urlconf('agilethumbs.urls')
+    try:
+        yield
+    finally:
+        set_urlconf(old_urlconf)
+        for key, value in old_values.items():
+            if value is missing:
+                delattr(settings, key)
+            else:
+                setattr(settings, key, value)
+
+
+STYLES = {
+    'small': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+              {'width': OUTPUT_SIZE[0], 'height': OUTPUT_SIZE[1]}),
+    'large': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+              {'width': OUTPUT_SIZE[0] * 4, 'height': OUTPUT_SIZE[1] * 4}),
+}
+
+
+def bench_urls(report, count):
+    images = [BenchmarkImage(u'uploads/%d/photo %d.jpg' % (i % 100, i))
+              for i in range(count)]
+    template = Template(
+        '{% load agilethumbs %}{% for image in images %}'
+        '{% image_url image "small" %}{% endfor %}')
+    bulk_template = Template(
+        '{% load agilethumbs %}{% image_urls images "small" as urls %}'
+        '{% for image, url in urls %}{{ url.small }}{% endfor %}')
+    with benchmark_settings(AGILETHUMBS_STYLES=STYLES):
+        # The first pass fills the URL cache
+        for label in ('cold', 'warm'):
+            started = time.time()
+            for image in images:
+                image_url(image, 'small')
+            report(result('urls', 'image_url %s' % label, count,
+                          time.time() - started))
+        started = time.time()
+        image_urls(images, ['small', 'large'])
+        report(result('urls', 'image_urls 2 styles', count,
+                      time.time() - started))
+        started = time.time()
+        template.render(Context({'images': images}))
+        report(result('urls', 'image_url tag', count,
+                      time.time() - started))
+        started = time.time()
+        bulk_template.render(Context({'images': images}))
+        report(result('urls', 'image_urls tag', count,
+                      time.time() - started))
+
+
+def bench_requests(report, count):
+    tmp_dir = tempfile.mkdtemp()
+    source = make_source(SOURCE_SIZES[1], 'JPEG')
+    id_to_object = lambda file_id: StringIO(source)
+    factory = RequestFactory()
+    try:
+        with benchmark_settings(AGILETHUMBS_STYLES=STYLES,
+                                AGILETHUMBS_CACHE_DIR=tmp_dir,
+                                AGILETHUMBS_ID_TO_OBJECT=id_to_object,
+                                AGILETHUMBS_SENDFILE_HEADER=None,
+                                AGILETHUMBS_METRICS=None):
+            urls = [image_url(BenchmarkImage(u'image%d.jpg' % i), 'small')
+                    for i in range(count)]
+            for label in ('miss', 'hit'):
+                started = time.time()
+                for url in urls:
+                    match = resolve(url)
+                    response = match.func(factory.get(url), *match.args,
+                                          **match.kwargs)
+                    if response.status_code != 200:
+                        raise RuntimeError('%s returned %d' % (
+                            url, response.status_code))
+                    # Make sure the file has actually been read
+                    ''.join(response)
+                report(result('requests', 'agilethumbs_image %s' % label,
+                              count, time.time() - started))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def compare(old, new):
+    """
+    Yield (name, old per second, new per second, ratio) for each benchmark
+    in both sets of results
+    """
+    old_results = dict(((r['group'], r['name']), r) for r in old['results'])
+    for r in new['results']:
+        previous = old_results.get((r['group'], r['name']))
+        if previous and previous['per_second'] and r['per_second']:
+            yield (r['name'], previous['per_second'], r['per_second'],
+                   r['per_second'] / previous['per_second'])
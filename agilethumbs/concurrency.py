@@ -0,0 +1,287 @@
+import os
+import time
+import fcntl
+import errno
+import socket
+import threading
+from contextlib import contextmanager
+from tempfile import mkstemp, gettempdir
+
+from django.conf import settings
+
+
+LOCK_SUFFIX = '.lock'
+POLL_INTERVAL = 0.05
+
+
+class ServerBusy(Exception):
+    """
+    Raised when no processing slot became free in time
+    """
+    def __init__(self, retry_after):
+        super(ServerBusy, self).__init__(
+            'No image processing slot available')
+        self.retry_after = retry_after
+
+
+@contextmanager
+def atomic_create(filename, mode=0660, makedirs=True):
+    """
+    Return a temporary file object to write to and move file into position
+    once creation is complete
+    """
+    with atomic_create_many([filename], mode, makedirs) as files:
+        yield files[0]
+
+
+@contextmanager
+def atomic_create_many(filenames, mode=0660, makedirs=True):
+    """
+    Like atomic_create, but for a list of files which are all moved into
+    position only once every one of them has been written
+    """
+    tmp_names = []
+    tmp_files = []
+    try:
+        for filename in filenames:
+            directory = os.path.dirname(filename)
+            if makedirs:
+                ensure_dir(directory)
+            tmp_names.append(mkstemp(dir=directory)[1])
+            tmp_files.append(open(tmp_names[-1], 'wb'))
+        # Yield file handles, actual content creation happens here
+        yield tmp_files
+        # Flush everything to disk before anything becomes visible, then set
+        # permissions and move them into place
+        for tmp_file in tmp_files:
+            tmp_file.close()
+        for tmp_name, filename in zip(tmp_names, filenames):
+            os.chmod(tmp_name, mode)
+            os.rename(tmp_name, filename)
+    except:
+        for tmp_name in tmp_names:
+            if os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+        raise
+    finally:
+        for tmp_file in tmp_files:
+            tmp_file.close()
+
+
+@contextmanager
+def single_flight(filename, timeout=None, stale_after=None, exists=None):
+    """
+    Ensure that only one thread, process or host generates `filename` at a
+    time, using a lock file alongside it
+
+    Yields True if the lock was acquired. Waiters block until the lock is
+    released or `timeout` seconds pass, whichever is first, and then yield
+    False; the caller should check whether the file now exists before doing
+    the work itself. Lock files older than `stale_after` seconds, or left by a
+    dead process on this host, are assumed to belong to crashed workers and
+    are broken. `exists` is called to check for the file, for files which
+    aren't kept on the local filesystem; it may be slow, so it is only
+    called once, and while waiting only the lock file is polled.
+    """
+    if exists is None:
+        exists = lambda: os.path.exists(filename)
+    if timeout is None:
+        timeout = getattr(settings, 'AGILETHUMBS_LOCK_TIMEOUT', 30)
+    if stale_after is None:
+        stale_after = getattr(settings, 'AGILETHUMBS_LOCK_STALE_AFTER', 120)
+    lock_name = filename + LOCK_SUFFIX
+    ensure_dir(os.path.dirname(lock_name))
+    deadline = time.time() + timeout
+    acquired = try_lock(lock_name)
+    if not acquired and not exists():
+        # Wait for the lock to be released. Taking it over then means the
+        # holder is done, and the caller checks for the file again.
+        while True:
+            if is_stale(lock_name, stale_after):
+                # Two waiters could both break the same stale lock and so
+                # both go on to generate the file, but atomic_create keeps
+                # that safe
+                break_lock(lock_name)
+            elif time.time() >= deadline:
+                break
+            else:
+                time.sleep(POLL_INTERVAL)
+            acquired = try_lock(lock_name)
+            if acquired:
+                break
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            break_lock(lock_name)
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+def coalesce(key, func, *args, **kwargs):
+    """
+    Call `func` with the given arguments, unless another thread in this
+    process is already doing so for the same key, in which case wait for
+    that call to finish and return its result or raise its exception
+
+    A threaded process receiving many requests for the same uncached image
+    then does the work once, and the waiting threads are woken as soon as
+    it is done rather than polling single_flight's lock file. Threads which
+    have waited AGILETHUMBS_LOCK_TIMEOUT seconds call `func` themselves, as
+    single_flight's waiters do.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+    if not leader:
+        flight.done.wait(getattr(settings, 'AGILETHUMBS_LOCK_TIMEOUT', 30))
+        if not flight.done.is_set():
+            return func(*args, **kwargs)
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    try:
+        flight.result = func(*args, **kwargs)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.result
+
+
+@contextmanager
+def processing_slot(limit=None, queue=None, timeout=None, directory=None):
+    """
+    Hold one of `limit` image processing slots shared by every process using
+    the same slot directory
+
+    Slots are files locked with flock, so they are released automatically if
+    the process dies. Up to `queue` callers wait for a slot, for at most
+    `timeout` seconds; if the queue is full or the wait times out ServerBusy
+    is raised. Does nothing if no limit is configured.
+    """
+    if limit is None:
+        limit = getattr(settings, 'AGILETHUMBS_PROCESSING_LIMIT', None)
+    if not limit:
+        yield
+        return
+    if queue is None:
+        queue = getattr(settings, 'AGILETHUMBS_PROCESSING_QUEUE', limit * 2)
+    if timeout is None:
+        timeout = getattr(settings, 'AGILETHUMBS_PROCESSING_TIMEOUT', 10)
+    if directory is None:
+        directory = getattr(settings, 'AGILETHUMBS_SLOT_DIR',
+                            os.path.join(gettempdir(), 'agilethumbs-slots'))
+    ensure_dir(directory)
+    retry_after = getattr(settings, 'AGILETHUMBS_PROCESSING_RETRY_AFTER', 5)
+    slot = try_flock_any(directory, 'slot', limit)
+    if slot is None:
+        # Join the queue, or give up straight away if it's full
+        place = try_flock_any(directory, 'queue', queue)
+        if place is None:
+            raise ServerBusy(retry_after)
+        try:
+            deadline = time.time() + timeout
+            while slot is None:
+                if time.time() >= deadline:
+                    raise ServerBusy(retry_after)
+                time.sleep(POLL_INTERVAL)
+                slot = try_flock_any(directory, 'slot', limit)
+        finally:
+            place.close()
+    try:
+        yield
+    finally:
+        slot.close()
+
+
+def try_flock_any(directory, prefix, count):
+    """
+    Return an open file holding an exclusive lock on the first free one of
+    `count` lock files, or None if they are all taken
+    """
+    for i in range(count):
+        f = open(os.path.join(directory, '%s-%d' % (prefix, i)), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            return f
+    return None
+
+
+def try_lock(lock_name):
+    """
+    Atomically create the lock file, recording who holds it. O_EXCL is atomic
+    on local filesystems and on NFSv3 and later.
+    """
+    try:
+        fd = os.open(lock_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0660)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    try:
+        os.write(fd, '%s %d\n' % (socket.gethostname(), os.getpid()))
+    finally:
+        os.close(fd)
+    return True
+
+
+def is_stale(lock_name, stale_after):
+    try:
+        age = time.time() - os.stat(lock_name).st_mtime
+        with open(lock_name, 'rb') as f:
+            owner = f.read().split()
+    except (OSError, IOError) as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    if age > stale_after:
+        return True
+    # A lock held by a process on this host which no longer exists is stale
+    # regardless of age. An empty lock file is one still being written.
+    if len(owner) == 2 and owner[0] == socket.gethostname():
+        return not pid_exists(int(owner[1]))
+    return False
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def break_lock(lock_name):
+    try:
+        os.unlink(lock_name)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def ensure_dir(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,206 @@
+"""
+Generate cached images as soon as a model's file field changes, rather than
+on the first request for them
+"""
+import os
+import threading
+from Queue import Queue, Full
+
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from django.db.models import get_model
+from django.db.models.signals import post_init, post_save, class_prepared
+
+from agilethumbs.base import get_style_registry, escape
+from agilethumbs.generate import generate_styles
+from agilethumbs.failures import (FAILURE_EXCEPTIONS, is_source_failure,
+    record_failure, clear_failures)
+from agilethumbs.metadata import clear_source_metadata
+
+
+def get_eager_styles():
+    """
+    Return AGILETHUMBS_EAGER_STYLES, which maps 'app_label.Model.field'
+    labels to the names of the styles to generate when that field changes
+    """
+    return getattr(settings, 'AGILETHUMBS_EAGER_STYLES', {})
+
+
+def connect():
+    """
+    Watch the models in AGILETHUMBS_EAGER_STYLES, whether or not they have
+    been loaded yet
+    """
+    if not get_eager_styles():
+        return
+    class_prepared.connect(model_prepared,
+                           dispatch_uid='agilethumbs.eager.model_prepared')
+    for label in get_eager_styles():
+        app_label, model_name, field = label.split('.')
+        model = get_model(app_label, model_name, seed_cache=False)
+        if model is not None:
+            watch(model)
+
+
+def model_prepared(sender, **kwargs):
+    if model_fields(sender):
+        watch(sender)
+
+
+def watch(model):
+    uid = 'agilethumbs.eager.%s.%s' % (model._meta.app_label,
+                                       model._meta.object_name)
+    post_init.connect(remember_files, sender=model, dispatch_uid=uid)
+    post_save.connect(queue_changed_files, sender=model, dispatch_uid=uid)
+
+
+def unwatch(model):
+    uid = 'agilethumbs.eager.%s.%s' % (model._meta.app_label,
+                                       model._meta.object_name)
+    post_init.disconnect(sender=model, dispatch_uid=uid)
+    post_save.disconnect(sender=model, dispatch_uid=uid)
+
+
+def model_fields(model):
+    """
+    Return a list of (field name, style names) configured for the model
+    """
+    prefix = ('%s.%s.' % (model._meta.app_label,
+                          model._meta.object_name)).lower()
+    return [(label[len(prefix):], style_names)
+            for label, style_names in get_eager_styles().items()
+            if label.lower().startswith(prefix)]
+
+
+def remember_files(sender, instance, **kwargs):
+    # Note the files the instance started with, so that saves which don't
+    # change them can be ignored
+    instance._agilethumbs_names = dict(
+        (field, getattr(instance, field).name)
+        for field, style_names in model_fields(sender))
+
+
+def queue_changed_files(sender, instance, raw=False, **kwargs):
+    if raw:
+        # Loading fixtures
+        return
+    old_names = getattr(instance, '_agilethumbs_names', {})
+    for field, style_names in model_fields(sender):
+        fileobj = getattr(instance, field)
+        if fileobj and fileobj.name != old_names.get(field):
+            file_changed(fileobj, style_names)
+    remember_files(sender, instance)
+
+
+def file_changed(fileobj, style_names):
+    """
+    Forget what is known about the file's previous contents and queue the
+    given styles to be generated for it
+    """
+    object_id = get_style_registry().object_to_id(fileobj)
+    file_id = escape(object_id)
+    clear_failures(file_id)
+    clear_source_metadata(object_id)
+    get_queue().enqueue(file_id, style_names)
+
+
+def generate(file_id, style_names):
+    """
+    Generate the missing cached images for a file, remembering failures so
+    that requests for them don't try again straight away
+    """
+    try:
+        # The queue is its own concurrency limit
+        generate_styles(file_id, style_names, throttle=False)
+    except FAILURE_EXCEPTIONS as e:
+        if not is_source_failure(e):
+            raise
+        registry = get_style_registry()
+        for style_name in style_names:
+            for extension, name in registry[style_name].cache_names(file_id):
+                record_failure(name)
+
+
+class SynchronousQueue(object):
+    """
+    Generates images straight away, in the thread saving the model
+    """
+
+    def enqueue(self, file_id, style_names):
+        generate(file_id, style_names)
+
+
+class ThreadQueue(object):
+    """
+    Generates images in a pool of `threads` background threads. Jobs already
+    waiting are not queued again, and jobs beyond `max_pending` are dropped,
+    leaving the images to be generated when first requested.
+    """
+
+    def __init__(self, threads=2, max_pending=1000):
+        self.threads = threads
+        self.queue = Queue(max_pending)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def enqueue(self, file_id, style_names):
+        job = (file_id, tuple(style_names))
+        with self.lock:
+            if job in self.pending:
+                return
+            try:
+                self.queue.put_nowait(job)
+            except Full:
+                return
+            self.pending.add(job)
+            if len(self.workers) < self.threads:
+                worker = threading.Thread(target=self.run,
+                                          name='agilethumbs-eager')
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            with self.lock:
+                # The file may change again while it is being processed
+                self.pending.discard(job)
+            try:
+                generate(*job)
+            except Exception:
+                # Requests for the images will try again, and report errors
+                pass
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Wait until every queued job is done
+        """
+        self.queue.join()
+
+
+_queue = (None, None)
+
+def get_queue():
+    """
+    Return the queue configured by AGILETHUMBS_EAGER_QUEUE (either an object
+    with an enqueue(file_id, style_names) method, or the dotted path of a
+    class to construct with the keyword arguments in
+    AGILETHUMBS_EAGER_QUEUE_OPTIONS). Queues are not shared with child
+    processes, whose threads don't survive the fork.
+    """
+    global _queue
+    config = getattr(settings, 'AGILETHUMBS_EAGER_QUEUE',
+                     'agilethumbs.eager.ThreadQueue')
+    key = (config, os.getpid())
+    if _queue[0] != key:
+        if isinstance(config, basestring):
+            queue = get_callable(config)(
+                **getattr(settings, 'AGILETHUMBS_EAGER_QUEUE_OPTIONS', {}))
+        else:
+            queue = config
+        _queue = (key, queue)
+    return _queue[1]
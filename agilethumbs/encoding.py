@@ -0,0 +1,24 @@
+from django.conf import settings
+
+from agilethumbs.base import ImageProcessorError
+
+
+# Options understood by both processors' `encoder` argument
+ENCODER_OPTIONS = ('progressive', 'optimize', 'subsampling', 'colors',
+                   'strip', 'target_bytes', 'min_quality')
+
+# Used by `target_bytes` unless overridden by `min_quality`
+DEFAULT_MIN_QUALITY = 30
+
+
+def encoder_options(encoder=None):
+    """
+    Return the encoder options for a style: its `encoder` argument on top of
+    the site-wide AGILETHUMBS_ENCODER defaults
+    """
+    options = dict(getattr(settings, 'AGILETHUMBS_ENCODER', {}))
+    options.update(encoder or {})
+    for key in options:
+        if key not in ENCODER_OPTIONS:
+            raise ImageProcessorError('Unknown encoder option: %s' % key)
+    return options
@@ -0,0 +1,196 @@
+import os
+import time
+import errno
+import sqlite3
+
+from django.conf import settings
+
+from agilethumbs.base import get_style_registry, parse_cache_filename
+
+
+POLICIES = {
+    'lru': 'last_access ASC',
+    'lfu': 'hits ASC, last_access ASC',
+}
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        style TEXT NOT NULL,
+        version TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS files_style_version ON files (style, version);
+"""
+
+
+def get_index_path():
+    return getattr(settings, 'AGILETHUMBS_CACHE_INDEX', None)
+
+
+def record_creation(filename):
+    """
+    Note that a file has been added to the cache, if tracking is enabled
+    """
+    index_path = get_index_path()
+    if index_path is not None:
+        append_log(index_path, 'C', filename, os.path.getsize(filename))
+
+
+def record_access(filename):
+    """
+    Note that a cached file has been served, if tracking is enabled
+    """
+    index_path = get_index_path()
+    if index_path is not None:
+        append_log(index_path, 'A', filename)
+
+
+def append_log(index_path, action, filename, size=0):
+    path = os.path.relpath(filename, settings.AGILETHUMBS_CACHE_DIR)
+    line = '%s\t%f\t%d\t%s\n' % (action, time.time(), size, path)
+    # Appends this small are atomic, so processes can share the log safely
+    fd = os.open(index_path + '.log',
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0660)
+    try:
+        os.write(fd, line.encode('utf8'))
+    finally:
+        os.close(fd)
+
+
+class CacheIndex(object):
+    """
+    SQLite index of the files in AGILETHUMBS_CACHE_DIR, used to keep the
+    cache within a size budget without scanning the directory
+
+    Creating or serving a cached file only appends a line to an access log
+    next to the index, which is cheap enough to do on every request. The log
+    is folded into the index whenever files are to be evicted.
+    """
+
+    def __init__(self, index_path=None, cache_dir=None, layout=None):
+        self.index_path = index_path or get_index_path()
+        self.cache_dir = cache_dir or settings.AGILETHUMBS_CACHE_DIR
+        self.layout = layout
+        self.db = sqlite3.connect(self.index_path, timeout=60)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def ingest(self):
+        """
+        Fold the access log into the index and return the number of entries
+        read. The log is renamed before reading, so processes appending to
+        it carry on with a fresh one.
+        """
+        log_name = self.index_path + '.log'
+        batch_name = '%s.%d.%f' % (log_name, os.getpid(), time.time())
+        try:
+            os.rename(log_name, batch_name)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+        count = 0
+        with open(batch_name, 'rb') as batch, self.db:
+            for line in batch:
+                try:
+                    action, timestamp, size, path = \
+                        line.decode('utf8').rstrip('\n').split('\t', 3)
+                except ValueError:
+                    # Ignore any incomplete line
+                    continue
+                if action == 'C':
+                    self.add(path, int(size), float(timestamp))
+                else:
+                    self.db.execute(
+                        'UPDATE files SET last_access = MAX(last_access, ?),'
+                        ' hits = hits + 1 WHERE path = ?',
+                        (float(timestamp), path))
+                count += 1
+        os.unlink(batch_name)
+        return count
+
+    def add(self, path, size, timestamp):
+        params = parse_cache_filename(path, self.layout)
+        if params is None:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO files (path, style, version, size,'
+            ' last_access, hits) VALUES (?, ?, ?, ?, ?, 0)',
+            (path, params['style'], params['version'], size, timestamp))
+
+    def scan(self):
+        """
+        Rebuild the index from the contents of the cache directory: only
+        needed when tracking is first enabled for an existing cache
+        """
+        with self.db:
+            self.db.execute('DELETE FROM files')
+            for directory, dirnames, filenames in os.walk(self.cache_dir):
+                for name in filenames:
+                    filename = os.path.join(directory, name)
+                    path = os.path.relpath(filename, self.cache_dir)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError:
+                        continue
+                    if not isinstance(path, unicode):
+                        path = path.decode('utf8')
+                    self.add(path, stat.st_size, stat.st_atime)
+
+    def total_size(self):
+        return self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+
+    def evict(self, max_bytes, policy='lru'):
+        """
+        Delete files, least recently (or frequently) used first, until the
+        cache is no larger than `max_bytes`. Returns (files, bytes) removed.
+        """
+        self.ingest()
+        excess = self.total_size() - max_bytes
+        if excess <= 0:
+            return (0, 0)
+        victims = []
+        for path, size in self.db.execute(
+                'SELECT path, size FROM files ORDER BY %s' % POLICIES[policy]):
+            if excess <= 0:
+                break
+            victims.append((path, size))
+            excess -= size
+        return self.delete(victims)
+
+    def purge_old_versions(self):
+        """
+        Delete every file belonging to a style which no longer exists, or to
+        an old version of a style. Returns (files, bytes) removed.
+        """
+        self.ingest()
+        registry = get_style_registry()
+        victims = []
+        for style, version in self.db.execute(
+                'SELECT DISTINCT style, version FROM files').fetchall():
+            # Size variants of a style are looked up through the registry
+            config = registry.get(style)
+            if config is None or config.version != version:
+                victims.extend(self.db.execute(
+                    'SELECT path, size FROM files WHERE style = ? AND'
+                    ' version = ?', (style, version)).fetchall())
+        return self.delete(victims)
+
+    def delete(self, victims):
+        removed = 0
+        with self.db:
+            for path, size in victims:
+                try:
+                    os.unlink(os.path.join(self.cache_dir, path))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+                removed += size
+        return (len(victims), removed)
@@ -0,0 +1,105 @@
+import time
+from hashlib import md5
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponseNotFound
+
+from agilethumbs.base import ImageProcessorError
+from agilethumbs.backends import content_type
+
+
+# Errors which mean the source is missing or can't be processed: IOError
+# covers both missing files and images PIL can't read
+FAILURE_EXCEPTIONS = (IOError, ImageProcessorError, ObjectDoesNotExist,
+                      Http404)
+
+
+@contextmanager
+def source_failures():
+    """
+    Mark any of FAILURE_EXCEPTIONS raised within the block as a failure of
+    the source, rather than of storing the output, which is what
+    is_source_failure checks for
+    """
+    try:
+        yield
+    except FAILURE_EXCEPTIONS as e:
+        e.source_failed = True
+        raise
+
+
+def is_source_failure(error):
+    """
+    Return True if the error came from fetching or processing a source, and
+    so is worth remembering with record_failure
+    """
+    return getattr(error, 'source_failed', False)
+
+
+def get_failure_ttl():
+    return getattr(settings, 'AGILETHUMBS_FAILURE_TTL', 60)
+
+
+def get_failure_cache():
+    return get_cache(getattr(settings, 'AGILETHUMBS_FAILURE_CACHE',
+                             'default'))
+
+
+def failure_key(name):
+    # Cache paths can be longer than memcached allows for keys
+    return 'agilethumbs-failed:%s' % md5(name.encode('utf8')).hexdigest()
+
+
+def cleared_key(file_id):
+    return 'agilethumbs-cleared:%s' % md5(file_id.encode('utf8')).hexdigest()
+
+
+def has_failed(name, file_id):
+    """
+    Return True if generating the cached file `name`, for the given (escaped)
+    file ID, failed within the last AGILETHUMBS_FAILURE_TTL seconds and its
+    failures haven't been cleared since
+    """
+    if not get_failure_ttl():
+        return False
+    keys = [failure_key(name), cleared_key(file_id)]
+    values = get_failure_cache().get_many(keys)
+    failed, cleared = values.get(keys[0]), values.get(keys[1])
+    return failed is not None and (cleared is None or failed > cleared)
+
+
+def record_failure(name):
+    ttl = get_failure_ttl()
+    if ttl:
+        get_failure_cache().set(failure_key(name), time.time(), ttl)
+
+
+def clear_failures(file_id):
+    """
+    Forget any failures for the given (escaped) file ID, e.g. because the
+    source has been replaced
+
+    Rather than deleting each failure, which would mean knowing every style
+    and size variant it might have been requested in, this notes when the
+    file's failures were cleared, and older ones are then ignored.
+    """
+    ttl = get_failure_ttl()
+    if ttl:
+        get_failure_cache().set(cleared_key(file_id), time.time(), ttl)
+
+
+def failure_response():
+    """
+    Return a 404 response, with the image in AGILETHUMBS_FAILURE_PLACEHOLDER
+    as its body if that is set
+    """
+    placeholder = getattr(settings, 'AGILETHUMBS_FAILURE_PLACEHOLDER', None)
+    if placeholder is None:
+        return HttpResponseNotFound('Image not available',
+                                    content_type='text/plain')
+    with open(placeholder, 'rb') as f:
+        return HttpResponseNotFound(f.read(),
+                                    content_type=content_type(placeholder))
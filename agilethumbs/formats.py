@@ -0,0 +1,86 @@
+from django.conf import settings
+
+
+# Styles with this extension are served in the best format each client
+# accepts
+AUTO_EXTENSION = 'auto'
+
+MIME_TYPES = {
+    'avif': 'image/avif',
+    'webp': 'image/webp',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+}
+
+
+def get_auto_formats():
+    """
+    Return the extensions to offer clients for 'auto' styles, best first
+    """
+    return getattr(settings, 'AGILETHUMBS_AUTO_FORMATS', ('avif', 'webp'))
+
+
+def get_auto_fallback():
+    """
+    Return the extension to use for 'auto' styles when the client accepts
+    none of the AGILETHUMBS_AUTO_FORMATS
+    """
+    return getattr(settings, 'AGILETHUMBS_AUTO_FALLBACK', 'jpg')
+
+
+def can_encode(processor, extension):
+    """
+    Return True if the processor says it can write the given format.
+    Processors without a `can_encode` function are only used for the
+    fallback format.
+    """
+    check = getattr(processor, 'can_encode', None)
+    return check is not None and check(extension)
+
+
+def variant_extensions(processor):
+    """
+    Return every extension an 'auto' style using the processor may be
+    served in
+    """
+    return [extension for extension in get_auto_formats()
+            if can_encode(processor, extension)] + [get_auto_fallback()]
+
+
+def negotiate(processor, accept):
+    """
+    Return the best extension for an 'auto' style using the processor, given
+    the client's Accept header
+    """
+    accepted = parse_accept(accept)
+    for extension in get_auto_formats():
+        # Only formats the client asks for by name count, as browsers send
+        # */* regardless of what they can display
+        if (accepted.get(MIME_TYPES.get(extension), 0) > 0 and
+                can_encode(processor, extension)):
+            return extension
+    return get_auto_fallback()
+
+
+def parse_accept(accept):
+    """
+    Return a dict mapping the media types in an Accept header to their
+    quality values
+    """
+    accepted = {}
+    for item in accept.split(','):
+        parts = item.split(';')
+        media_type = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            accepted[media_type] = quality
+    return accepted
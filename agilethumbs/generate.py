@@ -0,0 +1,236 @@
+import os
+from StringIO import StringIO
+
+from django.conf import settings
+from django.http import Http404
+from django.core.urlresolvers import get_callable
+from django.utils._os import safe_join
+
+from agilethumbs.base import (unescape, id_to_object, sign_params,
+    get_style_registry, cache_path)
+from agilethumbs.concurrency import (single_flight, coalesce,
+    processing_slot, try_lock, break_lock, ensure_dir, LOCK_SUFFIX)
+from agilethumbs.backends import get_cache_backend
+from agilethumbs import metrics
+from agilethumbs.limits import render, check_source_bytes, file_size
+from agilethumbs.metadata import processing_source, file_mtime
+from agilethumbs.failures import source_failures
+
+
+class SignatureMismatchError(Exception):
+    pass
+
+
+def create_cached_file(name, file_id, processor, processor_kwargs,
+                       extension, throttle=True):
+    """
+    Run the image processor on the file with the given (escaped) ID and
+    store the result in the cache backend under `name`
+
+    Returns False without doing anything if the file exists by the time any
+    concurrent generation of it in another process has finished. Threads in
+    this process asking for the same file share a single call, and its
+    result or exception. Unless `throttle` is False, processing waits for a
+    slot under AGILETHUMBS_PROCESSING_LIMIT and may raise ServerBusy.
+    """
+    return coalesce(name, create_once, name, file_id, processor,
+                    processor_kwargs, extension, throttle)
+
+
+def create_once(name, file_id, processor, processor_kwargs, extension,
+                throttle):
+    backend = get_cache_backend()
+    exists = lambda: backend.exists(name)
+    # Create file, unless another request created it while we waited
+    with single_flight(backend.lock_filename(name), exists=exists):
+        if exists():
+            return False
+        with processing_slot(None if throttle else 0), \
+                backend.create([name]) as outfiles:
+            object_id = unescape(file_id)
+            output = StringIO()
+            with source_failures():
+                with metrics.timer('fetch'):
+                    fileobj = get_id_to_object()(object_id)
+                count_input(fileobj)
+                try:
+                    with metrics.timer('process'), \
+                            processing_source(object_id, fileobj):
+                        render(processor, None, fileobj,
+                               [(output, extension, processor_kwargs)])
+                finally:
+                    close(fileobj)
+            copy_outputs([output], outfiles)
+            count_output(outfiles)
+    return True
+
+
+def generate_styles(file_id, style_names, throttle=True):
+    """
+    Generate every missing cached file for the given (escaped) file ID in the
+    given styles, reading the source only once
+
+    Styles whose processors can render several outputs at once (see
+    processor_pil.render_many) also share a single decode of the source.
+    Styles which are already being generated elsewhere are skipped. Returns
+    the names of the styles generated. Throttled as for create_cached_file.
+    """
+    registry = get_style_registry()
+    backend = get_cache_backend()
+    locks = []
+    try:
+        pending = []
+        for style_name in style_names:
+            style = registry[style_name]
+            for extension, name in style.cache_names(file_id):
+                if backend.exists(name):
+                    continue
+                lock_name = backend.lock_filename(name) + LOCK_SUFFIX
+                ensure_dir(os.path.dirname(lock_name))
+                if try_lock(lock_name):
+                    locks.append(lock_name)
+                    # Check again now we hold the lock
+                    if not backend.exists(name):
+                        pending.append((style, name, str(extension)))
+        if pending:
+            with processing_slot(None if throttle else 0):
+                with source_failures():
+                    source = read_source(file_id)
+                with processing_source(unescape(file_id), source):
+                    render_styles(backend, source, pending)
+    finally:
+        for lock_name in locks:
+            break_lock(lock_name)
+    created = []
+    for style, name, extension in pending:
+        if style.name not in created:
+            created.append(style.name)
+    return created
+
+
+def render_styles(backend, source, pending):
+    # Group together styles whose processors can share a decode
+    groups = []
+    for item in pending:
+        render_many = getattr(item[0].processor, 'render_many', None)
+        for group in groups:
+            if render_many is not None and group[0] is render_many:
+                group[1].append(item)
+                break
+        else:
+            groups.append((render_many, [item]))
+    for render_many, items in groups:
+        with backend.create([name for (style, name, extension) in items]) \
+                as outfiles:
+            source.seek(0)
+            outputs = [StringIO() for item in items]
+            with source_failures(), metrics.timer('process'):
+                render(items[0][0].processor, render_many, source, [
+                    (output, extension, style.kwargs)
+                    for ((style, name, extension), output)
+                    in zip(items, outputs)])
+            copy_outputs(outputs, outfiles)
+            count_output(outfiles)
+
+
+def copy_outputs(outputs, outfiles):
+    # Processors render into memory, so that errors storing the results
+    # (such as a full disk) aren't mistaken for failures of the source
+    for output, outfile in zip(outputs, outfiles):
+        outfile.write(output.getvalue())
+
+
+def count_input(fileobj):
+    # Processors may read the source lazily, so go by its size
+    if metrics.get_metrics() is None:
+        return
+    size = file_size(fileobj)
+    if size is not None:
+        metrics.incr('bytes_in', size)
+
+
+def count_output(outfiles):
+    if metrics.get_metrics() is None:
+        return
+    for outfile in outfiles:
+        try:
+            metrics.incr('bytes_out', outfile.tell())
+        except (AttributeError, IOError, ValueError):
+            pass
+
+
+def read_source(file_id):
+    """
+    Return an in-memory copy of the source for the given (escaped) file ID
+    """
+    with metrics.timer('fetch'):
+        fileobj = get_id_to_object()(unescape(file_id))
+        try:
+            # Refuse oversized sources before they are read into memory
+            check_source_bytes(fileobj)
+            source = StringIO(fileobj.read())
+            source.mtime = file_mtime(fileobj)
+        finally:
+            close(fileobj)
+    metrics.incr('bytes_in', source.len)
+    # Keep the name, which processors may use as a hint to the format
+    name = getattr(fileobj, 'name', None)
+    if name is not None:
+        source.name = name
+    return source
+
+
+def get_sibling_styles(style):
+    """
+    Return the group of styles in AGILETHUMBS_SIBLING_STYLES which should be
+    generated along with the given style, if any
+    """
+    for group in getattr(settings, 'AGILETHUMBS_SIBLING_STYLES', ()):
+        if style in group:
+            return group
+    return None
+
+
+def get_id_to_object():
+    # Allow override of id_to_object function in settings
+    return get_callable(getattr(
+        settings, 'AGILETHUMBS_ID_TO_OBJECT', id_to_object))
+
+
+def close(fileobj):
+    if hasattr(fileobj, 'close') and callable(fileobj.close):
+        fileobj.close()
+
+
+def get_cache_filename(file_id, style, version, signature, extension,
+                       layout=None):
+    """
+    Return path to cached file for supplied request parameters, when using
+    the default FileSystemCache backend
+    """
+    return safe_join(settings.AGILETHUMBS_CACHE_DIR, cache_path(
+        file_id, style, version, signature, extension, layout))
+
+
+def get_image_processor(file_id, style, version, signature, extension):
+    """
+    Validate supplied request parameters and return the relevant image
+    processor function, keyword arguments and extension
+
+    Raises SignatureMismatchError for invalid signatures or Http404 for valid
+    requests which reference outdated style versions.
+    """
+    # Check the signature
+    if signature != sign_params(file_id, style, version, extension):
+        raise SignatureMismatchError()
+    # Get and check the style details: the valid signature ensures that the
+    # details were correct at time of URL generation, but not that they
+    # haven't changed since
+    style_config = get_style_registry().get(style)
+    if style_config is None or version != style_config.version:
+        raise Http404()
+    image_processor = style_config.processor
+    processor_kwargs = style_config.kwargs
+    # Extension should be an str, not unicode, for PIL's sake
+    extension = extension.encode('ascii')
+    return (image_processor, processor_kwargs, extension)
@@ -0,0 +1,61 @@
+"""
+Size calculations shared by the processors, which need no image library
+"""
+from __future__ import division
+from math import ceil
+
+
+RESIZE_OPTIONS = ('fit', 'fill', 'pad', 'squash')
+
+
+def fit_size(size, box):
+    """
+    Return the size that Image.thumbnail would scale an image of the given
+    size to, so that the result doesn't depend on the scale it was decoded at
+    """
+    x, y = size
+    if x > box[0]:
+        y = int(max(y * box[0] / x, 1))
+        x = box[0]
+    if y > box[1]:
+        x = int(max(x * box[1] / y, 1))
+        y = box[1]
+    return x, y
+
+
+def required_size(size, width, height, resize):
+    """
+    Return the smallest source size from which the requested output can be
+    produced without upscaling
+    """
+    if resize == 'squash' and width and height:
+        return (width, height)
+    scales = []
+    if width:
+        scales.append(width / size[0])
+    if height:
+        scales.append(height / size[1])
+    if not scales:
+        return size
+    scale = max(scales) if resize == 'fill' else min(scales)
+    return (int(ceil(size[0] * scale)), int(ceil(size[1] * scale)))
+
+
+def output_size(size, width=None, height=None, resize='fit'):
+    """
+    Return the size of the image that resizing a source of the given size
+    produces, or None for an unknown resize option
+    """
+    width = width or None
+    height = height or None
+    if resize == 'fit':
+        if width is None and height is None:
+            return size
+        if width is None:
+            width = int(round(size[0] * height / size[1]))
+        elif height is None:
+            height = int(round(size[1] * width / size[0]))
+        return fit_size(size, (width, height))
+    if resize in RESIZE_OPTIONS:
+        return (width, height)
+    return None
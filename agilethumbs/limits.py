@@ -0,0 +1,124 @@
+import os
+import resource
+from StringIO import StringIO
+from functools import partial
+
+from django.conf import settings
+
+from agilethumbs.base import ImageProcessorError
+from agilethumbs.pool import get_pool
+from agilethumbs.metadata import current_source, processing_source, file_mtime
+
+
+def check_source_bytes(fileobj):
+    """
+    Raise ImageProcessorError if the source is larger than
+    AGILETHUMBS_MAX_SOURCE_BYTES
+    """
+    max_bytes = getattr(settings, 'AGILETHUMBS_MAX_SOURCE_BYTES', None)
+    if not max_bytes:
+        return
+    size = file_size(fileobj)
+    if size is not None and size > max_bytes:
+        raise ImageProcessorError('Source is %d bytes, more than the limit '
+                                  'of %d' % (size, max_bytes))
+
+
+def check_pixels(size):
+    """
+    Raise ImageProcessorError if an image of the given size, as read from
+    its header, has more than AGILETHUMBS_MAX_PIXELS pixels
+    """
+    max_pixels = getattr(settings, 'AGILETHUMBS_MAX_PIXELS', None)
+    if max_pixels and size[0] * size[1] > max_pixels:
+        raise ImageProcessorError('Source is %dx%d pixels, more than the '
+                                  'limit of %d' % (size[0], size[1],
+                                                   max_pixels))
+
+
+def file_size(fileobj):
+    for obj in (fileobj, getattr(fileobj, 'file', None)):
+        try:
+            return os.fstat(obj.fileno()).st_size
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    # In-memory files
+    if isinstance(getattr(fileobj, 'len', None), int):
+        return fileobj.len
+    return getattr(fileobj, 'size', None)
+
+
+def render(processor, render_many, infile, jobs):
+    """
+    Run `render_many`, if given, or else `processor` for each of the jobs
+    (outfile, extension, kwargs) on `infile`
+
+    With AGILETHUMBS_SANDBOX_WORKERS set, this happens in a pool of worker
+    processes limited to AGILETHUMBS_SANDBOX_MEMORY bytes of address space
+    and AGILETHUMBS_SANDBOX_CPU seconds of CPU time per job, so that a
+    hostile image takes down a disposable worker rather than the
+    application. Processors then need to be importable functions.
+    """
+    workers = getattr(settings, 'AGILETHUMBS_SANDBOX_WORKERS', 0)
+    if not workers:
+        return render_here(processor, render_many, infile, jobs)
+    # The source is read into memory to send to the worker
+    check_source_bytes(infile)
+    pool = get_pool(__name__, workers,
+        getattr(settings, 'AGILETHUMBS_SANDBOX_MAX_JOBS', 100),
+        partial(limit_memory,
+                getattr(settings, 'AGILETHUMBS_SANDBOX_MEMORY', None)))
+    # Let the worker record the source's metadata
+    source = current_source()
+    if source is not None:
+        source = (source[0], file_mtime(source[1]))
+    outputs = pool.apply(render_sandboxed, processor, render_many,
+        infile.read(), getattr(infile, 'name', None),
+        [(extension, kwargs) for (outfile, extension, kwargs) in jobs],
+        getattr(settings, 'AGILETHUMBS_SANDBOX_CPU', None), source)
+    for (outfile, extension, kwargs), output in zip(jobs, outputs):
+        outfile.write(output)
+
+
+def render_here(processor, render_many, infile, jobs):
+    if render_many is not None:
+        render_many(infile, jobs)
+    else:
+        for outfile, extension, kwargs in jobs:
+            processor(infile, outfile, extension, **kwargs)
+
+
+def limit_memory(max_bytes):
+    # Runs in each new sandbox worker
+    if max_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+def render_sandboxed(processor, render_many, data, name, jobs, cpu_seconds,
+                     source=None):
+    # Runs in a sandbox worker. CPU time is counted over the life of the
+    # process, so the limit is moved on for each job.
+    if cpu_seconds:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        limit = int(usage.ru_utime + usage.ru_stime) + cpu_seconds
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    infile = StringIO(data)
+    if name is not None:
+        infile.name = name
+    outfiles = [StringIO() for job in jobs]
+    jobs = [(outfile, extension, kwargs)
+            for (outfile, (extension, kwargs)) in zip(outfiles, jobs)]
+    try:
+        if source is None:
+            render_here(processor, render_many, infile, jobs)
+        else:
+            object_id, infile.mtime = source
+            with processing_source(object_id, infile):
+                render_here(processor, render_many, infile, jobs)
+    except MemoryError:
+        raise ImageProcessorError('Image processing exceeded the memory '
+                                  'limit')
+    return [outfile.getvalue() for outfile in outfiles]
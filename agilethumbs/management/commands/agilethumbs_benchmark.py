@@ -0,0 +1,65 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from agilethumbs import benchmark
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the image processors, URL generation and serving of "
+            "cached and uncached images, using synthetic images")
+    option_list = BaseCommand.option_list + (
+        make_option('--group', action='append', dest='groups',
+            choices=benchmark.GROUPS,
+            help='Only run this group of benchmarks (%s); may be given '
+                 'more than once' % ', '.join(benchmark.GROUPS)),
+        make_option('--quick', action='store_true', dest='quick',
+            default=False,
+            help='Use smaller images and fewer iterations'),
+        make_option('--repeat', type='int', dest='repeat',
+            help='Number of iterations for each processor and request '
+                 'benchmark'),
+        make_option('--output', dest='output', metavar='FILE',
+            help='Write the results to FILE as JSON'),
+        make_option('--compare', dest='compare', metavar='FILE',
+            help='Compare the results with those saved in FILE'),
+    )
+
+    def handle(self, **options):
+        previous = None
+        if options.get('compare'):
+            try:
+                with open(options['compare']) as f:
+                    previous = json.load(f)
+            except (IOError, ValueError) as e:
+                raise CommandError("Couldn't read %s: %s"
+                                   % (options['compare'], e))
+        self.verbosity = int(options.get('verbosity', 1))
+        results = benchmark.run(groups=options.get('groups') or
+                                    benchmark.GROUPS,
+                                quick=options.get('quick', False),
+                                repeat=options.get('repeat'),
+                                callback=self.report)
+        if options.get('output'):
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if previous is not None:
+            for name, old, new, ratio in benchmark.compare(previous,
+                                                           results):
+                self.stdout.write('%-60s %10.1f/s -> %10.1f/s  %+.0f%%\n'
+                                  % (name, old, new, (ratio - 1) * 100))
+
+    def report(self, result):
+        if self.verbosity < 1:
+            return
+        if 'skipped' in result:
+            self.stdout.write('%-60s skipped: %s\n' % (result['name'],
+                                                       result['skipped']))
+            return
+        line = '%-60s %10.1f/s' % (result['name'], result['per_second'])
+        if result.get('peak_rss_kb') is not None:
+            line += '  peak +%d KB' % result['peak_rss_kb']
+        if result.get('child_peak_rss_kb') is not None:
+            line += '  convert peak %d KB' % result['child_peak_rss_kb']
+        self.stdout.write(line + '\n')
@@ -0,0 +1,78 @@
+import re
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from agilethumbs.eviction import CacheIndex, get_index_path, POLICIES
+
+
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size(value):
+    match = re.match(r'^(\d+)\s*([kmgt]?)b?$', value.strip().lower())
+    if not match:
+        raise CommandError('Invalid size: %s' % value)
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+
+class Command(BaseCommand):
+    help = ("Delete cached images to keep the cache directory within "
+            "AGILETHUMBS_CACHE_MAX_BYTES, and images for old style versions")
+    option_list = BaseCommand.option_list + (
+        make_option('--max-bytes', dest='max_bytes',
+            help='Size budget for the cache, e.g. 500M or 20G (default: '
+                 'AGILETHUMBS_CACHE_MAX_BYTES)'),
+        make_option('--policy', dest='policy', default='lru',
+            choices=sorted(POLICIES.keys()),
+            help='Evict least recently (lru) or least frequently (lfu) '
+                 'used images first (default: lru)'),
+        make_option('--purge-old-versions', action='store_true',
+            dest='purge', default=False,
+            help='Also delete all images for old style versions and '
+                 'removed styles'),
+        make_option('--scan', action='store_true', dest='scan',
+            default=False,
+            help='Rebuild the index by scanning the cache directory first '
+                 '(only needed when tracking is first enabled)'),
+        make_option('--loop', type='int', dest='loop', default=0,
+            metavar='SECONDS',
+            help='Keep running, sweeping the cache every SECONDS'),
+    )
+
+    def handle(self, **options):
+        if get_index_path() is None:
+            raise CommandError('Set AGILETHUMBS_CACHE_INDEX to enable cache '
+                               'tracking')
+        max_bytes = options.get('max_bytes')
+        if max_bytes is not None:
+            max_bytes = parse_size(max_bytes)
+        else:
+            max_bytes = getattr(settings, 'AGILETHUMBS_CACHE_MAX_BYTES', None)
+        if max_bytes is None and not options.get('purge'):
+            raise CommandError('Specify --max-bytes, set '
+                               'AGILETHUMBS_CACHE_MAX_BYTES or use '
+                               '--purge-old-versions')
+        self.verbosity = int(options.get('verbosity', 1))
+        index = CacheIndex()
+        try:
+            if options.get('scan'):
+                index.scan()
+            while True:
+                if options.get('purge'):
+                    self.report('old versions', index.purge_old_versions())
+                if max_bytes is not None:
+                    self.report('over budget', index.evict(
+                        max_bytes, options.get('policy', 'lru')))
+                if not options.get('loop'):
+                    break
+                time.sleep(options['loop'])
+        finally:
+            index.close()
+
+    def report(self, reason, result):
+        files, size = result
+        if self.verbosity >= 1 and (files or self.verbosity >= 2):
+            self.stdout.write('Deleted %d files (%d bytes): %s\n'
+                              % (files, size, reason))
@@ -0,0 +1,76 @@
+import os
+import errno
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from agilethumbs.base import cache_path, parse_cache_filename
+from agilethumbs.concurrency import ensure_dir
+from agilethumbs.eviction import CacheIndex, get_index_path
+
+
+LAYOUTS = ('flat', 'sharded')
+
+
+class Command(BaseCommand):
+    help = ("Move the files in AGILETHUMBS_CACHE_DIR into a different "
+            "directory layout. Set AGILETHUMBS_CACHE_LAYOUT to the new "
+            "layout at the same time; anything requested in between is "
+            "simply generated again.")
+    option_list = BaseCommand.option_list + (
+        make_option('--to', dest='to', choices=LAYOUTS,
+            help='Layout to move to: flat or sharded'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help="Report what would be moved without moving anything"),
+    )
+
+    def handle(self, **options):
+        to = options.get('to')
+        if to is None:
+            raise CommandError('Specify the layout to move to with --to')
+        source = [layout for layout in LAYOUTS if layout != to][0]
+        dry_run = options.get('dry_run')
+        verbosity = int(options.get('verbosity', 1))
+        cache_dir = settings.AGILETHUMBS_CACHE_DIR
+        # Work out every move before making any, so that files which have
+        # already been moved aren't found again
+        moves = []
+        for directory, dirnames, filenames in os.walk(cache_dir):
+            for name in filenames:
+                filename = os.path.join(directory, name)
+                path = os.path.relpath(filename, cache_dir)
+                params = parse_cache_filename(path, source)
+                if params is not None:
+                    moves.append((filename, os.path.join(
+                        cache_dir, cache_path(layout=to, **params))))
+        for filename, target in moves:
+            if verbosity >= 2:
+                self.stdout.write('%s -> %s\n' % (filename, target))
+            if not dry_run:
+                ensure_dir(os.path.dirname(target))
+                os.rename(filename, target)
+        moved = len(moves)
+        if not dry_run:
+            remove_empty_dirs(cache_dir)
+            # Paths in the index are now out of date
+            if get_index_path() is not None:
+                index = CacheIndex(layout=to)
+                try:
+                    index.scan()
+                finally:
+                    index.close()
+        if verbosity >= 1:
+            self.stdout.write('%s %d files to the %s layout\n' % (
+                'Would move' if dry_run else 'Moved', moved, to))
+
+
+def remove_empty_dirs(root):
+    for directory, dirnames, filenames in os.walk(root, topdown=False):
+        if directory != root:
+            try:
+                os.rmdir(directory)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
@@ -0,0 +1,83 @@
+import sys
+import time
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.db.models import get_model
+
+from agilethumbs.warm import warm, iter_storage_ids, iter_model_ids
+
+
+class Command(BaseCommand):
+    args = '<style style ...>'
+    help = ("Generate any missing cached images in the given styles, "
+            "e.g. before a deploy or after bumping a style version")
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model',
+            help='Take images from every instance of this model, given as '
+                 'app_label.ModelName (requires --field)'),
+        make_option('--field', dest='field',
+            help='Name of the file field to use with --model'),
+        make_option('--dir', dest='dir',
+            help='Take images from every file under this directory in '
+                 'the default storage'),
+        make_option('--stdin', action='store_true', dest='stdin',
+            default=False,
+            help='Read file IDs from standard input, one per line'),
+        make_option('--processes', type='int', dest='processes',
+            default=multiprocessing.cpu_count(),
+            help='Number of images to generate in parallel (default: one '
+                 'per CPU)'),
+    )
+
+    def handle(self, *styles, **options):
+        if not styles:
+            raise CommandError('Specify at least one image style')
+        self.verbosity = int(options.get('verbosity', 1))
+        object_ids = self.get_object_ids(options)
+        self.start = self.last_report = time.time()
+        self.done = 0
+        try:
+            counts = warm(object_ids, styles, options['processes'],
+                          callback=self.progress)
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        elapsed = time.time() - self.start
+        if self.verbosity >= 1:
+            self.stdout.write(
+                '%(created)d created, %(exists)d already cached, '
+                '%(error)d errors' % counts
+                + ' in %.1fs (%.1f images/s)\n' % (
+                    elapsed, counts['created'] / max(elapsed, 0.001)))
+
+    def get_object_ids(self, options):
+        model_name, field = options.get('model'), options.get('field')
+        if model_name:
+            if not field:
+                raise CommandError('--model requires --field')
+            model = get_model(*model_name.split('.', 1))
+            if model is None:
+                raise CommandError('Unknown model: %s' % model_name)
+            return iter_model_ids(model, field)
+        elif options.get('dir') is not None:
+            return iter_storage_ids(default_storage, options.get('dir'))
+        elif options.get('stdin'):
+            return (line.strip().decode('utf8') for line in sys.stdin
+                    if line.strip())
+        raise CommandError('Specify a source of images with --model, '
+                           '--dir or --stdin')
+
+    def progress(self, status, params, message):
+        self.done += 1
+        if status == 'error' and self.verbosity >= 1:
+            self.stderr.write('Error generating %(file_id)s in style '
+                              '%(style)s' % params + ': %s\n' % message)
+        now = time.time()
+        if self.verbosity >= 2 or (self.verbosity >= 1 and
+                                   now - self.last_report >= 5):
+            self.last_report = now
+            self.stdout.write('%d images checked (%.1f/s)\n' % (
+                self.done, self.done / max(now - self.start, 0.001)))
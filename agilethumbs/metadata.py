@@ -0,0 +1,159 @@
+import os
+import threading
+from hashlib import md5
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+from agilethumbs.base import get_style_registry
+from agilethumbs.geometry import output_size, RESIZE_OPTIONS
+
+
+# Cache metadata for 30 days unless configured otherwise: sources rarely
+# change, and replacing one should clear its entry
+DEFAULT_TIMEOUT = 60 * 60 * 24 * 30
+
+_current = threading.local()
+
+
+def get_metadata_cache():
+    return get_cache(getattr(settings, 'AGILETHUMBS_METADATA_CACHE',
+                             'default'))
+
+
+def metadata_key(object_id):
+    return 'agilethumbs-meta:%s' % md5(object_id.encode('utf8')).hexdigest()
+
+
+def source_metadata(fileobj, fetch=False):
+    """
+    Return a dict with the 'width', 'height', 'format' and 'mtime' of a
+    source image, as recorded when it was last processed, or None if it
+    hasn't been
+
+    With `fetch`, unknown sources are opened to read their header instead.
+    """
+    object_id = get_style_registry().object_to_id(fileobj)
+    metadata = get_metadata_cache().get(metadata_key(object_id))
+    if metadata is None and fetch:
+        metadata = fetch_metadata(object_id)
+    return metadata
+
+
+def image_dimensions(fileobj, style='default'):
+    """
+    Return a dict with the 'width' and 'height' of the image `style`
+    produces for a source, predicted from its cached metadata without any
+    image I/O, or None if the source's size isn't known yet or the style's
+    output can't be predicted
+    """
+    metadata = source_metadata(fileobj)
+    if metadata is None:
+        return None
+    size = predict_size((metadata['width'], metadata['height']),
+                        get_style_registry()[style].kwargs)
+    if size is None:
+        return None
+    return {'width': size[0], 'height': size[1]}
+
+
+def predict_size(size, kwargs):
+    """
+    Return the output size for a source of the given size and a style's
+    processor arguments, or None if it can't be predicted
+    """
+    if 'operations' not in kwargs:
+        if not ('width' in kwargs or 'height' in kwargs):
+            return size
+        return output_size(size, kwargs.get('width'), kwargs.get('height'),
+                           kwargs.get('resize', 'fit'))
+    for op in kwargs['operations']:
+        name, op_kwargs = (op if isinstance(op, (list, tuple))
+                           else (op, {}))
+        if name in RESIZE_OPTIONS:
+            size = output_size(size, op_kwargs.get('width'),
+                               op_kwargs.get('height'), name)
+        elif name not in ('sharpen', 'blur', 'grayscale', 'watermark'):
+            # Custom operations could do anything
+            return None
+    return size
+
+
+def set_source_metadata(object_id, width, height, format=None, mtime=None):
+    metadata = {
+        'width': width,
+        'height': height,
+        'format': format,
+        'mtime': mtime,
+    }
+    get_metadata_cache().set(metadata_key(object_id), metadata,
+        getattr(settings, 'AGILETHUMBS_METADATA_TIMEOUT', DEFAULT_TIMEOUT))
+    return metadata
+
+
+def clear_source_metadata(object_id):
+    get_metadata_cache().delete(metadata_key(object_id))
+
+
+@contextmanager
+def processing_source(object_id, fileobj):
+    """
+    Note which source is being processed in this thread, so that processors
+    can record its metadata with record_source()
+    """
+    _current.source = (object_id, fileobj)
+    try:
+        yield
+    finally:
+        _current.source = None
+
+
+def current_source():
+    """
+    Return the (object ID, file) being processed in this thread, if any
+    """
+    return getattr(_current, 'source', None)
+
+
+def record_source(size, format):
+    """
+    Called by processors with the size and format of the source they have
+    just opened
+    """
+    source = current_source()
+    if source is None:
+        return
+    # Only record each source once per processing run
+    _current.source = None
+    object_id, fileobj = source
+    set_source_metadata(object_id, size[0], size[1], format,
+                        file_mtime(fileobj))
+
+
+def file_mtime(fileobj):
+    # In-memory copies of sources carry the original's mtime
+    mtime = getattr(fileobj, 'mtime', None)
+    if mtime is not None:
+        return mtime
+    for obj in (fileobj, getattr(fileobj, 'file', None)):
+        try:
+            return os.fstat(obj.fileno()).st_mtime
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+    return None
+
+
+def fetch_metadata(object_id):
+    from agilethumbs.generate import get_id_to_object, close
+    from agilethumbs.processor_pil import Image
+    fileobj = get_id_to_object()(object_id)
+    try:
+        # Only the header is read
+        im = Image.open(fileobj)
+        return set_source_metadata(object_id, im.size[0], im.size[1],
+                                   im.format, file_mtime(fileobj))
+    except IOError:
+        return None
+    finally:
+        close(fileobj)
@@ -0,0 +1,144 @@
+import time
+import socket
+import threading
+
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+
+
+class Timer(object):
+    """
+    Reports the time taken between start() and stop(), in milliseconds, as
+    the timing `name`. Also works as a context manager, which only reports
+    the time if the block succeeds.
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        if self.started is not None:
+            self.metrics.timing(self.name,
+                                (time.time() - self.started) * 1000)
+            self.started = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.stop()
+
+
+class NullTimer(object):
+
+    def start(self):
+        return self
+
+    def stop(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+_metrics = (None, None)
+
+def get_metrics():
+    """
+    Return the metrics client configured by AGILETHUMBS_METRICS (either an
+    object with timing() and incr() methods, or the dotted path of a class
+    to construct with the keyword arguments in AGILETHUMBS_METRICS_OPTIONS),
+    or None if metrics are disabled
+    """
+    global _metrics
+    config = getattr(settings, 'AGILETHUMBS_METRICS', None)
+    if config is None:
+        return None
+    if _metrics[0] is not config:
+        if isinstance(config, basestring):
+            client = get_callable(config)(
+                **getattr(settings, 'AGILETHUMBS_METRICS_OPTIONS', {}))
+        else:
+            client = config
+        _metrics = (config, client)
+    return _metrics[1]
+
+
+def timer(name):
+    metrics = get_metrics()
+    if metrics is None:
+        return NULL_TIMER
+    return Timer(metrics, name)
+
+
+def timing(name, ms):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.timing(name, ms)
+
+
+def incr(name, count=1):
+    metrics = get_metrics()
+    if metrics is not None:
+        metrics.incr(name, count)
+
+
+class MemoryCollector(object):
+    """
+    Keeps every metric reported to it, for tests and debugging
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def timing(self, name, ms):
+        with self.lock:
+            self.timings.setdefault(name, []).append(ms)
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def clear(self):
+        with self.lock:
+            self.timings = {}
+            self.counters = {}
+
+
+class StatsdClient(object):
+    """
+    Sends metrics to a statsd server over UDP
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='agilethumbs'):
+        self.address = (socket.gethostbyname(host), port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, ms):
+        self.send('%s:%d|ms' % (name, ms))
+
+    def incr(self, name, count=1):
+        self.send('%s:%d|c' % (name, count))
+
+    def send(self, data):
+        if self.prefix:
+            data = '%s.%s' % (self.prefix, data)
+        try:
+            self.socket.sendto(data.encode('utf8'), self.address)
+        except socket.error:
+            # Metrics must never break image requests
+            pass
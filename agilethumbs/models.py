@@ -1 +1,5 @@
 # Need models.py to convince Django this is an app
+
+from agilethumbs import eager
+
+eager.connect()
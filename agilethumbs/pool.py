@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import Queue
+import threading
+import subprocess
+import cPickle as pickle
+
+from agilethumbs.base import ImageProcessorError
+
+
+class WorkerPool(object):
+    """
+    A bounded set of long-lived worker processes which run functions on
+    behalf of the calling thread
+
+    Callers block until a worker is free. Workers are started on demand,
+    replaced after `max_jobs` jobs, and replaced if they die mid-job, in which
+    case the caller gets an ImageProcessorError. `initializer` is called in
+    each new worker before it accepts any jobs.
+    """
+
+    def __init__(self, size, max_jobs=None, initializer=None):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.initializer = initializer
+        self._idle = Queue.Queue()
+        # Each slot holds either a running Worker or None for one not yet
+        # started, so the queue bounds the number of workers
+        for i in range(size):
+            self._idle.put(None)
+
+    def apply(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in a worker and return the result. Both
+        the function and its arguments must be picklable.
+        """
+        worker = self._idle.get()
+        try:
+            if worker is None or not worker.is_alive():
+                worker = Worker(self.initializer)
+            result = worker.call(func, args, kwargs)
+            if self.max_jobs and worker.jobs >= self.max_jobs:
+                worker.stop()
+                worker = None
+            return result
+        except WorkerDied:
+            worker = None
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        for i in range(self.size):
+            worker = self._idle.get()
+            if worker is not None:
+                worker.stop()
+
+
+class WorkerDied(ImageProcessorError):
+    pass
+
+
+class Worker(object):
+    """
+    A worker process started from a fresh interpreter which only imports
+    what its jobs need, rather than forked from the (possibly large)
+    calling process. Jobs and results are pickled over its stdin and stdout.
+    """
+
+    def __init__(self, initializer=None):
+        self.jobs = 0
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', WORKER_SCRIPT], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, close_fds=True, env=worker_environ())
+        self.send(initializer)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def send(self, message):
+        # Pickled up front so that an unpicklable job can't leave half a
+        # message in the pipe
+        message = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        try:
+            self.process.stdin.write(message)
+            self.process.stdin.flush()
+        except IOError:
+            self.died()
+
+    def call(self, func, args, kwargs):
+        self.jobs += 1
+        self.send((func, args, kwargs))
+        try:
+            status, result = pickle.load(self.process.stdout)
+        except (EOFError, IOError, pickle.UnpicklingError):
+            self.died()
+        if status == 'error':
+            raise result
+        return result
+
+    def died(self):
+        self.kill()
+        raise WorkerDied('Worker process died (exit code %s)'
+                         % self.process.returncode)
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        for i in range(10):
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.1)
+        else:
+            self.kill()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        for pipe in (self.process.stdin, self.process.stdout):
+            try:
+                pipe.close()
+            except IOError:
+                pass
+
+
+WORKER_SCRIPT = 'from agilethumbs.pool import worker_main; worker_main()'
+
+def worker_environ():
+    # Workers need to import the same modules as their caller to unpickle
+    # jobs
+    path = [entry or os.getcwd() for entry in sys.path]
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+
+
+def worker_main():
+    # Keep the pipes to the pool to ourselves, so that anything else
+    # writing to stdout, or reading stdin, can't corrupt them
+    jobs = os.fdopen(os.dup(0), 'rb')
+    results = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    os.dup2(2, 1)
+    try:
+        initializer = pickle.load(jobs)
+    except EOFError:
+        return
+    if initializer is not None:
+        initializer()
+    while True:
+        try:
+            func, args, kwargs = pickle.load(jobs)
+        except (EOFError, KeyboardInterrupt):
+            break
+        try:
+            result = ('ok', func(*args, **kwargs))
+        except Exception as e:
+            result = ('error', e)
+        try:
+            result = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            result = pickle.dumps(('error', ImageProcessorError(
+                repr(result[1]))), pickle.HIGHEST_PROTOCOL)
+        results.write(result)
+        results.flush()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(name, size, max_jobs=None, initializer=None):
+    """
+    Return the named pool for this process, creating it if necessary. Pools
+    inherited from a parent process across a fork are not reused.
+    """
+    key = (name, os.getpid())
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = WorkerPool(size, max_jobs, initializer)
+    return pool
@@ -1,62 +1,341 @@
 import os
+import re
 import errno
 import subprocess
 
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+
 from agilethumbs import ImageProcessorError
+from agilethumbs.pool import get_pool
+from agilethumbs import metrics
+from agilethumbs.limits import check_source_bytes, check_pixels
+from agilethumbs.encoding import encoder_options
 
 CONVERT_PATH = 'convert'
 
+# Ask decoders for at least this multiple of the size actually needed, so
+# that the final resample has enough detail to work with
+REDUCING_GAP = 2
+
 
 def simple_resize(infile, outfile, extension,
                   width='', height='', resize='fit', background='transparent',
-                  quality=85):
-    args = []
-    # Scale image so it does not exceed specified dimensions
-    if resize == 'fit':
-        if width != '' or height != '':
-            args.extend([
-                '-thumbnail', '%sx%s' % (width, height),
-            ])
-    # Scale and crop image so it exactly fills specified dimensions 
-    elif resize == 'fill':
-        args.extend([
-            '-thumbnail', '%sx%s^' % (width, height),
-            '-gravity', 'center',
-            '-extent',  '%sx%s' % (width, height)
-        ])
-    # Scale image so it does not exceed specified dimensions and then pad with
-    # background color so it exactly fills specified dimensions
-    elif resize == 'pad':
-        args.extend([
-            '-thumbnail', '%sx%s' % (width, height),
-            '-background', background,
-            '-gravity', 'center',
-            '-extent',  '%sx%s' % (width, height)
-        ])
-    # Scale image to exact dimensions ignoring aspect ratio
-    elif resize == 'squash':
-        args.extend([
-            '-thumbnail', '%sx%s!' % (width, height)
-        ])
-    else:
+                  quality=85, encoder=None):
+    try:
+        resizer = RESIZERS[resize]
+    except KeyError:
         raise ImageProcessorError('Unknwon resize option: %s' % resize)
+    if resize == 'pad':
+        args = resizer(width, height, background)
+    else:
+        args = resizer(width, height)
     args.extend([
         '-colorspace', 'sRGB',
         '-quality', str(quality),
     ])
+    args.extend(encoder_args(extension, encoder))
     # Perform conversion
-    convert(infile, outfile, extension, args)
+    convert(infile, outfile, extension, args,
+            read_args=size_hint_args(width, height, resize))
+
+
+def pipeline(infile, outfile, extension, operations=(), quality=85,
+             encoder=None):
+    """
+    Apply a list of operations in a single run of convert. Operations are
+    given as for processor_pil.pipeline, except that functions return a list
+    of convert arguments rather than operating on an image.
+    """
+    operations = [(op, {}) if isinstance(op, basestring) or callable(op)
+                  else op for op in operations]
+    args = []
+    for name, kwargs in operations:
+        args.extend(get_operation(name)(**kwargs))
+    args.extend([
+        '-colorspace', 'sRGB',
+        '-quality', str(quality),
+    ])
+    args.extend(encoder_args(extension, encoder))
+    read_args = []
+    if operations and operations[0][0] in RESIZERS:
+        name, kwargs = operations[0]
+        read_args = size_hint_args(kwargs.get('width') or '',
+                                   kwargs.get('height') or '', name)
+    convert(infile, outfile, extension, args, read_args=read_args)
+
+
+def get_operation(name):
+    if callable(name):
+        return name
+    try:
+        operation = OPERATIONS.get(name) or get_callable(name)
+    except (ImportError, AttributeError):
+        operation = None
+    if not callable(operation):
+        raise ImageProcessorError('Unknown operation: %s' % name)
+    return operation
+
+
+# Pipeline operations, each returning a list of convert arguments
+
+def geometry(width, height, flag=''):
+    return '%sx%s%s' % ('' if width is None else width,
+                        '' if height is None else height, flag)
+
+
+def fit(width='', height=''):
+    """
+    Scale image so it does not exceed specified dimensions
+    """
+    if width in ('', None) and height in ('', None):
+        return []
+    return ['-thumbnail', geometry(width, height)]
+
+
+def fill(width, height):
+    """
+    Scale and crop image so it exactly fills specified dimensions
+    """
+    return [
+        '-thumbnail', geometry(width, height, '^'),
+        '-gravity', 'center',
+        '-extent',  geometry(width, height),
+    ]
+
+
+def pad(width, height, background='transparent'):
+    """
+    Scale image so it does not exceed specified dimensions and then pad with
+    background color so it exactly fills specified dimensions
+    """
+    return [
+        '-thumbnail', geometry(width, height),
+        '-background', background,
+        '-gravity', 'center',
+        '-extent',  geometry(width, height),
+    ]
+
+
+def squash(width, height):
+    """
+    Scale image to exact dimensions ignoring aspect ratio
+    """
+    return ['-thumbnail', geometry(width, height, '!')]
+
+
+def sharpen(radius=1, percent=100, threshold=3):
+    # Matches the arguments of PIL's UnsharpMask
+    return ['-unsharp', '0x%s+%s+%s' % (radius, percent / 100.0,
+                                         threshold / 255.0)]
+
+
+def blur(radius=2):
+    return ['-blur', '0x%s' % radius]
+
+
+def grayscale():
+    return ['-colorspace', 'Gray']
+
+
+GRAVITIES = {
+    'top-left': 'NorthWest',
+    'top-right': 'NorthEast',
+    'bottom-left': 'SouthWest',
+    'bottom-right': 'SouthEast',
+    'center': 'Center',
+}
+
+def watermark(path, position='bottom-right', opacity=100, margin=10):
+    """
+    Overlay the image at `path` in one corner (or the 'center') of the image,
+    at the given percentage opacity
+    """
+    if unsafe_path_regex.search(path):
+        raise ImageProcessorError('Unsupported watermark path: %s' % path)
+    return [
+        path,
+        '-gravity', GRAVITIES[position],
+        '-geometry', '+%d+%d' % (margin, margin),
+        '-compose', 'dissolve',
+        '-define', 'compose:args=%d' % opacity,
+        '-composite',
+        '-compose', 'over',
+    ]
 
 
-def convert(infile, outfile, extension, convert_args):
+RESIZERS = {
+    'fit': fit,
+    'fill': fill,
+    'pad': pad,
+    'squash': squash,
+}
+
+OPERATIONS = dict(RESIZERS,
+    sharpen=sharpen,
+    blur=blur,
+    grayscale=grayscale,
+    watermark=watermark,
+)
+
+
+def encoder_args(extension, encoder=None):
+    """
+    Return the convert arguments for the given `encoder` options (see
+    agilethumbs.encoding)
+    """
+    options = encoder_options(encoder)
+    extension = extension.lower()
+    args = []
+    if options.get('strip'):
+        args.append('-strip')
+    if extension in ('jpg', 'jpeg'):
+        if options.get('progressive'):
+            args.extend(['-interlace', 'Plane'])
+        if options.get('optimize'):
+            args.extend(['-define', 'jpeg:optimize-coding=true'])
+        if options.get('subsampling') is not None:
+            args.extend(['-sampling-factor', str(options['subsampling'])])
+        if options.get('target_bytes'):
+            # convert searches for the highest quality which fits
+            args.extend(['-define',
+                         'jpeg:extent=%db' % options['target_bytes']])
+    elif extension == 'webp':
+        if options.get('target_bytes'):
+            args.extend(['-define',
+                         'webp:target-size=%d' % options['target_bytes']])
+    elif extension in ('png', 'gif'):
+        if options.get('optimize') and extension == 'png':
+            args.extend(['-define', 'png:compression-level=9'])
+        if options.get('colors'):
+            args.extend(['-colors', str(int(options['colors']))])
+    return args
+
+
+def size_hint_args(width, height, resize):
+    """
+    Return decoder hints so that large JPEGs are decoded at reduced scale.
+    The decoder keeps both dimensions at least as large as the hint, so a
+    missing dimension can simply be given the same value as the other.
+    """
+    if resize not in ('fit', 'fill', 'pad', 'squash'):
+        return []
+    try:
+        width = int(width) if width != '' else None
+        height = int(height) if height != '' else None
+    except (TypeError, ValueError):
+        return []
+    if width is None and height is None:
+        return []
+    width = width or height
+    height = height or width
+    return ['-define', 'jpeg:size=%dx%d' % (width * REDUCING_GAP,
+                                            height * REDUCING_GAP)]
+
+
+def convert(infile, outfile, extension, convert_args, read_args=()):
+    # Before any of the source is read into memory
+    check_source_bytes(infile)
+    # Read straight from disk where possible, otherwise pipe the file in
+    path = path_from_file(infile)
+    if path is not None:
+        source, stdin = string_arg_from_file(infile, path), None
+    else:
+        source, stdin = string_arg_from_file(infile), infile
     # Construct the argument list for convert
-    cmd_args = ([CONVERT_PATH, string_arg_from_file(infile)]
+    cmd_args = ([CONVERT_PATH] + list(read_args) + [source]
                 + convert_args
                 + ['%s:-' % extension])
+    workers = getattr(settings, 'AGILETHUMBS_IM_WORKERS', 0)
+    if stdin is not None and (workers or not has_fileno(stdin)):
+        # In-memory files can't be handed to convert as its stdin
+        data, stdin = stdin.read(), None
+    else:
+        data = None
+    if getattr(settings, 'AGILETHUMBS_MAX_PIXELS', None):
+        # Piped sources have to be read twice
+        if stdin is not None:
+            data, stdin = stdin.read(), None
+        check_pixels(identify_size(source, data))
+    convert_timer = metrics.timer('convert').start()
+    if workers:
+        # Hand the job to a long-lived worker process, a small interpreter
+        # rather than a copy of this one, to fork convert from
+        pool = get_pool(__name__, workers,
+            getattr(settings, 'AGILETHUMBS_IM_WORKER_MAX_JOBS', 500))
+        returncode, output, stderr = pool.apply(run_convert, cmd_args, data)
+    else:
+        # In-memory outfiles, such as StorageCache's, can't be convert's
+        # stdout
+        stdout = outfile if has_fileno(outfile) else subprocess.PIPE
+        returncode, output, stderr = run_convert(cmd_args, data, stdin=stdin,
+                                                 stdout=stdout)
+    if returncode != 0:
+        raise ImageProcessorError('ImageMagick error: %s' % stderr)
+    if output is not None:
+        outfile.write(output)
+    convert_timer.stop()
+
+
+def identify_size(source, data=None):
+    """
+    Return the width and height of a source image, reading only its header
+    """
+    returncode, output, stderr = run_convert([CONVERT_PATH, '-ping', source,
+        '-format', '%w %h\\n', 'info:'], data)
+    try:
+        # Multi-frame images print a line per frame
+        width, height = output.splitlines()[0].split()
+        return int(width), int(height)
+    except (IndexError, ValueError):
+        raise ImageProcessorError('ImageMagick error: %s' % stderr)
+
+
+def can_encode(extension):
+    """
+    Return True if the installed ImageMagick can write images in the given
+    format
+    """
+    global _writable_formats
+    if _writable_formats is None:
+        _writable_formats = list_writable_formats()
+    return extension.upper() in _writable_formats
+
+_writable_formats = None
+
+# Lines of `convert -list format` output look like:
+#     WEBP* WEBP      rw-   WebP Image Format
+format_line_regex = re.compile(r'^\s*([A-Z0-9-]+)\*?\s+\S+\s+[r-]([w-])')
+
+def list_writable_formats():
+    try:
+        returncode, output, stderr = run_convert([CONVERT_PATH, '-list',
+                                                  'format'])
+    except ImageProcessorError:
+        return frozenset()
+    formats = set()
+    for line in output.splitlines():
+        match = format_line_regex.match(line)
+        if match and match.group(2) == 'w':
+            formats.add(match.group(1))
+    return frozenset(formats)
+
+
+simple_resize.can_encode = can_encode
+pipeline.can_encode = can_encode
+
+
+def run_convert(cmd_args, data=None, stdin=None, stdout=subprocess.PIPE):
+    """
+    Run convert, feeding it either `data` or the `stdin` file, and return
+    its exit code, output (if `stdout` is a pipe) and error output
+    """
+    if data is not None:
+        stdin = subprocess.PIPE
     # Invoke convert via subprocess
     try:
-        proc = subprocess.Popen(cmd_args, shell=False, stdin=infile,
-            stdout=outfile, stderr=subprocess.PIPE)
+        proc = subprocess.Popen(cmd_args, shell=False, stdin=stdin,
+            stdout=stdout, stderr=subprocess.PIPE)
     except OSError as e:
         if e.errno == errno.ENOENT:
             raise ImageProcessorError(
@@ -67,12 +346,31 @@ def convert(infile, outfile, extension, convert_args):
                     " PATH, or fiddle with %s.CONVERT_PATH" % __name__)
         else:
             raise 
-    stderr = proc.communicate()[1]
-    if proc.returncode != 0:
-        raise ImageProcessorError('ImageMagick error: %s' % stderr)
+    output, stderr = proc.communicate(data)
+    return proc.returncode, output, stderr
+
+
+def has_convert():
+    """
+    Return True if CONVERT_PATH can be found
+    """
+    if os.path.isabs(CONVERT_PATH):
+        return os.access(CONVERT_PATH, os.X_OK)
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(directory, CONVERT_PATH), os.X_OK):
+            return True
+    return False
 
 
-def string_arg_from_file(fileobj):
+def has_fileno(fileobj):
+    try:
+        fileobj.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return True
+
+
+def string_arg_from_file(fileobj, path='-'):
     # Get the file extension from the name, if it has a name attribute.
     # ImageMagick can usually determine the format without it, but it helps
     # in some cases.
@@ -81,5 +379,23 @@ def string_arg_from_file(fileobj):
         ext = os.path.splitext(name)[1].lstrip('.')
     except AttributeError:
         ext = ''
-    return  (ext + ':-') if ext != '' else '-'
+    return  (ext + ':' + path) if ext != '' else path
+
+
+# Characters which ImageMagick treats specially in input filenames
+unsafe_path_regex = re.compile(r'[\[\]*?:]')
+
+def path_from_file(fileobj):
+    """
+    Return the filesystem path of the file underlying `fileobj`, if it has
+    one which can be passed to ImageMagick as-is, or None
+    """
+    # Django File objects wrap the real file, whose name is the full path
+    for obj in (fileobj, getattr(fileobj, 'file', None)):
+        name = getattr(obj, 'name', None)
+        if (isinstance(name, basestring) and os.path.isabs(name)
+                and not unsafe_path_regex.search(name)
+                and os.path.isfile(name)):
+            return name
+    return None
 
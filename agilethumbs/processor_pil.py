@@ -1,49 +1,390 @@
 from __future__ import division
 import re
+from StringIO import StringIO
 
 # Try to import PIL in either of the two ways it can end up installed.
 try:
-        from PIL import Image, ImageOps
+        from PIL import Image, ImageOps, ImageFilter
 except ImportError:
-        import Image, ImageOps
+        import Image, ImageOps, ImageFilter
+
+from django.core.urlresolvers import get_callable
 
 from agilethumbs import ImageProcessorError
+from agilethumbs import metrics
+from agilethumbs.geometry import fit_size, required_size, output_size
+from agilethumbs.metadata import record_source
+from agilethumbs.limits import check_source_bytes, check_pixels
+from agilethumbs.encoding import encoder_options, DEFAULT_MIN_QUALITY
 
 
 def simple_resize(
         infile, outfile, extension,
         width=None, height=None, resize='fit', background='transparent',
-        quality=85):
-    im = Image.open(infile)
-    im = im.convert('RGB')
-    # Scale image so it does not exceed specified dimensions
-    if resize == 'fit':
-        if width is not None or height is not None:
-            if width is None:
-                width = int(round(im.size[0] * height / im.size[1]))
-            elif height is None:
-                height = int(round(im.size[1] * width / im.size[0]))
-            im.thumbnail((width, height), Image.ANTIALIAS)
-    # Scale and crop image so it exactly fills specified dimensions 
-    elif resize == 'fill':
-        im = ImageOps.fit(im, (width, height), Image.ANTIALIAS)
-    # Scale image so it does not exceed specified dimensions and then pad with
-    # background color so it exactly fills specified dimensions
-    elif resize == 'pad':
-        im.thumbnail((width, height), Image.ANTIALIAS)
-        tmp = Image.new('RGBA', (width, height), color_from_string(background))
-        tmp.paste(im, ((width - im.size[0]) // 2, (height - im.size[1]) // 2))
-        im = tmp
-    # Scale image to exact dimensions ignoring aspect ratio
-    elif resize == 'squash':
-        im = im.resize((width, height), Image.ANTIALIAS)
-    else:
+        quality=85, encoder=None):
+    render_many(infile, [(outfile, extension, {
+        'width': width, 'height': height, 'resize': resize,
+        'background': background, 'quality': quality, 'encoder': encoder})])
+
+
+def render_many(infile, jobs):
+    """
+    Produce the output for several sets of simple_resize arguments from a
+    single decode of `infile`. Each job is an (outfile, extension, kwargs)
+    tuple.
+
+    Larger 'fit' outputs are reused as the source for smaller ones wherever
+    they still have enough detail.
+    """
+    decode_timer = metrics.timer('decode').start()
+    im = open_image(infile)
+    # Image.open only reads the header, so we know the size before decoding
+    size = im.size
+    jobs = [(outfile, extension, kwargs, required_size(size,
+                kwargs.get('width'), kwargs.get('height'),
+                kwargs.get('resize', 'fit')))
+            for (outfile, extension, kwargs) in jobs]
+    im = decode(im, (max(job[3][0] for job in jobs),
+                     max(job[3][1] for job in jobs)))
+    decode_timer.stop()
+    sources = [im]
+    for outfile, extension, kwargs, needed in sorted(
+            jobs, key=lambda job: job[3][0] * job[3][1], reverse=True):
+        kwargs = kwargs.copy()
+        quality = kwargs.pop('quality', 85)
+        encoder = kwargs.pop('encoder', None)
+        # Use the smallest available image with enough detail
+        source = im
+        for candidate in sources:
+            if (candidate.size[0] >= needed[0] * REDUCING_GAP and
+                    candidate.size[1] >= needed[1] * REDUCING_GAP and
+                    candidate.size[0] < source.size[0]):
+                source = candidate
+        with metrics.timer('resize'):
+            output = resize_image(source, size, **kwargs)
+        with metrics.timer('encode'):
+            save_image(output, outfile, extension, quality, encoder)
+        # Only scaled, rather than cropped or padded, images can be reused
+        if kwargs.get('resize', 'fit') == 'fit':
+            sources.append(output)
+
+
+def pipeline(infile, outfile, extension, operations=(), quality=85,
+             encoder=None):
+    """
+    Apply a list of operations to a single decode of `infile`, and encode
+    the result once at the end. Each operation is either a name or a
+    (name, kwargs) tuple, where the name is a key of OPERATIONS, or a
+    function taking and returning a PIL image or its dotted path, e.g.
+
+        [('fill', {'width': 100, 'height': 100}), 'sharpen']
+    """
+    operations = [(op, {}) if isinstance(op, basestring) or callable(op)
+                  else op for op in operations]
+    with metrics.timer('decode'):
+        im = open_image(infile)
+        size = im.size
+        # If the pipeline starts by shrinking the image, decode it no larger
+        # than needed
+        if operations and operations[0][0] in RESIZERS:
+            name, kwargs = operations[0]
+            im = decode(im, required_size(size, kwargs.get('width'),
+                                          kwargs.get('height'), name))
+            operations[0] = (name, dict(kwargs, size=size))
+        else:
+            im = decode(im, size)
+    with metrics.timer('resize'):
+        for name, kwargs in operations:
+            im = get_operation(name)(im, **kwargs)
+    with metrics.timer('encode'):
+        save_image(im, outfile, extension, quality, encoder)
+
+
+def open_image(infile):
+    """
+    Open an image, reading only its header, and check it against the
+    AGILETHUMBS_MAX_SOURCE_BYTES and AGILETHUMBS_MAX_PIXELS budgets before
+    anything is decoded
+    """
+    check_source_bytes(infile)
+    try:
+        im = Image.open(infile)
+    except DECOMPRESSION_BOMB_ERRORS as e:
+        raise ImageProcessorError(str(e))
+    check_pixels(im.size)
+    record_source(im.size, im.format)
+    return im
+
+# Raised by newer versions of PIL for absurdly large images
+DECOMPRESSION_BOMB_ERRORS = tuple(filter(None, [
+    getattr(Image, 'DecompressionBombError', None)]))
+
+
+def decode(im, size):
+    """
+    Decode the opened image `im`, at reduced scale if it is much larger than
+    `size`, and return it in RGB mode
+    """
+    im = shrink_on_load(im, size)
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    im.load()
+    return im
+
+
+def get_operation(name):
+    if callable(name):
+        return name
+    try:
+        return OPERATIONS[name]
+    except KeyError:
+        pass
+    try:
+        operation = get_callable(name)
+    except (ImportError, AttributeError):
+        operation = None
+    if not callable(operation):
+        raise ImageProcessorError('Unknown operation: %s' % name)
+    return operation
+
+
+def resize_image(im, size, width=None, height=None, resize='fit',
+                 background='transparent'):
+    """
+    Return a resized copy of `im`, which is a decoded (and possibly already
+    reduced) version of a source image of the given `size`
+    """
+    try:
+        resizer = RESIZERS[resize]
+    except KeyError:
         raise ImageProcessorError('Unknwon resize option: %s' % resize)
+    if resize == 'pad':
+        return resizer(im, width, height, background, size=size)
+    return resizer(im, width, height, size=size)
+
+
+# Pipeline operations. `size` is the size of the original image, when `im` is
+# a reduced decode of it.
+
+def fit(im, width=None, height=None, size=None):
+    """
+    Scale image so it does not exceed specified dimensions
+    """
+    fitted = output_size(size or im.size, width, height, 'fit')
+    if fitted != im.size:
+        im = im.resize(fitted, Image.ANTIALIAS)
+    return im
+
+
+def fill(im, width, height, size=None):
+    """
+    Scale and crop image so it exactly fills specified dimensions
+    """
+    return ImageOps.fit(im, (width, height), Image.ANTIALIAS)
+
+
+def pad(im, width, height, background='transparent', size=None):
+    """
+    Scale image so it does not exceed specified dimensions and then pad with
+    background color so it exactly fills specified dimensions
+    """
+    fitted = fit_size(size or im.size, (width, height))
+    if fitted != im.size:
+        im = im.resize(fitted, Image.ANTIALIAS)
+    tmp = Image.new('RGBA', (width, height), color_from_string(background))
+    tmp.paste(im, ((width - im.size[0]) // 2, (height - im.size[1]) // 2))
+    return tmp
+
+
+def squash(im, width, height, size=None):
+    """
+    Scale image to exact dimensions ignoring aspect ratio
+    """
+    return im.resize((width, height), Image.ANTIALIAS)
+
+
+def sharpen(im, radius=1, percent=100, threshold=3):
+    return im.filter(ImageFilter.UnsharpMask(radius, percent, threshold))
+
+
+def blur(im, radius=2):
+    return im.filter(ImageFilter.GaussianBlur(radius))
+
+
+def grayscale(im):
+    return ImageOps.grayscale(im).convert(im.mode)
+
+
+def watermark(im, path, position='bottom-right', opacity=100, margin=10):
+    """
+    Overlay the image at `path` in one corner (or the 'center') of the image,
+    at the given percentage opacity
+    """
+    mark = Image.open(path).convert('RGBA')
+    if opacity < 100:
+        alpha = mark.split()[3].point(lambda a: a * opacity // 100)
+        mark.putalpha(alpha)
+    vertical, _, horizontal = position.partition('-')
+    x = (im.size[0] - mark.size[0]) // 2
+    y = (im.size[1] - mark.size[1]) // 2
+    if horizontal == 'left':
+        x = margin
+    elif horizontal == 'right':
+        x = im.size[0] - mark.size[0] - margin
+    if vertical == 'top':
+        y = margin
+    elif vertical == 'bottom':
+        y = im.size[1] - mark.size[1] - margin
+    im = im.copy()
+    im.paste(mark, (x, y), mark)
+    return im
+
+
+RESIZERS = {
+    'fit': fit,
+    'fill': fill,
+    'pad': pad,
+    'squash': squash,
+}
+
+OPERATIONS = dict(RESIZERS,
+    sharpen=sharpen,
+    blur=blur,
+    grayscale=grayscale,
+    watermark=watermark,
+)
+
+
+def save_image(im, outfile, extension, quality=85, encoder=None):
+    """
+    Encode `im` to `outfile` with the given quality and `encoder` options
+    (see agilethumbs.encoding)
+    """
+    options = encoder_options(encoder)
+    im_format = image_format(extension)
+    params = {'quality': quality}
+    if im_format == 'JPEG':
+        params['progressive'] = bool(options.get('progressive'))
+        params['optimize'] = bool(options.get('optimize'))
+        if options.get('subsampling') is not None:
+            params['subsampling'] = options['subsampling']
+    elif im_format == 'PNG':
+        params['optimize'] = bool(options.get('optimize'))
+    if options.get('colors') and im_format in PALETTE_FORMATS:
+        im = quantize(im, options['colors'])
+    if options.get('strip'):
+        # Some formats copy these from the source unless told otherwise
+        im.info = dict((key, value) for (key, value) in im.info.items()
+                       if key not in METADATA_KEYS)
+    if options.get('target_bytes') and im_format in LOSSY_FORMATS:
+        outfile.write(encode_to_size(im, im_format, params,
+            options['target_bytes'],
+            options.get('min_quality', DEFAULT_MIN_QUALITY)))
+    else:
+        im.save(outfile, im_format, **params)
+
+PALETTE_FORMATS = ('PNG', 'GIF')
+LOSSY_FORMATS = ('JPEG', 'WEBP')
+METADATA_KEYS = ('exif', 'icc_profile', 'xmp', 'dpi', 'comment')
+
+
+def quantize(im, colors):
+    """
+    Reduce `im` to a palette of at most `colors` colours
+    """
+    if im.mode == 'RGBA':
+        # Only the fast octree method keeps the alpha channel
+        return im.quantize(colors, method=2)
+    if im.mode != 'RGB':
+        im = im.convert('RGB')
+    return im.quantize(colors)
+
+
+def encode_to_size(im, im_format, params, max_bytes, min_quality):
+    """
+    Return `im` encoded at the highest quality between `min_quality` and
+    params['quality'] whose output fits in `max_bytes`, or at `min_quality`
+    if none does, searching in memory
+    """
+    encoded = {}
+    def encode(quality):
+        if quality not in encoded:
+            output = StringIO()
+            im.save(output, im_format, **dict(params, quality=quality))
+            encoded[quality] = output.getvalue()
+        return encoded[quality]
+    # Small images often fit at the requested quality
+    best = encode(params['quality'])
+    if len(best) <= max_bytes:
+        return best
+    low, high = min_quality, params['quality'] - 1
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(quality)
+        if len(data) <= max_bytes:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+    if best is None:
+        best = encode(min_quality)
+    return best
+
+
+def image_format(extension):
     # Convert `extension` argument into something PIL is happy with
     im_format = extension.encode('ascii').upper()
     if im_format == 'JPG':
                 im_format = 'JPEG'
-    im.save(outfile, im_format, quality=quality)
+    return im_format
+
+
+def can_encode(extension):
+    """
+    Return True if the installed PIL can write images in the given format,
+    e.g. WebP needs PIL to have been built with libwebp
+    """
+    Image.init()
+    return image_format(extension) in Image.SAVE
+
+
+# Processors which can render several outputs from one decode advertise it
+# with this attribute
+simple_resize.render_many = render_many
+
+# Processors used for 'auto' styles advertise which formats they can write
+simple_resize.can_encode = can_encode
+pipeline.can_encode = can_encode
+
+
+# Decode images to at least this multiple of the size actually needed, so
+# that the final antialiased resample has enough detail to work with
+REDUCING_GAP = 2
+
+# Modes supported by Image.reduce
+REDUCE_MODES = ('L', 'LA', 'I', 'F', 'RGB', 'RGBA', 'RGBa', 'CMYK', 'YCbCr')
+
+
+def shrink_on_load(im, size):
+    """
+    Decode the image at reduced scale where that still leaves at least
+    REDUCING_GAP times `size`: JPEGs are scaled during decoding using the DCT
+    and, where available, other formats are reduced by box sampling before
+    any further processing
+    """
+    target = (size[0] * REDUCING_GAP, size[1] * REDUCING_GAP)
+    if target[0] >= im.size[0] or target[1] >= im.size[1]:
+        return im
+    if im.format == 'JPEG':
+        im.draft('RGB', target)
+    elif hasattr(im, 'reduce'):
+        factor = min(im.size[0] // target[0], im.size[1] // target[1])
+        if factor >= 2:
+            if im.mode not in REDUCE_MODES:
+                im = im.convert('RGB')
+            im = im.reduce(factor)
+    return im
 
 
 color_regex = re.compile('^#' + ('([a-fA-F0-9]{2})' * 3) + '$')
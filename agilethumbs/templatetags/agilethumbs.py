@@ -1,8 +1,131 @@
 from django import template
-from .. import image_url as get_image_url
+from .. import (image_url as get_image_url, image_urls as get_image_urls,
+    image_srcset as get_image_srcset)
+from ..metadata import image_dimensions
 
 register = template.Library()
 
 @register.simple_tag
 def image_url(image, style='default'):
     return get_image_url(image, style)
+
+
+class ImageURLsNode(template.Node):
+
+    def __init__(self, images, styles, varname):
+        self.images = images
+        self.styles = styles
+        self.varname = varname
+
+    def render(self, context):
+        images = list(self.images.resolve(context))
+        styles = [style.resolve(context) for style in self.styles]
+        urls = get_image_urls(images, styles)
+        context[self.varname] = zip(images, urls)
+        return ''
+
+
+@register.tag
+def image_urls(parser, token):
+    """
+    Build URLs for a list of images in several styles in one go, e.g.
+
+        {% image_urls images 'small' 'large' as image_list %}
+        {% for image, urls in image_list %}
+            <a href="{{ urls.large }}"><img src="{{ urls.small }}"></a>
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) < 4 or bits[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            "Usage: {%% %s images 'style' ['style' ...] as varname %%}"
+            % bits[0])
+    images = parser.compile_filter(bits[1])
+    styles = [parser.compile_filter(bit) for bit in bits[2:-2] or
+              ["'default'"]]
+    return ImageURLsNode(images, styles, bits[-1])
+
+
+class ImageSrcsetNode(template.Node):
+
+    def __init__(self, image, style, sizes, varname=None):
+        self.image = image
+        self.style = style
+        self.sizes = sizes
+        self.varname = varname
+
+    def render(self, context):
+        widths, densities = [], []
+        for size in self.sizes:
+            size = size.resolve(context)
+            if isinstance(size, basestring) and size.endswith('x'):
+                densities.append(size)
+            else:
+                widths.append(size)
+        srcset = get_image_srcset(self.image.resolve(context),
+                                  self.style.resolve(context), widths,
+                                  densities)
+        if self.varname is None:
+            return srcset
+        context[self.varname] = srcset
+        return ''
+
+
+@register.tag
+def image_srcset(parser, token):
+    """
+    Build a srcset attribute value for an image in a style at several widths
+    or pixel densities, e.g.
+
+        <img src="{% image_url image 'thumb' %}"
+             srcset="{% image_srcset image 'thumb' 320 640 1280 %}"
+             sizes="(max-width: 600px) 100vw, 320px">
+        <img srcset="{% image_srcset image 'thumb' '1x' '2x' %}">
+    """
+    bits = token.split_contents()
+    varname = None
+    if len(bits) > 2 and bits[-2] == 'as':
+        varname = bits[-1]
+        bits = bits[:-2]
+    if len(bits) < 4:
+        raise template.TemplateSyntaxError(
+            "Usage: {%% %s image 'style' width|'density' ... [as varname] %%}"
+            % bits[0])
+    return ImageSrcsetNode(parser.compile_filter(bits[1]),
+                           parser.compile_filter(bits[2]),
+                           [parser.compile_filter(bit) for bit in bits[3:]],
+                           varname)
+
+
+class ImageDimensionsNode(template.Node):
+
+    def __init__(self, image, style, varname):
+        self.image = image
+        self.style = style
+        self.varname = varname
+
+    def render(self, context):
+        context[self.varname] = image_dimensions(
+            self.image.resolve(context), self.style.resolve(context))
+        return ''
+
+
+@register.tag(name='image_dimensions')
+def do_image_dimensions(parser, token):
+    """
+    Predict the width and height of an image in a style from the cached
+    size of its source, without opening it, e.g.
+
+        {% image_dimensions image 'thumb' as dims %}
+        <img src="{% image_url image 'thumb' %}"
+             {% if dims %}width="{{ dims.width }}" height="{{ dims.height }}"{% endif %}>
+
+    The variable is None if the source hasn't been processed yet.
+    """
+    bits = token.split_contents()
+    if len(bits) not in (4, 5) or bits[-2] != 'as':
+        raise template.TemplateSyntaxError(
+            "Usage: {%% %s image ['style'] as varname %%}" % bits[0])
+    style = bits[2] if len(bits) == 5 else "'default'"
+    return ImageDimensionsNode(parser.compile_filter(bits[1]),
+                               parser.compile_filter(style), bits[-1])
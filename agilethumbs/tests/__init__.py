@@ -2,3 +2,21 @@ from escape import *
 from object_to_id import *
 from simple_resize import *
 from image_request import *
+from concurrency import *
+from url_cache import *
+from pool import *
+from warm import *
+from generate import *
+from eviction import *
+from layout import *
+from backends import *
+from failures import *
+from metrics import *
+from benchmark import *
+from pipeline import *
+from formats import *
+from srcset import *
+from metadata import *
+from limits import *
+from eager import *
+from encoding import *
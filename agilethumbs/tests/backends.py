@@ -0,0 +1,118 @@
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, processor_pil
+from agilethumbs.base import cache_path, get_style_registry, escape
+from agilethumbs.backends import StorageCache, get_cache_backend
+from agilethumbs.generate import generate_styles
+from agilethumbs.processor_im import has_convert
+from agilethumbs.benchmark import make_source
+from agilethumbs.tests.utils import NamedObject, copy_processor
+
+
+class CountingStorageCache(StorageCache):
+
+    reads = 0
+
+    def read(self, name):
+        CountingStorageCache.reads += 1
+        return super(CountingStorageCache, self).read(name)
+
+
+@override_settings()
+class TestCacheBackends(TestCase):
+
+    urls = 'agilethumbs.tests.image_request'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.tmp_dir + '/storage')
+        CountingStorageCache.reads = 0
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir + '/unused'
+        settings.AGILETHUMBS_LOCK_DIR = self.tmp_dir + '/locks'
+        settings.AGILETHUMBS_CACHE_BACKEND = \
+            'agilethumbs.tests.backends.CountingStorageCache'
+        settings.AGILETHUMBS_CACHE_BACKEND_OPTIONS = {'storage': self.storage}
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'copy': (copy_processor, 'jpg', 1, {}),
+            'other': (copy_processor, 'png', 1, {}),
+        }
+
+    def id_to_object(self, file_id):
+        return StringIO('contents of %s' % file_id)
+
+    def cachePath(self, style):
+        style = get_style_registry()[style]
+        return cache_path(**style.params(escape(u'image')))
+
+    def testStorage(self):
+        url = image_url(NamedObject(u'image'), 'copy')
+        for i in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, 'contents of image')
+            self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(self.storage.exists(self.cachePath('copy')))
+        self.assertEqual(CountingStorageCache.reads, 2)
+
+    def testStorageRedirect(self):
+        settings.AGILETHUMBS_CACHE_BACKEND_OPTIONS = {
+            'storage': self.storage, 'redirect': True}
+        response = self.client.get(image_url(NamedObject(u'image'), 'copy'))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(
+            self.storage.url(self.cachePath('copy'))))
+
+    def testGenerateStyles(self):
+        created = generate_styles(u'image', ['copy', 'other'])
+        self.assertEqual(sorted(created), ['copy', 'other'])
+        for style in ('copy', 'other'):
+            self.assertEqual(get_cache_backend().read(self.cachePath(style)),
+                             'contents of image')
+        # Saving again replaces rather than duplicating files
+        get_cache_backend().delete(self.cachePath('copy'))
+        generate_styles(u'image', ['copy', 'other'])
+        self.assertEqual(len(self.storage.listdir('')[1]), 2)
+
+    def testImageMagick(self):
+        # convert can't write straight into the in-memory files
+        if not has_convert():
+            self.skipTest('ImageMagick is not installed')
+        source = make_source((60, 40), 'PNG')
+        settings.AGILETHUMBS_ID_TO_OBJECT = lambda file_id: StringIO(source)
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_im.simple_resize', 'png', 1,
+                      {'width': 30}),
+        }
+        response = self.client.get(image_url(NamedObject(u'image'), 'small'))
+        self.assertEqual(response.status_code, 200)
+        im = processor_pil.Image.open(StringIO(response.content))
+        self.assertEqual(im.size, (30, 20))
+
+    def testMemoryCache(self):
+        settings.AGILETHUMBS_MEMORY_CACHE = {'max_items': 10}
+        url = image_url(NamedObject(u'image'), 'copy')
+        for i in range(3):
+            response = self.client.get(url)
+            self.assertEqual(response.content, 'contents of image')
+        self.assertEqual(CountingStorageCache.reads, 1)
+
+    def testMemoryCacheItemSize(self):
+        settings.AGILETHUMBS_MEMORY_CACHE = {'max_item_size': 4}
+        url = image_url(NamedObject(u'image'), 'copy')
+        for i in range(3):
+            self.client.get(url)
+        self.assertEqual(CountingStorageCache.reads, 3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
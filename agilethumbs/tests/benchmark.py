@@ -0,0 +1,70 @@
+import sys
+import subprocess
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import benchmark, processor_pil
+from agilethumbs.processor_im import has_convert
+
+
+def allocate(size):
+    return len('x' * size)
+
+def allocate_in_child(size):
+    return subprocess.call([sys.executable, '-c', "'x' * %d" % size])
+
+
+@override_settings()
+class TestBenchmark(TestCase):
+
+    def testMakeSource(self):
+        im = processor_pil.Image.open(
+            StringIO(benchmark.make_source((64, 48), 'PNG')))
+        self.assertEqual(im.size, (64, 48))
+        self.assertEqual(im.format, 'PNG')
+
+    def testInChild(self):
+        value, peak_rss, child_peak_rss = benchmark.in_child(
+            allocate, (50 * 1024 * 1024,))
+        self.assertEqual(value, 50 * 1024 * 1024)
+        self.assertTrue(peak_rss >= 40 * 1024)
+        self.assertRaises(RuntimeError, benchmark.in_child, allocate,
+                          ('not a size',))
+
+    def testInChildCountsChildren(self):
+        value, peak_rss, child_peak_rss = benchmark.in_child(
+            allocate_in_child, (50 * 1024 * 1024,))
+        self.assertEqual(value, 0)
+        self.assertTrue(child_peak_rss >= 40 * 1024)
+
+    def testImageMagick(self):
+        if not has_convert():
+            self.skipTest('ImageMagick is not installed')
+        source = benchmark.make_source((64, 48), 'JPEG')
+        for resize in benchmark.RESIZE_MODES:
+            for workers in (0, 1):
+                seconds, peak_rss, child_peak_rss = benchmark.in_child(
+                    benchmark.time_processor, (
+                        'agilethumbs.processor_im.simple_resize', source,
+                        resize, 1, workers))
+                self.assertTrue(seconds > 0)
+
+    def testRun(self):
+        old_styles = settings.AGILETHUMBS_STYLES = {}
+        results = benchmark.run(groups=['urls', 'requests'], quick=True)
+        names = [result['name'] for result in results['results']]
+        self.assertTrue('image_url tag' in names)
+        self.assertTrue('agilethumbs_image hit' in names)
+        for result in results['results']:
+            self.assertTrue(result['per_second'] > 0)
+        # Settings are restored afterwards
+        self.assertTrue(settings.AGILETHUMBS_STYLES is old_styles)
+        comparison = list(benchmark.compare(results, results))
+        self.assertEqual(len(comparison), len(names))
+        self.assertEqual(comparison[0][3], 1)
@@ -0,0 +1,178 @@
+import os
+import time
+import socket
+import tempfile
+import shutil
+import threading
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs.concurrency import (single_flight, coalesce,
+    processing_slot, ServerBusy, LOCK_SUFFIX)
+
+
+class TestSingleFlight(TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'sub', 'image.jpg')
+        self.lock_name = self.filename + LOCK_SUFFIX
+    
+    def testAcquireAndRelease(self):
+        with single_flight(self.filename) as acquired:
+            self.assertTrue(acquired)
+            self.assertTrue(os.path.exists(self.lock_name))
+        self.assertFalse(os.path.exists(self.lock_name))
+    
+    def testWaiterTimesOut(self):
+        with single_flight(self.filename):
+            with single_flight(self.filename, timeout=0.1) as acquired:
+                self.assertFalse(acquired)
+            self.assertTrue(os.path.exists(self.lock_name))
+    
+    def testWaiterReturnsOnceFileExists(self):
+        with single_flight(self.filename):
+            open(self.filename, 'wb').close()
+            start = time.time()
+            with single_flight(self.filename, timeout=5) as acquired:
+                self.assertFalse(acquired)
+            self.assertLess(time.time() - start, 1)
+    
+    def testWaiterPollsLockFile(self):
+        checks = []
+        def exists():
+            checks.append(1)
+            return False
+        with single_flight(self.filename):
+            with single_flight(self.filename, timeout=0.3,
+                               exists=exists) as acquired:
+                self.assertFalse(acquired)
+        self.assertEqual(len(checks), 1)
+    
+    def testOldLockIsBroken(self):
+        os.makedirs(os.path.dirname(self.lock_name))
+        with open(self.lock_name, 'wb') as f:
+            f.write('otherhost 1\n')
+        old = time.time() - 600
+        os.utime(self.lock_name, (old, old))
+        with single_flight(self.filename, timeout=1,
+                           stale_after=60) as acquired:
+            self.assertTrue(acquired)
+    
+    def testDeadOwnerLockIsBroken(self):
+        os.makedirs(os.path.dirname(self.lock_name))
+        # Find a pid which is not in use
+        pid = 99999
+        while os.path.exists('/proc/%d' % pid):
+            pid -= 1
+        with open(self.lock_name, 'wb') as f:
+            f.write('%s %d\n' % (socket.gethostname(), pid))
+        with single_flight(self.filename, timeout=1) as acquired:
+            self.assertTrue(acquired)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+class TestProcessingSlot(TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+    
+    def slot(self, **kwargs):
+        return processing_slot(directory=self.tmp_dir, **kwargs)
+    
+    def testLimit(self):
+        with self.slot(limit=2):
+            with self.slot(limit=2):
+                with self.assertRaises(ServerBusy):
+                    with self.slot(limit=2, queue=1, timeout=0.1):
+                        pass
+        with self.slot(limit=2):
+            pass
+    
+    def testFullQueueFailsImmediately(self):
+        with self.slot(limit=1):
+            start = time.time()
+            with self.assertRaises(ServerBusy):
+                with self.slot(limit=1, queue=0, timeout=5):
+                    pass
+            self.assertLess(time.time() - start, 1)
+    
+    def testDisabled(self):
+        with self.slot(limit=0):
+            with self.slot(limit=0):
+                pass
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+
+@override_settings()
+class TestCoalesce(TestCase):
+    
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+    
+    def work(self, value):
+        self.calls.append(value)
+        self.release.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+    
+    def run_threads(self, value, count=5):
+        results = []
+        def target():
+            try:
+                results.append(coalesce('key', self.work, value))
+            except Exception as e:
+                results.append(e)
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        # Give every thread time to join the first one's call
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+    
+    def testConcurrentCallsShared(self):
+        self.assertEqual(self.run_threads('result'), ['result'] * 5)
+        self.assertEqual(self.calls, ['result'])
+    
+    def testErrorsShared(self):
+        error = IOError('No such file')
+        self.assertEqual(self.run_threads(error), [error] * 5)
+        self.assertEqual(len(self.calls), 1)
+    
+    def testLaterCallsNotShared(self):
+        self.release.set()
+        self.assertEqual(coalesce('key', self.work, 1), 1)
+        self.assertEqual(coalesce('key', self.work, 2), 2)
+        self.assertEqual(self.calls, [1, 2])
+    
+    def testWaitTimesOut(self):
+        settings.AGILETHUMBS_LOCK_TIMEOUT = 0.1
+        leader = threading.Thread(target=coalesce,
+                                  args=('key', self.work, 'first'))
+        leader.start()
+        time.sleep(0.1)
+        try:
+            # The follower gives up waiting and does the work itself
+            follower = threading.Thread(target=coalesce,
+                                        args=('key', self.work, 'second'))
+            follower.start()
+            time.sleep(0.3)
+            self.assertEqual(self.calls, ['first', 'second'])
+        finally:
+            self.release.set()
+            leader.join()
+            follower.join()
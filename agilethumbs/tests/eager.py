@@ -0,0 +1,139 @@
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.db import models
+from django.db.models.signals import post_save
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import eager, processor_pil
+from agilethumbs.base import get_style_registry, escape
+from agilethumbs.backends import get_cache_backend
+from agilethumbs.failures import get_failure_cache, record_failure, has_failed
+from agilethumbs.metadata import (get_metadata_cache, set_source_metadata,
+    source_metadata)
+
+
+class Photo(models.Model):
+    image = models.FileField(upload_to='photos')
+
+    class Meta:
+        app_label = 'agilethumbs'
+
+
+class RecordingQueue(object):
+
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, file_id, style_names):
+        self.jobs.append((file_id, list(style_names)))
+
+
+@override_settings()
+class TestEager(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        source = StringIO()
+        processor_pil.Image.new('RGB', (300, 200)).save(source, 'JPEG')
+        self.source = source.getvalue()
+        get_failure_cache().clear()
+        get_metadata_cache().clear()
+        self.queue = RecordingQueue()
+        settings.AGILETHUMBS_EAGER_QUEUE = self.queue
+        settings.AGILETHUMBS_EAGER_STYLES = {
+            'agilethumbs.Photo.image': ['small', 'large'],
+        }
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 1,
+                      {'width': 30}),
+            'large': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                      {'width': 100}),
+        }
+        eager.connect()
+
+    def id_to_object(self, file_id):
+        if file_id.startswith('missing'):
+            raise IOError('No such file')
+        return StringIO(self.source)
+
+    def save(self, photo, created=False):
+        # Saves aren't needed, just their signal
+        post_save.send(sender=Photo, instance=photo, created=created)
+
+    def cached(self, object_id, style_name):
+        file_id = escape(object_id)
+        backend = get_cache_backend()
+        return all(backend.exists(name) for (extension, name)
+                   in get_style_registry()[style_name].cache_names(file_id))
+
+    def testNewFile(self):
+        photo = Photo()
+        photo.image = 'photos/new.jpg'
+        self.save(photo, created=True)
+        self.assertEqual(self.queue.jobs,
+                         [(escape(u'photos/new.jpg'), ['small', 'large'])])
+
+    def testUnchangedFile(self):
+        photo = Photo(image='photos/old.jpg')
+        self.save(photo)
+        self.assertEqual(self.queue.jobs, [])
+        photo.image = 'photos/replacement.jpg'
+        self.save(photo)
+        self.save(photo)
+        self.assertEqual(self.queue.jobs, [
+            (escape(u'photos/replacement.jpg'), ['small', 'large'])])
+
+    def testEmptyFile(self):
+        self.save(Photo(), created=True)
+        self.assertEqual(self.queue.jobs, [])
+
+    def testClearsFailuresAndMetadata(self):
+        name = get_style_registry()['small'].cache_names(
+            escape(u'photos/new.jpg'))[0][1]
+        record_failure(name)
+        set_source_metadata(u'photos/new.jpg', 10, 10)
+        photo = Photo()
+        photo.image = 'photos/new.jpg'
+        self.save(photo, created=True)
+        self.assertFalse(has_failed(name, escape(u'photos/new.jpg')))
+        self.assertEqual(source_metadata(photo.image), None)
+
+    def testSynchronousQueue(self):
+        settings.AGILETHUMBS_EAGER_QUEUE = 'agilethumbs.eager.SynchronousQueue'
+        photo = Photo()
+        photo.image = 'photos/new.jpg'
+        self.save(photo, created=True)
+        self.assertTrue(self.cached(u'photos/new.jpg', 'small'))
+        self.assertTrue(self.cached(u'photos/new.jpg', 'large'))
+
+    def testFailuresRemembered(self):
+        settings.AGILETHUMBS_EAGER_QUEUE = 'agilethumbs.eager.SynchronousQueue'
+        photo = Photo()
+        photo.image = 'missing.jpg'
+        self.save(photo, created=True)
+        name = get_style_registry()['small'].cache_names(
+            escape(u'missing.jpg'))[0][1]
+        self.assertTrue(has_failed(name, escape(u'missing.jpg')))
+
+    def testThreadQueue(self):
+        queue = eager.ThreadQueue(threads=2)
+        for i in range(3):
+            for j in range(2):
+                queue.enqueue(escape(u'image%d.jpg' % i), ['small'])
+        queue.join()
+        for i in range(3):
+            self.assertTrue(self.cached(u'image%d.jpg' % i, 'small'))
+        self.assertTrue(len(queue.workers) <= 2)
+
+    def tearDown(self):
+        eager.unwatch(Photo)
+        shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,102 @@
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import ImageProcessorError, processor_pil, processor_im
+from agilethumbs.benchmark import make_source
+
+Image = processor_pil.Image
+
+
+@override_settings()
+class TestEncoderOptions(TestCase):
+
+    def setUp(self):
+        self.source = make_source((400, 300), 'JPEG')
+
+    def resize(self, extension='jpg', source=None, **kwargs):
+        output = StringIO()
+        processor_pil.simple_resize(StringIO(source or self.source), output,
+                                    extension, width=200, **kwargs)
+        return output.getvalue()
+
+    def testProgressive(self):
+        im = Image.open(StringIO(self.resize(
+            encoder={'progressive': True, 'optimize': True})))
+        self.assertTrue(im.info.get('progressive') or
+                        im.info.get('progression'))
+        im = Image.open(StringIO(self.resize()))
+        self.assertFalse(im.info.get('progressive'))
+
+    def testSubsampling(self):
+        from PIL import JpegImagePlugin
+        im = Image.open(StringIO(self.resize(
+            encoder={'subsampling': '4:4:4'})))
+        self.assertEqual(JpegImagePlugin.get_sampling(im), 0)
+        im = Image.open(StringIO(self.resize(
+            encoder={'subsampling': '4:2:0'})))
+        self.assertEqual(JpegImagePlugin.get_sampling(im), 2)
+
+    def testQuantize(self):
+        output = self.resize('png', encoder={'colors': 64})
+        im = Image.open(StringIO(output))
+        self.assertEqual(im.mode, 'P')
+        self.assertTrue(len(output) < len(self.resize('png')))
+
+    def testStrip(self):
+        source = StringIO()
+        Image.new('RGB', (400, 300)).save(source, 'PNG',
+                                          icc_profile='profile')
+        for encoder, stripped in (({}, False), ({'strip': True}, True)):
+            # Unresized images keep the source's metadata
+            output = StringIO()
+            processor_pil.pipeline(StringIO(source.getvalue()), output,
+                                   'png', encoder=encoder)
+            im = Image.open(StringIO(output.getvalue()))
+            self.assertEqual('icc_profile' in im.info, not stripped)
+
+    def testTargetBytes(self):
+        full_size = len(self.resize(quality=95))
+        target = full_size // 2
+        output = self.resize(quality=95, encoder={'target_bytes': target})
+        self.assertTrue(len(output) <= target)
+        # As good as fits
+        self.assertTrue(len(self.resize(quality=95, encoder={
+            'target_bytes': len(output) - 1})) < len(output))
+        # Images which already fit are left alone
+        self.assertEqual(len(self.resize(quality=95, encoder={
+            'target_bytes': full_size})), full_size)
+
+    def testSiteDefaults(self):
+        settings.AGILETHUMBS_ENCODER = {'progressive': True}
+        im = Image.open(StringIO(self.resize()))
+        self.assertTrue(im.info.get('progressive') or
+                        im.info.get('progression'))
+        im = Image.open(StringIO(self.resize(
+            encoder={'progressive': False})))
+        self.assertFalse(im.info.get('progressive'))
+
+    def testPipeline(self):
+        output = StringIO()
+        processor_pil.pipeline(StringIO(self.source), output, 'png',
+            operations=[('fit', {'width': 100})], encoder={'colors': 16})
+        self.assertEqual(Image.open(StringIO(output.getvalue())).mode, 'P')
+
+    def testUnknownOption(self):
+        self.assertRaises(ImageProcessorError, self.resize,
+                          encoder={'progresive': True})
+
+    def testConvertArguments(self):
+        self.assertEqual(processor_im.encoder_args('jpg'), [])
+        self.assertEqual(processor_im.encoder_args('jpg', {
+            'progressive': True, 'subsampling': '4:2:0', 'strip': True,
+            'target_bytes': 10000}), [
+            '-strip', '-interlace', 'Plane', '-sampling-factor', '4:2:0',
+            '-define', 'jpeg:extent=10000b'])
+        self.assertEqual(processor_im.encoder_args('png', {
+            'colors': 64, 'progressive': True}), ['-colors', '64'])
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs.base import get_style_registry, escape
+from agilethumbs.generate import get_cache_filename, generate_styles
+from agilethumbs.eviction import CacheIndex, record_access
+from agilethumbs.tests.utils import copy_processor
+
+
+def fixed_size_source(file_id):
+    return StringIO('x' * 100)
+
+
+@override_settings()
+class TestEviction(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        settings.AGILETHUMBS_CACHE_DIR = os.path.join(self.tmp_dir, 'cache')
+        settings.AGILETHUMBS_CACHE_INDEX = os.path.join(self.tmp_dir, 'index')
+        settings.AGILETHUMBS_ID_TO_OBJECT = fixed_size_source
+        self.setStyles(1)
+        self.index = CacheIndex()
+    
+    def setStyles(self, version):
+        settings.AGILETHUMBS_STYLES = {
+            'one': (copy_processor, 'jpg', version, {}),
+            'two': (copy_processor, 'jpg', 1, {}),
+        }
+    
+    def cacheFilename(self, object_id, style):
+        style = get_style_registry()[style]
+        return get_cache_filename(**style.params(escape(object_id)))
+    
+    def testEvictLeastRecentlyUsed(self):
+        for object_id in [u'a', u'b', u'c']:
+            generate_styles(escape(object_id), ['one'])
+        record_access(self.cacheFilename(u'a', 'one'))
+        self.assertEqual(self.index.evict(200), (1, 100))
+        self.assertTrue(os.path.exists(self.cacheFilename(u'a', 'one')))
+        self.assertFalse(os.path.exists(self.cacheFilename(u'b', 'one')))
+        self.assertTrue(os.path.exists(self.cacheFilename(u'c', 'one')))
+        self.assertEqual(self.index.evict(200), (0, 0))
+    
+    def testEvictLeastFrequentlyUsed(self):
+        for object_id in [u'a', u'b']:
+            generate_styles(escape(object_id), ['one'])
+        for i in range(2):
+            record_access(self.cacheFilename(u'a', 'one'))
+        record_access(self.cacheFilename(u'b', 'one'))
+        self.assertEqual(self.index.evict(100, 'lfu'), (1, 100))
+        self.assertFalse(os.path.exists(self.cacheFilename(u'b', 'one')))
+    
+    def testPurgeOldVersions(self):
+        generate_styles(escape(u'a'), ['one', 'two'])
+        old_filename = self.cacheFilename(u'a', 'one')
+        self.setStyles(2)
+        self.assertEqual(self.index.purge_old_versions(), (1, 100))
+        self.assertFalse(os.path.exists(old_filename))
+        self.assertTrue(os.path.exists(self.cacheFilename(u'a', 'two')))
+    
+    def testPurgeKeepsVariants(self):
+        generate_styles(escape(u'a'), ['one_400w', 'two', 'two_200w'])
+        old_filename = self.cacheFilename(u'a', 'one_400w')
+        self.setStyles(2)
+        self.assertEqual(self.index.purge_old_versions(), (1, 100))
+        self.assertFalse(os.path.exists(old_filename))
+        for style in ('two', 'two_200w'):
+            self.assertTrue(os.path.exists(self.cacheFilename(u'a', style)))
+    
+    def testScan(self):
+        generate_styles(escape(u'a/b'), ['one', 'two'])
+        os.unlink(settings.AGILETHUMBS_CACHE_INDEX + '.log')
+        self.index.scan()
+        self.assertEqual(self.index.total_size(), 200)
+    
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,157 @@
+import os
+import errno
+import signal
+import resource
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, processor_pil
+from agilethumbs.base import escape
+from agilethumbs.failures import clear_failures, get_failure_cache
+from agilethumbs.tests.utils import NamedObject
+
+
+def large_processor(infile, outfile, extension):
+    outfile.write('x' * 100000)
+
+
+class FullStorage(FileSystemStorage):
+
+    def _save(self, name, content):
+        raise IOError(errno.ENOSPC, 'No space left on device')
+
+
+@override_settings()
+class TestFailures(TestCase):
+
+    urls = 'agilethumbs.tests.image_request'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.reads = 0
+        self.source = None
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 1,
+                      {'width': 10}),
+        }
+        get_failure_cache().clear()
+
+    def id_to_object(self, file_id):
+        self.reads += 1
+        if self.source is None:
+            raise IOError('No such file: %s' % file_id)
+        return StringIO(self.source)
+
+    def testMissingSource(self):
+        url = image_url(NamedObject(u'missing'), 'small')
+        for i in range(3):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.reads, 1)
+
+    def testUnreadableSource(self):
+        self.source = 'not an image'
+        url = image_url(NamedObject(u'broken'), 'small')
+        for i in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.reads, 1)
+
+    def testOutputErrorsNotRemembered(self):
+        settings.AGILETHUMBS_CACHE_BACKEND = 'agilethumbs.backends.StorageCache'
+        settings.AGILETHUMBS_CACHE_BACKEND_OPTIONS = {
+            'storage': FullStorage(location=self.tmp_dir)}
+        source = StringIO()
+        processor_pil.Image.new('RGB', (20, 20)).save(source, 'PNG')
+        self.source = source.getvalue()
+        url = image_url(NamedObject(u'full'), 'small')
+        for i in range(2):
+            self.assertRaises(IOError, self.client.get, url)
+        self.assertEqual(self.reads, 2)
+
+    def testFileSystemErrorsNotRemembered(self):
+        self.source = 'source'
+        settings.AGILETHUMBS_STYLES = {
+            'large': (large_processor, 'png', 1, {}),
+        }
+        url = image_url(NamedObject(u'large'), 'large')
+        # Writes beyond the limit fail with EFBIG rather than a signal
+        handler = signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+        limit = resource.getrlimit(resource.RLIMIT_FSIZE)
+        resource.setrlimit(resource.RLIMIT_FSIZE, (4096, limit[1]))
+        try:
+            self.assertRaises(IOError, self.client.get, url)
+        finally:
+            resource.setrlimit(resource.RLIMIT_FSIZE, limit)
+            signal.signal(signal.SIGXFSZ, handler)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.reads, 2)
+
+    def testPlaceholder(self):
+        placeholder = os.path.join(self.tmp_dir, 'placeholder.png')
+        with open(placeholder, 'wb') as f:
+            f.write('placeholder image')
+        settings.AGILETHUMBS_FAILURE_PLACEHOLDER = placeholder
+        response = self.client.get(image_url(NamedObject(u'missing'),
+                                             'small'))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.content, 'placeholder image')
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+    def testClearFailures(self):
+        url = image_url(NamedObject(u'replaced'), 'small')
+        self.client.get(url)
+        im = processor_pil.Image.new('RGB', (20, 20))
+        source = StringIO()
+        im.save(source, 'PNG')
+        self.source = source.getvalue()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        clear_failures(escape(u'replaced'))
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.reads, 2)
+
+    def testClearVariantFailures(self):
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 1,
+                      {'width': 10, 'height': 10}),
+        }
+        url = image_url(NamedObject(u'replaced'), 'small_20w')
+        self.client.get(url)
+        im = processor_pil.Image.new('RGB', (40, 40))
+        source = StringIO()
+        im.save(source, 'PNG')
+        self.source = source.getvalue()
+        clear_failures(escape(u'replaced'))
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.reads, 2)
+
+    def testVersionBump(self):
+        self.client.get(image_url(NamedObject(u'missing'), 'small'))
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 2,
+                      {'width': 10}),
+        }
+        self.client.get(image_url(NamedObject(u'missing'), 'small'))
+        self.assertEqual(self.reads, 2)
+
+    def testDisabled(self):
+        settings.AGILETHUMBS_FAILURE_TTL = 0
+        url = image_url(NamedObject(u'missing'), 'small')
+        for i in range(2):
+            self.client.get(url)
+        self.assertEqual(self.reads, 2)
+
+    def tearDown(self):
+        get_failure_cache().clear()
+        shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, processor_pil
+from agilethumbs.base import get_style_registry, escape, parse_cache_filename
+from agilethumbs.formats import parse_accept, negotiate, variant_extensions
+from agilethumbs.generate import generate_styles
+from agilethumbs.tests.utils import NamedObject
+
+
+def webp_only(infile, outfile, extension):
+    pass
+
+webp_only.can_encode = lambda extension: extension == 'webp'
+
+
+def plain_processor(infile, outfile, extension):
+    pass
+
+
+@override_settings()
+class TestNegotiation(TestCase):
+    
+    def testParseAccept(self):
+        self.assertEqual(parse_accept('image/avif,image/webp;q=0.8, */*'),
+                         {'image/avif': 1.0, 'image/webp': 0.8, '*/*': 1.0})
+        self.assertEqual(parse_accept(''), {})
+        self.assertEqual(parse_accept('image/webp;q=x'), {'image/webp': 0})
+    
+    def testNegotiate(self):
+        accept = 'image/avif,image/webp,image/*,*/*;q=0.8'
+        self.assertEqual(negotiate(webp_only, accept), 'webp')
+        self.assertEqual(negotiate(webp_only, 'image/webp;q=0'), 'jpg')
+        self.assertEqual(negotiate(webp_only, '*/*'), 'jpg')
+        self.assertEqual(negotiate(plain_processor, accept), 'jpg')
+        settings.AGILETHUMBS_AUTO_FALLBACK = 'png'
+        self.assertEqual(negotiate(webp_only, 'image/avif'), 'png')
+    
+    def testVariants(self):
+        self.assertEqual(variant_extensions(webp_only), ['webp', 'jpg'])
+        self.assertEqual(variant_extensions(plain_processor), ['jpg'])
+
+
+@override_settings()
+class TestAutoFormat(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        source = StringIO()
+        processor_pil.Image.new('RGB', (300, 200)).save(source, 'PNG')
+        self.source = source.getvalue()
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = lambda file_id: StringIO(
+            self.source)
+        settings.AGILETHUMBS_STYLES = {
+            'auto': ('agilethumbs.processor_pil.simple_resize', 'auto', 1,
+                     {'width': 30}),
+        }
+        # Offer a format PIL can't write, to check that it's skipped
+        settings.AGILETHUMBS_AUTO_FORMATS = ('bogus', 'webp')
+    
+    def get(self, accept):
+        url = image_url(NamedObject(u'image'), 'auto')
+        response = self.client.get(url, HTTP_ACCEPT=accept)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Vary'], 'Accept')
+        return response
+    
+    def imageFormat(self, response):
+        return processor_pil.Image.open(StringIO(response.content)).format
+    
+    def testNegotiated(self):
+        if not processor_pil.can_encode('webp'):
+            self.skipTest('PIL was built without WebP support')
+        response = self.get('image/bogus,image/webp,*/*')
+        self.assertEqual(self.imageFormat(response), 'WEBP')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        response = self.get('*/*')
+        self.assertEqual(self.imageFormat(response), 'JPEG')
+        # Each format is cached separately
+        names = sorted(os.listdir(self.tmp_dir))
+        self.assertEqual([name.rsplit('.', 2)[1:] for name in names],
+                         [['auto', 'jpg'], ['auto', 'webp']])
+        for name in names:
+            params = parse_cache_filename(name)
+            self.assertEqual(params['extension'], 'auto')
+            self.assertEqual(params['variant'], name.rsplit('.', 1)[1])
+    
+    def testGenerateVariants(self):
+        self.assertEqual(generate_styles(u'image', ['auto']), ['auto'])
+        style = get_style_registry()['auto']
+        extensions = [extension for (extension, name)
+                      in style.cache_names(escape(u'image'))]
+        self.assertEqual(len(os.listdir(self.tmp_dir)), len(extensions))
+        self.assertTrue('jpg' in extensions)
+        self.assertFalse('bogus' in extensions)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
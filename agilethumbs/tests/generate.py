@@ -0,0 +1,94 @@
+import os
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, processor_pil
+from agilethumbs.base import get_style_registry, escape
+from agilethumbs.generate import generate_styles, get_cache_filename
+from agilethumbs.failures import get_failure_cache
+from agilethumbs.tests.utils import NamedObject, copy_processor
+
+
+@override_settings()
+class TestGenerateStyles(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.reads = []
+        get_failure_cache().clear()
+        source = StringIO()
+        processor_pil.Image.new('RGB', (1200, 800)).save(source, 'JPEG')
+        self.source = source.getvalue()
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'large': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                      {'width': 400}),
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 1,
+                      {'width': 100}),
+            'square': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                       {'width': 50, 'height': 50, 'resize': 'fill'}),
+            'copy': (copy_processor, 'jpg', 1, {}),
+        }
+    
+    def id_to_object(self, file_id):
+        self.reads.append(file_id)
+        return StringIO(self.source)
+    
+    def cacheFilename(self, style):
+        style = get_style_registry()[style]
+        return get_cache_filename(**style.params(escape(u'image')))
+    
+    def assertImageSize(self, style, size):
+        im = processor_pil.Image.open(self.cacheFilename(style))
+        self.assertEqual(im.size, size)
+    
+    def testSingleRead(self):
+        created = generate_styles(u'image', ['large', 'small', 'square',
+                                             'copy'])
+        self.assertEqual(sorted(created), ['copy', 'large', 'small',
+                                           'square'])
+        self.assertEqual(self.reads, [u'image'])
+        self.assertImageSize('large', (400, 266))
+        self.assertImageSize('small', (100, 66))
+        self.assertImageSize('square', (50, 50))
+        with open(self.cacheFilename('copy'), 'rb') as f:
+            self.assertEqual(f.read(), self.source)
+    
+    def testExistingSkipped(self):
+        generate_styles(u'image', ['large'])
+        created = generate_styles(u'image', ['large', 'small'])
+        self.assertEqual(created, ['small'])
+    
+    def testSiblingsGeneratedOnMiss(self):
+        settings.AGILETHUMBS_SIBLING_STYLES = [('large', 'small')]
+        response = self.client.get(image_url(NamedObject(u'image'), 'small'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(os.path.exists(self.cacheFilename('large')))
+        self.assertFalse(os.path.exists(self.cacheFilename('square')))
+        self.assertEqual(self.reads, [u'image'])
+    
+    def testBrokenSibling(self):
+        settings.AGILETHUMBS_STYLES['broken'] = (
+            'agilethumbs.processor_pil.simple_resize', 'png', 1,
+            {'width': 50, 'height': 50, 'resize': 'pad',
+             'background': 'not a colour'})
+        settings.AGILETHUMBS_SIBLING_STYLES = [('small', 'broken')]
+        url = image_url(NamedObject(u'image'), 'small')
+        for i in range(2):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        self.assertFalse(os.path.exists(self.cacheFilename('broken')))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
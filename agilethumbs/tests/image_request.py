@@ -6,13 +6,19 @@ from StringIO import StringIO
 from django.test import TestCase
 from django.conf import settings
 from django.conf.urls.defaults import patterns, include, url
+from django.core.urlresolvers import resolve
+from django.http import Http404
+from django.test.client import RequestFactory
 from django.template import Template, Context
 try:
     from django.test.utils import override_settings
 except ImportError:
     from agilethumbs.tests.utils import override_settings
 
-from agilethumbs import image_url
+from agilethumbs import image_url, image_urls
+from agilethumbs.concurrency import processing_slot
+from agilethumbs.backends import image_etag
+from agilethumbs.generate import SignatureMismatchError
 
 URL_PREFIX = 'agilethumbs'
 
@@ -68,6 +74,84 @@ class TestImageRequest(TestCase):
         with open(cache_path, 'rb') as f:
             self.assertEqual(f.read(), self.contents)
     
+    def testSendfile(self):
+        url = image_url(self.fileobj, 'test')
+        cache_url = url[len('/%s/' % URL_PREFIX):]
+        settings.AGILETHUMBS_SENDFILE_HEADER = 'X-Sendfile'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['X-Sendfile'],
+                         os.path.join(self.tmp_dir, cache_url))
+        settings.AGILETHUMBS_SENDFILE_HEADER = 'X-Accel-Redirect'
+        settings.AGILETHUMBS_SENDFILE_PREFIX = '/internal-thumbs/'
+        response = self.client.get(url)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/internal-thumbs/' + cache_url)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+    
+    def testCachingHeaders(self):
+        url = image_url(self.fileobj, 'test')
+        response = self.client.get(url)
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        etag = response['ETag']
+        self.assertEqual(self.client.get(url)['ETag'], etag)
+        settings.AGILETHUMBS_CACHE_CONTROL = None
+        self.assertFalse(self.client.get(url).has_header('Cache-Control'))
+    
+    def testNotModified(self):
+        url = image_url(self.fileobj, 'test')
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        # Answered without looking for the file
+        os.unlink(os.path.join(self.tmp_dir, url[len('/%s/' % URL_PREFIX):]))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+    
+    def testNotModifiedChecksURL(self):
+        def get(url):
+            match = resolve(url)
+            etag = image_etag(url[len('/%s/' % URL_PREFIX):])
+            request = RequestFactory().get(url, HTTP_IF_NONE_MATCH=etag)
+            return match.func(request, **match.kwargs)
+        url = image_url(self.fileobj, 'test')
+        self.assertEqual(get(url).status_code, 304)
+        self.assertRaises(SignatureMismatchError, get,
+                          url.replace('-1-', '-2-'))
+        # Outdated versions
+        settings.AGILETHUMBS_STYLES = {
+            'test': (self.image_processor, self.extension, 2,
+                     self.processor_kwargs)
+        }
+        self.assertRaises(Http404, get, url)
+    
+    def testHead(self):
+        url = image_url(self.fileobj, 'test')
+        response = self.client.head(url)
+        self.assertEqual(response.status_code, 200)
+        self.client.get(url)
+        response = self.client.head(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.contents)))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(response.has_header('ETag'))
+    
+    def testBusy(self):
+        settings.AGILETHUMBS_PROCESSING_LIMIT = 1
+        settings.AGILETHUMBS_PROCESSING_QUEUE = 0
+        settings.AGILETHUMBS_SLOT_DIR = os.path.join(self.tmp_dir, 'slots')
+        url = image_url(self.fileobj, 'test')
+        with processing_slot():
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response.has_header('Retry-After'))
+        # Once the slot is free the image is generated as normal
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+    
     def testTemplateTag(self):
         url = image_url(self.fileobj, 'test')
         template = Template("{% load agilethumbs %}"
@@ -75,6 +159,20 @@ class TestImageRequest(TestCase):
         tag_url = template.render(Context({'fileobj': self.fileobj}))
         self.assertEqual(url, tag_url)
     
+    def testBulkURLs(self):
+        fileobjs = [self.fileobj, self.fileobj]
+        urls = image_urls(fileobjs, ['test'])
+        self.assertEqual(urls, [{'test': image_url(self.fileobj, 'test')}] * 2)
+    
+    def testBulkTemplateTag(self):
+        url = image_url(self.fileobj, 'test')
+        template = Template("{% load agilethumbs %}"
+                            "{% image_urls fileobjs 'test' as image_list %}"
+                            "{% for image, urls in image_list %}"
+                            "{{ urls.test }};{% endfor %}")
+        output = template.render(Context({'fileobjs': [self.fileobj] * 2}))
+        self.assertEqual(output, '%s;%s;' % (url, url))
+    
     def tearDown(self):
         shutil.rmtree(self.tmp_dir)
     
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import shutil
+
+from django.test import TestCase
+from django.conf import settings
+from django.core.management import call_command
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs.base import (get_style_registry, escape, cache_path,
+    parse_cache_filename)
+from agilethumbs.generate import get_cache_filename, generate_styles
+from agilethumbs.tests.utils import copy_processor, id_to_object
+
+
+@override_settings()
+class TestShardedLayout(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'test': (copy_processor, 'jpg', 1, {}),
+        }
+        self.params = get_style_registry()['test'].params(escape(u'a/b'))
+    
+    def testShardedPath(self):
+        settings.AGILETHUMBS_CACHE_LAYOUT = 'sharded'
+        path = cache_path(**self.params)
+        signature = self.params['signature']
+        self.assertEqual(path, '%s/%s/%s' % (
+            signature[:2], signature[2:4],
+            cache_path(layout='flat', **self.params)))
+        self.assertEqual(parse_cache_filename(path), self.params)
+        self.assertIsNone(parse_cache_filename(path, 'flat'))
+        self.assertIsNone(parse_cache_filename('zz/zz/' + path.split('/', 2)[2]))
+    
+    def testMigrate(self):
+        generate_styles(self.params['file_id'], ['test'])
+        flat_filename = get_cache_filename(**self.params)
+        settings.AGILETHUMBS_CACHE_LAYOUT = 'sharded'
+        call_command('agilethumbs_migrate_layout', to='sharded', verbosity=0)
+        self.assertFalse(os.path.exists(flat_filename))
+        with open(get_cache_filename(**self.params), 'rb') as f:
+            self.assertEqual(f.read(),
+                             'contents of %s' % self.params['file_id'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'a')))
+        call_command('agilethumbs_migrate_layout', to='flat', verbosity=0)
+        self.assertTrue(os.path.exists(flat_filename))
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import resource
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import ImageProcessorError, processor_pil, limits, pool
+from agilethumbs.generate import generate_styles, create_cached_file
+from agilethumbs.backends import get_cache_backend
+from agilethumbs.base import get_style_registry
+from agilethumbs.processor_im import has_convert
+
+
+def get_pid(infile, outfile, extension):
+    outfile.write(str(os.getpid()))
+
+def allocate(infile, outfile, extension):
+    outfile.write('x' * (1024 * 1024 * 1024))
+
+def spin(infile, outfile, extension):
+    while True:
+        pass
+
+class UnreadableFile(StringIO):
+    # Fails the test if the source is read
+
+    def read(self, *args):
+        raise AssertionError('Oversized source was read')
+
+
+def address_space():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+
+@override_settings()
+class TestLimits(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 1,
+                      {'width': 30}),
+            'large': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                      {'width': 100}),
+        }
+        source = StringIO()
+        processor_pil.Image.new('RGB', (300, 200)).save(source, 'PNG')
+        self.source = source.getvalue()
+
+    def id_to_object(self, file_id):
+        return StringIO(self.source)
+
+    def resize(self):
+        output = StringIO()
+        processor_pil.simple_resize(StringIO(self.source), output, 'png',
+                                    width=30)
+        return output
+
+    def testMaxPixels(self):
+        settings.AGILETHUMBS_MAX_PIXELS = 300 * 200
+        self.assertTrue(self.resize().getvalue())
+        settings.AGILETHUMBS_MAX_PIXELS = 300 * 200 - 1
+        self.assertRaises(ImageProcessorError, self.resize)
+
+    def testMaxSourceBytes(self):
+        settings.AGILETHUMBS_MAX_SOURCE_BYTES = len(self.source)
+        self.assertTrue(self.resize().getvalue())
+        settings.AGILETHUMBS_MAX_SOURCE_BYTES = len(self.source) - 1
+        self.assertRaises(ImageProcessorError, self.resize)
+
+    def testMaxSourceBytesBeforeReading(self):
+        settings.AGILETHUMBS_MAX_SOURCE_BYTES = len(self.source) - 1
+        settings.AGILETHUMBS_ID_TO_OBJECT = lambda file_id: UnreadableFile(
+            self.source)
+        self.assertRaises(ImageProcessorError, generate_styles, u'image',
+                          ['small'])
+        settings.AGILETHUMBS_SANDBOX_WORKERS = 1
+        self.assertRaises(ImageProcessorError, create_cached_file, 'sandboxed',
+                          u'image', get_pid, {}, 'txt')
+
+    def testFileSize(self):
+        with open(os.path.join(self.tmp_dir, 'source.png'), 'wb') as f:
+            f.write(self.source)
+        with open(f.name, 'rb') as f:
+            self.assertEqual(limits.file_size(f), len(self.source))
+        self.assertEqual(limits.file_size(StringIO(self.source)),
+                         len(self.source))
+
+    def testSandbox(self):
+        settings.AGILETHUMBS_SANDBOX_WORKERS = 1
+        self.assertEqual(generate_styles(u'image', ['small', 'large']),
+                         ['small', 'large'])
+        backend = get_cache_backend()
+        for extension, name in get_style_registry()['small'].cache_names(
+                u'image'):
+            path = backend.path(name)
+            self.assertEqual(processor_pil.Image.open(path).size, (30, 20))
+        self.assertTrue(create_cached_file('sandboxed', u'image', get_pid, {},
+                                           'txt'))
+        with open(os.path.join(self.tmp_dir, 'sandboxed')) as f:
+            self.assertNotEqual(int(f.read()), os.getpid())
+
+    def testSandboxImageMagick(self):
+        # Outputs come back from the worker in memory
+        if not has_convert():
+            self.skipTest('ImageMagick is not installed')
+        settings.AGILETHUMBS_SANDBOX_WORKERS = 1
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_im.simple_resize', 'png', 1,
+                      {'width': 30}),
+        }
+        self.assertEqual(generate_styles(u'image', ['small']), ['small'])
+        extension, name = get_style_registry()['small'].cache_names(
+            u'image')[0]
+        path = get_cache_backend().path(name)
+        self.assertEqual(processor_pil.Image.open(path).size, (30, 20))
+
+    def testSandboxMemoryLimit(self):
+        settings.AGILETHUMBS_SANDBOX_WORKERS = 1
+        settings.AGILETHUMBS_SANDBOX_MEMORY = (address_space() +
+                                               256 * 1024 * 1024)
+        self.assertRaises(ImageProcessorError, create_cached_file,
+                          'allocated', u'image', allocate, {}, 'txt')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmp_dir, 'allocated')))
+
+    def testSandboxCPULimit(self):
+        settings.AGILETHUMBS_SANDBOX_WORKERS = 1
+        settings.AGILETHUMBS_SANDBOX_CPU = 1
+        self.assertRaises(ImageProcessorError, create_cached_file,
+                          'spun', u'image', spin, {}, 'txt')
+        # The worker is replaced
+        self.assertTrue(create_cached_file('sandboxed', u'image', get_pid, {},
+                                           'txt'))
+
+    def tearDown(self):
+        for key in list(pool._pools):
+            if key[0] == limits.__name__:
+                pool._pools.pop(key).close()
+        shutil.rmtree(self.tmp_dir)
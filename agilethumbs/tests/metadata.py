@@ -0,0 +1,103 @@
+import os
+import tempfile
+import shutil
+
+from django.test import TestCase
+from django.conf import settings
+from django.template import Template, Context
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, processor_pil
+from agilethumbs.generate import generate_styles
+from agilethumbs.metadata import (source_metadata, image_dimensions,
+    predict_size, clear_source_metadata, get_metadata_cache)
+from agilethumbs.tests.utils import NamedObject
+
+
+@override_settings()
+class TestMetadata(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_name = os.path.join(self.tmp_dir, 'source.png')
+        processor_pil.Image.new('RGB', (600, 400)).save(self.source_name)
+        self.image = NamedObject(u'photo')
+        self.opened = 0
+        get_metadata_cache().clear()
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'fit': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                    {'width': 150}),
+            'fill': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                     {'width': 50, 'height': 50, 'resize': 'fill'}),
+            'card': ('agilethumbs.processor_pil.pipeline', 'jpg', 1,
+                     {'operations': [('fit', {'height': 100}), 'sharpen']}),
+        }
+    
+    def id_to_object(self, file_id):
+        self.opened += 1
+        return open(self.source_name, 'rb')
+    
+    def testRecordedByProcessing(self):
+        self.assertIsNone(source_metadata(self.image))
+        self.assertIsNone(image_dimensions(self.image, 'fit'))
+        self.client.get(image_url(self.image, 'fit'))
+        metadata = source_metadata(self.image)
+        self.assertEqual((metadata['width'], metadata['height']), (600, 400))
+        self.assertEqual(metadata['format'], 'PNG')
+        self.assertEqual(metadata['mtime'],
+                         os.path.getmtime(self.source_name))
+        opened = self.opened
+        self.assertEqual(image_dimensions(self.image, 'fit'),
+                         {'width': 150, 'height': 100})
+        self.assertEqual(image_dimensions(self.image, 'fill'),
+                         {'width': 50, 'height': 50})
+        self.assertEqual(image_dimensions(self.image, 'card'),
+                         {'width': 150, 'height': 100})
+        self.assertEqual(image_dimensions(self.image, 'fit_2x'),
+                         {'width': 300, 'height': 200})
+        self.assertEqual(self.opened, opened)
+    
+    def testRecordedByGenerateStyles(self):
+        generate_styles(u'photo', ['fit', 'fill'])
+        metadata = source_metadata(self.image)
+        self.assertEqual(metadata['width'], 600)
+        self.assertEqual(metadata['mtime'],
+                         os.path.getmtime(self.source_name))
+        clear_source_metadata(u'photo')
+        self.assertIsNone(source_metadata(self.image))
+    
+    def testFetch(self):
+        metadata = source_metadata(self.image, fetch=True)
+        self.assertEqual(metadata['height'], 400)
+        self.assertEqual(self.opened, 1)
+        source_metadata(self.image, fetch=True)
+        self.assertEqual(self.opened, 1)
+    
+    def testPredictSize(self):
+        self.assertEqual(predict_size((600, 400), {'width': 900}), (600, 400))
+        self.assertEqual(predict_size((600, 400), {'height': 40,
+                                                   'width': ''}), (60, 40))
+        self.assertEqual(predict_size((600, 400), {}), (600, 400))
+        self.assertEqual(predict_size((600, 400), {
+            'width': 70, 'height': 30, 'resize': 'squash'}), (70, 30))
+        self.assertIsNone(predict_size((600, 400), {
+            'operations': ['myapp.ops.crop']}))
+    
+    def testTemplateTag(self):
+        generate_styles(u'photo', ['fit'])
+        template = Template("{% load agilethumbs %}"
+                            "{% image_dimensions image 'fill' as dims %}"
+                            "{{ dims.width }}x{{ dims.height }}")
+        self.assertEqual(template.render(Context({'image': self.image})),
+                         '50x50')
+    
+    def tearDown(self):
+        get_metadata_cache().clear()
+        shutil.rmtree(self.tmp_dir)
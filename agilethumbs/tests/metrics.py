@@ -0,0 +1,78 @@
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, processor_pil, metrics
+from agilethumbs.generate import generate_styles
+from agilethumbs.failures import get_failure_cache
+from agilethumbs.tests.utils import NamedObject
+
+
+@override_settings()
+class TestMetrics(TestCase):
+
+    urls = 'agilethumbs.tests.image_request'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        source = StringIO()
+        processor_pil.Image.new('RGB', (300, 200)).save(source, 'JPEG')
+        self.source = source.getvalue()
+        get_failure_cache().clear()
+        self.collector = metrics.MemoryCollector()
+        settings.AGILETHUMBS_METRICS = self.collector
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'small': ('agilethumbs.processor_pil.simple_resize', 'png', 1,
+                      {'width': 30}),
+            'large': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                      {'width': 100}),
+        }
+
+    def id_to_object(self, file_id):
+        if file_id == u'missing':
+            raise IOError('No such file')
+        return StringIO(self.source)
+
+    def testRequest(self):
+        url = image_url(NamedObject(u'image'), 'small')
+        for i in range(2):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.collector.counters['miss'], 1)
+        self.assertEqual(self.collector.counters['hit'], 1)
+        self.assertTrue(self.collector.counters['bytes_out'] > 0)
+        self.assertEqual(self.collector.counters['bytes_in'],
+                         len(self.source))
+        for name in ('miss', 'fetch', 'process', 'decode', 'resize',
+                     'encode', 'write'):
+            self.assertEqual(len(self.collector.timings[name]), 1)
+
+    def testError(self):
+        url = image_url(NamedObject(u'missing'), 'small')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.collector.counters['error'], 1)
+        self.assertFalse('miss' in self.collector.timings)
+
+    def testGenerateStyles(self):
+        generate_styles(u'image', ['small', 'large'])
+        self.assertEqual(self.collector.counters['bytes_in'],
+                         len(self.source))
+        self.assertEqual(len(self.collector.timings['decode']), 1)
+        self.assertEqual(len(self.collector.timings['encode']), 2)
+
+    def testDisabled(self):
+        settings.AGILETHUMBS_METRICS = None
+        self.assertTrue(metrics.timer('decode') is metrics.NULL_TIMER)
+        generate_styles(u'image', ['small'])
+        self.assertEqual(self.collector.timings, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
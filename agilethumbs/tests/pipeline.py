@@ -0,0 +1,99 @@
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from agilethumbs import processor_im, processor_pil, ImageProcessorError
+
+Image = processor_pil.Image
+
+
+def invert(im):
+    return processor_pil.ImageOps.invert(im)
+
+
+class TestPipelinePIL(TestCase):
+    
+    def setUp(self):
+        source = StringIO()
+        im = Image.new('RGB', (300, 200), (200, 50, 50))
+        im.paste((50, 50, 200), (150, 0, 300, 200))
+        im.save(source, 'PNG')
+        self.source = source.getvalue()
+    
+    def run_pipeline(self, operations, extension='png'):
+        outfile = StringIO()
+        processor_pil.pipeline(StringIO(self.source), outfile, extension,
+                               operations)
+        outfile.seek(0)
+        return Image.open(outfile)
+    
+    def testResize(self):
+        im = self.run_pipeline([('fill', {'width': 50, 'height': 50})])
+        self.assertEqual(im.size, (50, 50))
+        im = self.run_pipeline([('fit', {'width': 60})])
+        self.assertEqual(im.size, (60, 40))
+    
+    def testChain(self):
+        im = self.run_pipeline([
+            ('fit', {'width': 150}),
+            'grayscale',
+            ('sharpen', {'radius': 2}),
+            ('blur', {'radius': 1}),
+        ])
+        self.assertEqual(im.size, (150, 100))
+        r, g, b = im.convert('RGB').getpixel((10, 50))
+        self.assertEqual(r, g)
+        self.assertEqual(g, b)
+    
+    def testCustomOperations(self):
+        im = self.run_pipeline([('squash', {'width': 10, 'height': 10}),
+                                'agilethumbs.tests.pipeline.invert'])
+        self.assertEqual(im.convert('RGB').getpixel((0, 5)), (55, 205, 205))
+        im = self.run_pipeline([invert])
+        self.assertEqual(im.size, (300, 200))
+    
+    def testWatermark(self):
+        mark = StringIO()
+        Image.new('RGBA', (20, 10), (0, 255, 0, 255)).save(mark, 'PNG')
+        mark.seek(0)
+        im = self.run_pipeline([('watermark', {'path': mark, 'margin': 5,
+                                               'position': 'top-left'})])
+        im = im.convert('RGB')
+        self.assertEqual(im.getpixel((5, 5)), (0, 255, 0))
+        self.assertEqual(im.getpixel((30, 5)), (200, 50, 50))
+    
+    def testUnknownOperation(self):
+        self.assertRaises(ImageProcessorError, self.run_pipeline, ['sepia'])
+        self.assertRaises(ImageProcessorError, self.run_pipeline,
+                          ['agilethumbs.tests.pipeline.missing'])
+    
+    def testSimpleResizeUsesOperations(self):
+        outfile = StringIO()
+        processor_pil.simple_resize(StringIO(self.source), outfile, 'png',
+                                    width=40, height=40, resize='pad',
+                                    background='#ffffff')
+        outfile.seek(0)
+        im = Image.open(outfile)
+        self.assertEqual(im.size, (40, 40))
+        self.assertEqual(im.getpixel((0, 0)), (255, 255, 255, 255))
+
+
+class TestPipelineArgsIM(TestCase):
+    
+    def testResizeArgs(self):
+        self.assertEqual(processor_im.fit(100, ''), ['-thumbnail', '100x'])
+        self.assertEqual(processor_im.fit(None, 50), ['-thumbnail', 'x50'])
+        self.assertEqual(processor_im.fit(), [])
+        self.assertEqual(processor_im.squash(30, 20),
+                         ['-thumbnail', '30x20!'])
+    
+    def testOperationArgs(self):
+        get_operation = processor_im.get_operation
+        self.assertEqual(get_operation('grayscale')(),
+                         ['-colorspace', 'Gray'])
+        self.assertEqual(get_operation('blur')(radius=3), ['-blur', '0x3'])
+        self.assertEqual(processor_im.watermark('/tmp/mark.png')[:3],
+                         ['/tmp/mark.png', '-gravity', 'SouthEast'])
+        self.assertRaises(ImageProcessorError, processor_im.watermark,
+                          '/tmp/mark[0].png')
+        self.assertRaises(ImageProcessorError, get_operation, 'sepia')
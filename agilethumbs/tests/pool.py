@@ -0,0 +1,69 @@
+import os
+
+from django.test import TestCase
+
+from agilethumbs import ImageProcessorError
+from agilethumbs.pool import WorkerPool
+
+
+def get_pid():
+    return os.getpid()
+
+def add(a, b=0):
+    return a + b
+
+def fail(message):
+    raise ImageProcessorError(message)
+
+def crash():
+    os._exit(1)
+
+def get_state():
+    return STATE
+
+def noisy():
+    print 'Not part of the result'
+    return 1
+
+STATE = 'initial'
+
+
+class TestWorkerPool(TestCase):
+    
+    def setUp(self):
+        self.pool = WorkerPool(1, max_jobs=3)
+    
+    def testApply(self):
+        self.assertEqual(self.pool.apply(add, 1, b=2), 3)
+        self.assertNotEqual(self.pool.apply(get_pid), os.getpid())
+    
+    def testWorkerReused(self):
+        self.assertEqual(self.pool.apply(get_pid), self.pool.apply(get_pid))
+    
+    def testWorkerRestartedAfterMaxJobs(self):
+        pids = set(self.pool.apply(get_pid) for i in range(6))
+        self.assertEqual(len(pids), 2)
+    
+    def testErrorsPropagate(self):
+        self.assertRaises(ImageProcessorError, self.pool.apply, fail, 'oops')
+        self.assertEqual(self.pool.apply(add, 1), 1)
+    
+    def testCrashedWorkerReplaced(self):
+        self.assertRaises(ImageProcessorError, self.pool.apply, crash)
+        self.assertEqual(self.pool.apply(add, 1), 1)
+    
+    def testFreshInterpreter(self):
+        global STATE
+        STATE = 'changed'
+        try:
+            # Workers aren't forked copies of this process
+            self.assertEqual(self.pool.apply(get_state), 'initial')
+        finally:
+            STATE = 'initial'
+    
+    def testOutputIgnored(self):
+        self.assertEqual(self.pool.apply(noisy), 1)
+        self.assertEqual(self.pool.apply(add, 2), 2)
+    
+    def tearDown(self):
+        self.pool.close()
@@ -3,6 +3,7 @@ import tempfile
 import shutil
 import subprocess
 import re
+from StringIO import StringIO
 
 from django.test import TestCase
 from django.conf import settings
@@ -69,6 +70,59 @@ class TestSimpleResizeIM(TestCase):
     def tearDown(self):
         shutil.rmtree(self.tmp_dir)
 
+class TestConvertArgsIM(TestCase):
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+    
+    def testPathFromFile(self):
+        name = os.path.join(self.tmp_dir, 'image.png')
+        open(name, 'wb').close()
+        with open(name, 'rb') as f:
+            self.assertEqual(processor_im.path_from_file(f), name)
+            self.assertEqual(processor_im.string_arg_from_file(f, name),
+                             'png:' + name)
+            self.assertEqual(processor_im.string_arg_from_file(f), 'png:-')
+    
+    def testNoPathForUnsafeOrMissingFiles(self):
+        name = os.path.join(self.tmp_dir, 'image[0].png')
+        open(name, 'wb').close()
+        with open(name, 'rb') as f:
+            self.assertIsNone(processor_im.path_from_file(f))
+        self.assertIsNone(processor_im.path_from_file(StringIO('data')))
+    
+    def testSizeHints(self):
+        size_hint_args = processor_im.size_hint_args
+        self.assertEqual(size_hint_args(100, '', 'fit'),
+                         ['-define', 'jpeg:size=200x200'])
+        self.assertEqual(size_hint_args(100, 50, 'fill'),
+                         ['-define', 'jpeg:size=200x100'])
+        self.assertEqual(size_hint_args('', '', 'fit'), [])
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
 class TestSimpleResizePIL(TestSimpleResizeIM):
     image_lib = processor_pil
+    
+    def testShrinkOnLoad(self):
+        for ext, im_format in [('jpg', 'JPEG'), ('png', 'PNG')]:
+            self.test_img = self.tmpFile('large.%s' % ext)
+            processor_pil.Image.new('RGB', (3000, 2000)).save(self.test_img,
+                                                              im_format)
+            outfile = self.doResize('jpg', resize='fit', width=100)
+            self.assertImageSize(outfile, (100, 66))
+            outfile = self.doResize('jpg', resize='fill', width=50, height=50)
+            self.assertImageSize(outfile, (50, 50))
+    
+    def testRequiredSize(self):
+        required_size = processor_pil.required_size
+        self.assertEqual(required_size((3000, 2000), 100, None, 'fit'),
+                         (100, 67))
+        self.assertEqual(required_size((3000, 2000), 100, 100, 'fill'),
+                         (150, 100))
+        self.assertEqual(required_size((3000, 2000), 30, 50, 'squash'),
+                         (30, 50))
+        self.assertEqual(required_size((3000, 2000), None, None, 'fit'),
+                         (3000, 2000))
 
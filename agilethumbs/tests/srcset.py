@@ -0,0 +1,105 @@
+import tempfile
+import shutil
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Template, Context
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url, image_srcset, processor_pil
+from agilethumbs.base import get_style_registry
+from agilethumbs.generate import generate_styles
+from agilethumbs.tests.utils import NamedObject
+
+
+@override_settings()
+class TestSrcset(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.reads = 0
+        source = StringIO()
+        processor_pil.Image.new('RGB', (1200, 800)).save(source, 'JPEG')
+        self.source = source.getvalue()
+        self.image = NamedObject(u'photo')
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = self.id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'thumb': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                      {'width': 100, 'height': 50, 'resize': 'fill'}),
+            'tall': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1,
+                     {'height': 100}),
+            'card': ('agilethumbs.processor_pil.pipeline', 'jpg', 1,
+                     {'operations': [('fit', {'width': 200}), 'sharpen']}),
+        }
+    
+    def id_to_object(self, file_id):
+        self.reads += 1
+        return StringIO(self.source)
+    
+    def testVariants(self):
+        registry = get_style_registry()
+        self.assertEqual(registry['thumb_300w'].kwargs,
+                         {'width': 300, 'height': 150, 'resize': 'fill'})
+        self.assertEqual(registry['thumb_2x'].kwargs,
+                         {'width': 200, 'height': 100, 'resize': 'fill'})
+        self.assertEqual(registry['tall_50w'].kwargs, {'width': 50})
+        self.assertEqual(registry['card_400w'].kwargs['operations'],
+                         [('fit', {'width': 400}), 'sharpen'])
+        self.assertEqual(registry['thumb_300w'].version, u'1')
+        self.assertRaises(ImproperlyConfigured, registry.__getitem__,
+                          'missing_300w')
+        self.assertRaises(ImproperlyConfigured, registry.__getitem__,
+                          'thumb_0x')
+    
+    def testSrcset(self):
+        self.assertEqual(image_srcset(self.image, 'thumb', [100, 200]),
+            '%s 100w, %s 200w' % (image_url(self.image, 'thumb_100w'),
+                                  image_url(self.image, 'thumb_200w')))
+        self.assertEqual(image_srcset(self.image, 'thumb',
+                                      densities=[1, '2x']),
+            '%s 1x, %s 2x' % (image_url(self.image, 'thumb'),
+                              image_url(self.image, 'thumb_2x')))
+    
+    def testFractionalDensity(self):
+        self.assertRaises(ImproperlyConfigured, image_srcset, self.image,
+                          'thumb', densities=['1.5x'])
+    
+    def testTemplateTag(self):
+        template = Template("{% load agilethumbs %}"
+                            "{% image_srcset image 'thumb' 100 200 %}|"
+                            "{% image_srcset image 'thumb' '1x' '2x' as s %}"
+                            "{{ s }}")
+        output = template.render(Context({'image': self.image}))
+        self.assertEqual(output, '%s|%s' % (
+            image_srcset(self.image, 'thumb', [100, 200]),
+            image_srcset(self.image, 'thumb', densities=['1x', '2x'])))
+    
+    def testRequestVariant(self):
+        response = self.client.get(image_url(self.image, 'thumb_300w'))
+        self.assertEqual(response.status_code, 200)
+        im = processor_pil.Image.open(StringIO(response.content))
+        self.assertEqual(im.size, (300, 150))
+    
+    def testGenerateVariants(self):
+        created = generate_styles(u'photo', ['thumb_100w', 'thumb_200w',
+                                             'thumb_2x'])
+        self.assertEqual(len(created), 3)
+        self.assertEqual(self.reads, 1)
+    
+    def testVersionBump(self):
+        old_url = image_url(self.image, 'thumb_300w')
+        settings.AGILETHUMBS_STYLES = dict(settings.AGILETHUMBS_STYLES,
+            thumb=('agilethumbs.processor_pil.simple_resize', 'jpg', 2,
+                   {'width': 100, 'height': 50, 'resize': 'fill'}))
+        self.assertNotEqual(image_url(self.image, 'thumb_300w'), old_url)
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
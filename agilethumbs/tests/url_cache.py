@@ -0,0 +1,66 @@
+from django.test import TestCase
+from django.conf import settings
+from django.core.urlresolvers import reverse
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs import image_url
+from agilethumbs.base import (get_style_registry, url_cache_stats,
+    clear_style_registry, escape)
+from agilethumbs.lru import LRUCache
+from agilethumbs.tests.utils import NamedObject
+
+
+@override_settings()
+class TestURLCache(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        settings.AGILETHUMBS_URL_CACHE_SIZE = 10
+        settings.AGILETHUMBS_STYLES = {
+            'test': ('agilethumbs.processor_pil.simple_resize', 'jpg', 1, {}),
+        }
+        clear_style_registry()
+    
+    def testTemplateMatchesReverse(self):
+        file_id = escape(u'some/dir/image name.png')
+        style = get_style_registry()['test']
+        self.assertTrue(style.url_template)
+        self.assertEqual(
+            style.build_url(file_id),
+            reverse('agilethumbs_image', kwargs=style.params(file_id)))
+    
+    def testRepeatedCallsHitCache(self):
+        fileobj = NamedObject(u'image.png')
+        url = image_url(fileobj, 'test')
+        self.assertEqual(url, image_url(fileobj, 'test'))
+        stats = url_cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+    
+    def testSettingsChangeInvalidates(self):
+        fileobj = NamedObject(u'image.png')
+        url = image_url(fileobj, 'test')
+        settings.AGILETHUMBS_STYLES = {
+            'test': ('agilethumbs.processor_pil.simple_resize', 'jpg', 2, {}),
+        }
+        self.assertNotEqual(url, image_url(fileobj, 'test'))
+        settings.SECRET_KEY = settings.SECRET_KEY + 'changed'
+        self.assertNotEqual(url, image_url(fileobj, 'test'))
+
+
+class TestLRUCache(TestCase):
+    
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
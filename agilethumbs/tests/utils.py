@@ -1,14 +1,34 @@
 """
-Borrowed the override_settings function from Django 1.4's django.test.utils
+Helpers shared by the tests. Borrowed the override_settings function from
+Django 1.4's django.test.utils
 """
 
 from __future__ import with_statement
 
 import warnings
+from StringIO import StringIO
 from django.conf import settings, UserSettingsHolder
 from django.utils.functional import wraps
 
 
+class NamedObject(object):
+    """
+    Stands in for a file, identified by its name
+    """
+    def __init__(self, name):
+        self.name = name
+
+
+def copy_processor(infile, outfile, extension):
+    outfile.write(infile.read())
+
+
+def id_to_object(file_id):
+    if file_id == 'missing':
+        raise IOError('No such file')
+    return StringIO('contents of %s' % file_id)
+
+
 class override_settings(object):
     """
     Acts as either a decorator, or a context manager. If it's a decorator it
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import shutil
+
+from django.test import TestCase
+from django.conf import settings
+try:
+    from django.test.utils import override_settings
+except ImportError:
+    from agilethumbs.tests.utils import override_settings
+
+from agilethumbs.base import get_style_registry, escape
+from agilethumbs.views import get_cache_filename
+from agilethumbs.warm import warm
+from agilethumbs.tests.utils import copy_processor, id_to_object
+
+
+@override_settings()
+class TestWarm(TestCase):
+    
+    urls = 'agilethumbs.tests.image_request'
+    
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        settings.AGILETHUMBS_CACHE_DIR = self.tmp_dir
+        settings.AGILETHUMBS_ID_TO_OBJECT = id_to_object
+        settings.AGILETHUMBS_STYLES = {
+            'one': (copy_processor, 'jpg', 1, {}),
+            'two': (copy_processor, 'png', 1, {}),
+        }
+    
+    def cacheFilename(self, object_id, style):
+        style = get_style_registry()[style]
+        return get_cache_filename(**style.params(escape(object_id)))
+    
+    def testWarm(self):
+        counts = warm([u'a/b', u'c'], ['one', 'two'], processes=1)
+        self.assertEqual(counts, {'created': 4, 'exists': 0, 'error': 0})
+        with open(self.cacheFilename(u'a/b', 'two'), 'rb') as f:
+            self.assertEqual(f.read(), 'contents of a/b')
+        counts = warm([u'a/b', u'c'], ['one', 'two'], processes=1)
+        self.assertEqual(counts, {'created': 0, 'exists': 4, 'error': 0})
+    
+    def testWarmInParallel(self):
+        counts = warm([u'a', u'b', u'c', u'd'], ['one'], processes=2)
+        self.assertEqual(counts, {'created': 4, 'exists': 0, 'error': 0})
+        for object_id in [u'a', u'b', u'c', u'd']:
+            self.assertTrue(os.path.exists(self.cacheFilename(object_id,
+                                                              'one')))
+    
+    def testErrorsReported(self):
+        errors = []
+        def callback(status, params, message):
+            if status == 'error':
+                errors.append(params['file_id'])
+        counts = warm([u'missing', u'a'], ['one'], processes=1,
+                      callback=callback)
+        self.assertEqual(counts, {'created': 1, 'exists': 0, 'error': 1})
+        self.assertEqual(errors, ['missing'])
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
@@ -1,109 +1,98 @@
-import os
-import errno
-from contextlib import contextmanager
-from tempfile import mkstemp
+import logging
 
-from django.conf import settings
-from django.http import Http404
-from django.core.urlresolvers import get_callable
-from django.utils._os import safe_join
-from django.views.static import serve as django_serve_static
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import parse_etags
 
-from agilethumbs.base import unescape, id_to_object, sign_params
-from agilethumbs.concurrency import atomic_create
+from agilethumbs.base import cache_path, get_style_registry
+from agilethumbs.formats import AUTO_EXTENSION, negotiate
+from agilethumbs.concurrency import ServerBusy
+from agilethumbs.backends import (get_cache_backend, content_type,
+    image_etag, patch_image_headers)
+from agilethumbs import metrics
+from agilethumbs.failures import (FAILURE_EXCEPTIONS, is_source_failure,
+    has_failed, record_failure, failure_response)
+from agilethumbs.generate import (SignatureMismatchError, create_cached_file,
+    generate_styles, get_sibling_styles, get_cache_filename,
+    get_image_processor)
 
 
-class SignatureMismatchError(Exception):
-    pass
+logger = logging.getLogger(__name__)
 
 
 def agilethumbs_image(request, **kwargs):
-    filename = get_cache_filename(**kwargs)
+    backend = get_cache_backend()
+    auto = kwargs['extension'] == AUTO_EXTENSION
+    if auto:
+        # Serve the best format the client accepts, each cached separately
+        style = get_style_registry().get(kwargs['style'])
+        if style is None:
+            raise Http404()
+        extension = negotiate(style.processor,
+                              request.META.get('HTTP_ACCEPT', ''))
+        name = cache_path(variant=extension, **kwargs)
+    else:
+        name = cache_path(**kwargs)
+    # A client which has any copy of this URL has the current one, as long
+    # as the URL is one we would serve: checking costs no file access
+    if image_etag(name) in parse_etags(
+            request.META.get('HTTP_IF_NONE_MATCH', '')):
+        get_image_processor(**kwargs)
+        metrics.incr('not_modified')
+        return patch_image_headers(HttpResponseNotModified(), name, auto)
     # If the file already exists serve it up
-    if os.path.exists(filename):
-        return serve_file(request, filename)
-    # Allow override of id_to_object function in settings
-    this_id_to_object = get_callable(getattr(
-        settings, 'AGILETHUMBS_ID_TO_OBJECT', id_to_object))
-    processor, processor_kwargs, extension = get_image_processor(**kwargs)
-    # Create file
-    with atomic_create(filename) as outfile:
-        fileobj = this_id_to_object(unescape(kwargs['file_id']))
-        try:
-            processor(fileobj, outfile, extension, **processor_kwargs)
-        finally:
-            if hasattr(fileobj, 'close') and callable(fileobj.close):
-                fileobj.close()
-    # Serve it up
-    return serve_file(request, filename)
-
-
-def get_cache_filename(file_id, style, version, signature, extension):
-    """
-    Return path to cached file for supplied request parameters
-    """
-    cache_url = '%s-%s-%s-%s.%s' % (file_id, style, version, signature,
-                                    extension)
-    cache_path = safe_join(settings.AGILETHUMBS_CACHE_DIR, cache_url)
-    return cache_path
-
-
-def get_image_processor(file_id, style, version, signature, extension):
-    """
-    Validate supplied request parameters and return the relevant image
-    processor function, keyword arguments and extension
-    
-    Raises SignatureMismatchError for invalid signatures or Http404 for valid
-    requests which reference outdated style versions.
-    """
-    # Check the signature
-    if signature != sign_params(file_id, style, version, extension):
-        raise SignatureMismatchError()
-    # Get and check the style details: the valid signature ensures that the
-    # details were correct at time of URL generation, but not that they
-    # haven't changed since
+    if request.method == 'HEAD':
+        # Answered from a single stat where the backend allows
+        size = backend.size(name)
+        if size is not None:
+            metrics.incr('hit')
+            response = HttpResponse(content_type=content_type(name))
+            response['Content-Length'] = str(size)
+            return patch_image_headers(response, name, auto)
+    elif backend.exists(name):
+        metrics.incr('hit')
+        return serve(backend, request, name, auto)
+    processor, processor_kwargs, url_extension = get_image_processor(**kwargs)
+    if not auto:
+        extension = url_extension
+    # Don't keep retrying sources which have just failed
+    if has_failed(name, kwargs['file_id']):
+        metrics.incr('failure_cached')
+        return failure_response()
+    metrics.incr('miss')
+    request_timer = metrics.timer('miss').start()
     try:
-        style_config = settings.AGILETHUMBS_STYLES[style]
-    except KeyError:
-        raise Http404()
-    if version != unicode(style_config[2]):
-        raise Http404()
-    image_processor = get_callable(style_config[0])
-    processor_kwargs = style_config[3]
-    # Extension should be an str, not unicode, for PIL's sake
-    extension = extension.encode('ascii')
-    return (image_processor, processor_kwargs, extension)
-
-
-@contextmanager
-def atomic_create(filename, mode=0660, makedirs=True):
-    """
-    Return a temporary file object to write to and move file into position
-    once creation is complete
-    """
-    directory = os.path.dirname(filename)
-    if makedirs:
-        try:
-            os.makedirs(directory)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
+        # Optionally generate related styles from the same read of the source
+        siblings = get_sibling_styles(kwargs['style'])
+        if siblings:
+            try:
+                generate_styles(kwargs['file_id'], siblings)
+            except ServerBusy:
                 raise
-    tmp_name = mkstemp(dir=directory)[1]
-    tmp_file = open(tmp_name, 'wb')
-    try:
-        # Yield file handle, actual content creation happens here
-        yield tmp_file
-        # Set permissions and move it into place
-        os.chmod(tmp_name, mode)
-        os.rename(tmp_name, filename)
-    except:
-        os.unlink(tmp_name)
-        raise
-    finally:
-        tmp_file.close()
+            except Exception:
+                # Only the requested style has to succeed, and it is tried
+                # on its own below
+                logger.exception('Error generating sibling styles of %s',
+                                 name)
+        if not backend.exists(name):
+            create_cached_file(name, kwargs['file_id'], processor,
+                               processor_kwargs, str(extension))
+    except ServerBusy as e:
+        response = HttpResponse('Too many images being processed, try again '
+                                'later', status=503, content_type='text/plain')
+        response['Retry-After'] = str(e.retry_after)
+        metrics.incr('busy')
+        return response
+    except FAILURE_EXCEPTIONS as e:
+        # Errors storing the output aren't the source's fault
+        if not is_source_failure(e):
+            raise
+        record_failure(name)
+        metrics.incr('error')
+        return failure_response()
+    request_timer.stop()
+    # Serve it up
+    return serve(backend, request, name, auto)
 
 
-def serve_file(request, path):
-    return django_serve_static(request, path, document_root='/')
-    
-    
+def serve(backend, request, name, auto=False):
+    return patch_image_headers(backend.serve(request, name), name, auto)
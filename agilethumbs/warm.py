@@ -0,0 +1,105 @@
+import os
+import multiprocessing
+
+from django.db import connection
+
+from agilethumbs.base import get_style_registry, escape
+from agilethumbs.backends import get_cache_backend
+from agilethumbs.generate import generate_styles
+
+
+def warm(object_ids, style_names, processes=None, callback=None):
+    """
+    Generate any missing cached images for every combination of object ID
+    (as returned by the OBJECT_TO_ID function) and style, using a pool of
+    `processes` worker processes (default: one per CPU). Each source is read
+    only once for all the styles.
+
+    `callback` is called with the status ('created', 'exists' or 'error'),
+    the URL parameters and, for errors, a message, as each job completes.
+    Returns a dict counting the jobs with each status.
+    """
+    # Fail early on unknown styles
+    registry = get_style_registry()
+    for name in style_names:
+        registry[name]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    counts = {'created': 0, 'exists': 0, 'error': 0}
+    jobs = ((escape(object_id), style_names) for object_id in object_ids)
+    if processes > 1:
+        # Don't share the database connection with the worker processes
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(warm_one, jobs, chunksize=16)
+    else:
+        pool = None
+        results = (warm_one(job) for job in jobs)
+    try:
+        for job_results in results:
+            for status, params, message in job_results:
+                counts[status] += 1
+                if callback is not None:
+                    callback(status, params, message)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return counts
+
+
+def warm_one(job):
+    """
+    Generate the missing cached images for one source, reading it only once,
+    and return a (status, params, message) tuple for each style rather than
+    raising so that one bad source doesn't stop the rest
+    """
+    file_id, style_names = job
+    registry = get_style_registry()
+    backend = get_cache_backend()
+    styles = [registry[name] for name in style_names]
+    try:
+        # Warming has its own concurrency limit
+        created = generate_styles(file_id, style_names, throttle=False)
+    except Exception as e:
+        message = '%s: %s' % (e.__class__.__name__, e)
+        return [('exists', style.params(file_id), None)
+                if all(backend.exists(name)
+                       for (extension, name) in style.cache_names(file_id))
+                else ('error', style.params(file_id), message)
+                for style in styles]
+    return [('created' if style.name in created else 'exists',
+             style.params(file_id), None) for style in styles]
+
+
+def iter_storage_ids(storage, path=''):
+    """
+    Yield the IDs of every file under `path` in `storage`
+    """
+    this_object_to_id = get_style_registry().object_to_id
+    directories, files = storage.listdir(path)
+    for name in files:
+        yield this_object_to_id(StorageName(os.path.join(path, name)))
+    for directory in directories:
+        for object_id in iter_storage_ids(storage, os.path.join(path,
+                                                                directory)):
+            yield object_id
+
+
+def iter_model_ids(model, field):
+    """
+    Yield the IDs of the files in `field` for every instance of `model`
+    """
+    this_object_to_id = get_style_registry().object_to_id
+    for obj in model._default_manager.all().iterator():
+        fileobj = getattr(obj, field)
+        if fileobj:
+            yield this_object_to_id(fileobj)
+
+
+class StorageName(object):
+    """
+    Stands in for an unopened file in storage when converting it to an ID
+    """
+
+    def __init__(self, name):
+        self.name = name